@@ -1,4 +1,5 @@
 import os
+import sqlite3
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 from flask import Flask
@@ -8,6 +9,8 @@ from flask.ext.login import LoginManager
 from flask.ext.assets import Environment
 from flask.ext.wtf import CsrfProtect
 from flask.ext.compress import Compress
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from config import config
 from assets import app_css, app_js, vendor_css, vendor_js
 
@@ -22,6 +25,37 @@ login_manager.session_protection = 'strong'
 login_manager.login_view = 'account.login'
 
 
+# The sqlite3 module commits before SAVEPOINT statements, which breaks
+# db.session.begin_nested(). Begin transactions ourselves instead, at the
+# first statement that isn't a SELECT as sqlite3 would, so that reads don't
+# hold locks that block writers in other threads.
+@event.listens_for(Engine, 'connect')
+def _connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, 'begin')
+def _begin(connection):
+    if connection.dialect.name == 'sqlite':
+        connection.info['sqlite_begin'] = True
+
+
+@event.listens_for(Engine, 'commit')
+@event.listens_for(Engine, 'rollback')
+def _end(connection):
+    connection.info.pop('sqlite_begin', None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(connection, cursor, statement, parameters, context,
+                    executemany):
+    if connection.info.get('sqlite_begin') and \
+            not statement.lstrip().upper().startswith('SELECT'):
+        del connection.info['sqlite_begin']
+        cursor.execute('BEGIN')
+
+
 def create_app(config_name):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
@@ -38,6 +72,14 @@ def create_app(config_name):
     from utils import register_template_utils
     register_template_utils(app)
 
+    # Count SQL queries per request
+    from query_counter import init_query_counter
+    init_query_counter(app)
+
+    # Load member names for autocomplete
+    from autocomplete import init_name_index
+    init_name_index(app)
+
     # Set up asset pipeline
     assets_env = Environment(app)
     dirs = ['assets/styles', 'assets/scripts']
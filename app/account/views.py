@@ -41,7 +41,12 @@ def register():
     """Register a new user, and send them a confirmation email."""
     form = RegistrationForm()
     if form.validate_on_submit():
-        zip_code = ZIPCode.create_zip_code(form.zip_code.data)
+        try:
+            zip_code = ZIPCode.create_zip_code(form.zip_code.data)
+        except ValueError:
+            flash('ZIP code {} could not be found.'.format(form.zip_code.data),
+                  'form-error')
+            return render_template('account/register.html', form=form)
         user = User(first_name=form.first_name.data,
                     last_name=form.last_name.data,
                     email=form.email.data,
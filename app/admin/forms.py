@@ -1,4 +1,5 @@
 from flask.ext.wtf import Form
+from flask.ext.wtf.file import FileField, FileRequired
 from wtforms.fields import StringField, PasswordField, SubmitField
 from wtforms.fields.html5 import EmailField
 from wtforms.ext.sqlalchemy.fields import QuerySelectField
@@ -49,6 +50,17 @@ class InviteUserForm(Form):
             raise ValidationError('Email already registered.')
 
 
+class InviteUsersForm(Form):
+    role = QuerySelectField('Account type',
+                            validators=[InputRequired()],
+                            get_label='name',
+                            query_factory=lambda: db.session.query(Role).
+                            order_by('permissions'))
+    csv_file = FileField('CSV file with first_name, last_name and email '
+                         'columns', validators=[FileRequired()])
+    submit = SubmitField('Invite')
+
+
 class NewUserForm(InviteUserForm):
     password = PasswordField('Password', validators=[
         InputRequired(), EqualTo('password2',
@@ -1,18 +1,35 @@
 from ..decorators import admin_required
 
-from flask import render_template, abort, redirect, flash, url_for, request
+from datetime import datetime
+from flask import render_template, abort, redirect, flash, url_for, \
+    request, current_app, Response, stream_with_context
 from flask.ext.login import login_required, current_user
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, lazyload, load_only
 
 from forms import (
     ChangeUserEmailForm,
     NewUserForm,
     ChangeAccountTypeForm,
     InviteUserForm,
+    InviteUsersForm,
 )
 from . import admin
-from ..models import User, Role, DonorLevel
+from ..models import User, Role, DonorLevel, Tag, AffiliationTag, Job
 from .. import db
 from ..email import send_email
+from ..export import export_users, gzipped, parse_since, MIMETYPES
+from ..invites import invite_users, InviteFileError
+from ..jobs import retry
+from ..pagination import keyset_paginate
+
+# Sort orders of the registered users table, on indexed columns. Each ends
+# with the id so that every user has a distinct sort key.
+USER_SORTS = {
+    'last_name': [User.last_name, User.id],
+    'first_name': [User.first_name, User.id],
+    'email': [User.email, User.id]
+}
 
 
 @admin.route('/')
@@ -67,16 +84,110 @@ def invite_user():
     return render_template('admin/new_user.html', form=form)
 
 
+@admin.route('/invite-users', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def invite_users_from_csv():
+    """Invites every new user listed in an uploaded CSV file."""
+    form = InviteUsersForm()
+    report = None
+    if form.validate_on_submit():
+        try:
+            report = invite_users(form.csv_file.data.stream, form.role.data)
+        except InviteFileError as e:
+            flash(str(e), 'form-error')
+        else:
+            flash('{invited} of {rows} users invited and {resent} '
+                  'invitations resent. The emails are being sent in the '
+                  'background.'.format(**report), 'form-success')
+    return render_template('admin/invite_users.html', form=form,
+                           report=report)
+
+
 @admin.route('/users')
 @login_required
 @admin_required
 def registered_users():
-    """View all registered users."""
-    users = User.query.all()
+    """
+    View registered users, filtered by `role`, `donor_level`, `affiliation`
+    and `confirmed`, and sorted by `sort` in `order`, one page at a time.
+    """
+    args = request.args
+    sort = args.get('sort')
+    if sort not in USER_SORTS:
+        sort = 'last_name'
+    filters = dict((name, args.get(name, type=int))
+                   for name in ['role', 'donor_level', 'affiliation'])
+    confirmed = args.get('confirmed')
+    if confirmed not in ['yes', 'no']:
+        confirmed = None
+
+    # Load just what the table shows, with each user's role and donor level
+    # in the same query.
+    users = User.query.options(
+        load_only('id', 'first_name', 'last_name', 'email'),
+        joinedload(User.role).load_only('name'),
+        joinedload(User.donor_level).load_only('name'),
+        lazyload(User.user_links))
+    if filters['role'] is not None:
+        users = users.filter(User.role_id == filters['role'])
+    if filters['donor_level'] is not None:
+        users = users.filter(User.donor_level_id == filters['donor_level'])
+    if filters['affiliation'] is not None:
+        users = users.filter(User.tags.any(Tag.id == filters['affiliation']))
+    if confirmed is not None:
+        users = users.filter(User.confirmed == (confirmed == 'yes'))
+    descending = args.get('order') == 'desc'
+    page = keyset_paginate(users, USER_SORTS[sort],
+                           current_app.config['ADMIN_USERS_PER_PAGE'],
+                           after=args.get('after'),
+                           before=args.get('before'),
+                           descending=descending)
+
+    # Query arguments that select the current set of users, for links.
+    params = dict((name, value) for name, value in filters.items()
+                  if value is not None)
+    if confirmed is not None:
+        params['confirmed'] = confirmed
     roles = Role.query.all()
     donor_levels = DonorLevel.query.all()
-    return render_template('admin/registered_users.html', users=users,
-                           roles=roles, donor_levels=donor_levels)
+    affiliations = AffiliationTag.query.order_by(AffiliationTag.name).all()
+    return render_template('admin/registered_users.html', users=page,
+                           roles=roles, donor_levels=donor_levels,
+                           affiliations=affiliations, params=params,
+                           sort=sort, descending=descending)
+
+
+@admin.route('/users/export')
+@login_required
+@admin_required
+def export_registered_users():
+    """
+    Download the users added or changed `since` a time (all users if not
+    given) as `format` csv or jsonl, gzipped if the client accepts it. The
+    X-Exported-At header gives the time to use as `since` for the next
+    export.
+    """
+    format = request.args.get('format', 'csv')
+    if format not in MIMETYPES:
+        abort(400)
+    try:
+        since = parse_since(request.args.get('since'))
+    except ValueError:
+        abort(400)
+    exported_at = datetime.utcnow()
+    chunks = export_users(format, since)
+    headers = {
+        'Content-Disposition': 'attachment; filename=users-{}.{}'.format(
+            exported_at.strftime('%Y%m%d%H%M%S'), format),
+        'X-Exported-At': exported_at.isoformat()
+    }
+    if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+        chunks = gzipped(chunks)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    return Response(stream_with_context(chunks), mimetype=MIMETYPES[format],
+                    headers=headers)
 
 
 @admin.route('/user/<int:user_id>')
@@ -181,3 +292,40 @@ def update_donor_level():
     db.session.commit()
 
     return redirect(url_for('admin.registered_users'))
+
+
+@admin.route('/jobs')
+@login_required
+@admin_required
+def jobs():
+    """View background jobs, newest first, filtered by `status`."""
+    status = request.args.get('status')
+    if status not in Job.STATUSES:
+        status = None
+    counts = dict(db.session.query(Job.status, func.count(Job.id))
+                  .group_by(Job.status))
+    query = Job.query.options(load_only('id', 'task', 'status', 'attempts',
+                                        'max_attempts', 'run_at',
+                                        'created_at', 'finished_at',
+                                        'last_error'))
+    if status is not None:
+        query = query.filter(Job.status == status)
+    page = keyset_paginate(query, [Job.id],
+                           current_app.config['ADMIN_JOBS_PER_PAGE'],
+                           after=request.args.get('after'),
+                           before=request.args.get('before'),
+                           descending=True)
+    return render_template('admin/jobs.html', jobs=page, counts=counts,
+                           statuses=Job.STATUSES, status=status)
+
+
+@admin.route('/jobs/<int:job_id>/retry', methods=['POST'])
+@login_required
+@admin_required
+def retry_job(job_id):
+    """Run a failed job again."""
+    job = Job.query.get_or_404(job_id)
+    if job.status == Job.FAILED:
+        retry(job)
+        db.session.commit()
+    return redirect(url_for('admin.jobs', status=request.args.get('status')))
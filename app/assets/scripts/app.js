@@ -43,3 +43,45 @@ $(document).ready(function () {
         };
 })(jQuery);
 
+// Show the markers of a GMaps map, fetched from a map data endpoint (see
+// app/geo/clustering.py) for the visible bounding box and zoom level
+// whenever the map stops moving. markerFor(data, i) returns the options of
+// the marker for the i-th cluster of a page of data.
+function loadMapData(map, url, markerFor) {
+    var latest = 0;
+
+    function load() {
+        var bounds = map.map.getBounds();
+        if (!bounds) {
+            return;
+        }
+        var sw = bounds.getSouthWest();
+        var ne = bounds.getNorthEast();
+        var params = {
+            bbox: [sw.lat(), sw.lng(), ne.lat(), ne.lng()].join(','),
+            zoom: map.getZoom()
+        };
+        var current = ++latest;
+        map.removeMarkers();
+        (function fetchPage(page) {
+            params.page = page;
+            $.getJSON(url, params, function (data) {
+                if (current !== latest) {
+                    return;  // The map has moved since this request.
+                }
+                for (var i = 0; i < data.lat.length; i++) {
+                    map.addMarker(markerFor(data, i));
+                }
+                if (data.next_page) {
+                    fetchPage(data.next_page);
+                }
+            });
+        })(1);
+    }
+
+    google.maps.event.addListener(map.map, 'idle', load);
+}
+
+function escapeHtml(text) {
+    return $('<div>').text(text).html();
+}
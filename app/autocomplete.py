@@ -0,0 +1,224 @@
+"""
+In-memory autocomplete of member names.
+
+Each process keeps the words of every member's name in a sorted list of
+(word, user id) pairs, so completing a prefix is a binary search that does
+not touch the database. Changes to users committed by this process are
+applied to the index as they are committed, and the whole index is reloaded
+every AUTOCOMPLETE_REBUILD_INTERVAL seconds to pick up changes made by other
+processes. The index is first loaded before the app serves its first
+request.
+"""
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from flask import current_app
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect
+from . import db
+
+
+def name_words(name):
+    """Return the lowercase words of name, without accents."""
+    name = unicodedata.normalize('NFKD', unicode(name or ''))
+    name = u''.join(c for c in name if not unicodedata.combining(c))
+    return re.findall(r'\w+', name.lower(), re.UNICODE)
+
+
+class NameIndex(object):
+    def __init__(self, rebuild_interval=300, clock=time.time):
+        """
+        Index the names of all users. The index is reloaded from the
+        database at most every rebuild_interval seconds.
+        """
+        self.rebuild_interval = rebuild_interval
+        self.clock = clock
+        # Sorted (word, user id) pairs.
+        self._keys = []
+        # User id -> (full name, name words), see _entry.
+        self._names = {}
+        # (user id, (first name, last name) or None if removed) for the
+        # changes made while a rebuild reads the users, else None.
+        self._changes = None
+        self._next_rebuild = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def rebuild(self, force=False):
+        """
+        Reload the names of all users. Completions are served from the old
+        index while the users are read, and the changes made meanwhile are
+        applied to the new one.
+        """
+        with self._lock:
+            now = self.clock()
+            if not force and now < self._next_rebuild:
+                return
+            self._next_rebuild = now + self.rebuild_interval
+            if self._changes is None:
+                self._changes = []
+
+        names = {}
+        keys = []
+        for user_id, first_name, last_name in self._read_names():
+            name, words = self._entry(first_name, last_name)
+            names[user_id] = (name, words)
+            keys.extend((word, user_id) for word in words.split())
+        keys.sort()
+
+        with self._lock:
+            self._keys, self._names = keys, names
+            changes, self._changes = self._changes or [], None
+            for user_id, name in changes:
+                self._remove(user_id)
+                if name is not None:
+                    self._add(user_id, *name)
+
+    def _read_names(self):
+        """Return the (id, first name, last name) of every user."""
+        from .models import User
+
+        return db.session.query(User.id, User.first_name,
+                                User.last_name).all()
+
+    @staticmethod
+    def _entry(first_name, last_name):
+        """
+        Return the full name and name words of a user. The words are joined
+        into one string, each preceded by a space, so that ' ' + prefix in
+        words tests whether any of them starts with prefix.
+        """
+        name = u' '.join(part for part in (first_name, last_name) if part)
+        return name, u''.join(u' ' + word for word in
+                              sorted(set(name_words(name))))
+
+    def set(self, user_id, first_name, last_name):
+        """Add a user to the index, or update their name."""
+        with self._lock:
+            self._remove(user_id)
+            self._add(user_id, first_name, last_name)
+            if self._changes is not None:
+                self._changes.append((user_id, (first_name, last_name)))
+
+    def remove(self, user_id):
+        """Remove a user from the index."""
+        with self._lock:
+            self._remove(user_id)
+            if self._changes is not None:
+                self._changes.append((user_id, None))
+
+    def _add(self, user_id, first_name, last_name):
+        name, words = self._entry(first_name, last_name)
+        self._names[user_id] = (name, words)
+        for word in words.split():
+            insort(self._keys, (word, user_id))
+
+    def _remove(self, user_id):
+        name, words = self._names.pop(user_id, (None, u''))
+        for word in words.split():
+            i = bisect_left(self._keys, (word, user_id))
+            if i < len(self._keys) and self._keys[i] == (word, user_id):
+                del self._keys[i]
+
+    def complete(self, query, k=10):
+        """
+        Return up to k (user id, full name) pairs for users with a name word
+        starting with each word of query.
+        """
+        self.rebuild()
+        terms = name_words(query)
+        if not terms:
+            return []
+        results = []
+        seen = set()
+        with self._lock:
+            keys, names = self._keys, self._names
+            # Scan the completions of the word that has the fewest.
+            start, end = min((self._range(term) for term in terms),
+                             key=lambda bounds: bounds[1] - bounds[0])
+            prefixes = [u' ' + term for term in terms]
+            for i in xrange(start, end):
+                user_id = keys[i][1]
+                if user_id in seen:
+                    continue
+                seen.add(user_id)
+                name, words = names[user_id]
+                if all(prefix in words for prefix in prefixes):
+                    results.append((user_id, name))
+                    if len(results) == k:
+                        break
+        return results
+
+    def _range(self, prefix):
+        """Return the slice of self._keys with words starting with prefix."""
+        return (bisect_left(self._keys, (prefix,)),
+                bisect_left(self._keys, (prefix + u'\uffff',)))
+
+
+def init_name_index(app):
+    """Load the name index before app serves its first request."""
+    @app.before_first_request
+    def load_name_index():
+        get_name_index(app).rebuild(force=True)
+
+
+_index_lock = threading.Lock()
+
+
+def get_name_index(app=None):
+    """Return the NameIndex of users for app."""
+    app = app or current_app._get_current_object()
+    with _index_lock:
+        index = app.extensions.get('name_index')
+        if index is None:
+            index = NameIndex(
+                rebuild_interval=app.config['AUTOCOMPLETE_REBUILD_INTERVAL'])
+            app.extensions['name_index'] = index
+    return index
+
+
+# Users added, renamed or deleted in a flush are applied to the index once
+# the transaction is committed.
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _record_name_changes(session, flush_context):
+    from .models import User
+
+    changes = session.info.setdefault('name_changes', [])
+    for user in session.deleted:
+        if isinstance(user, User):
+            changes.append((user.id, None))
+    for user in session.new:
+        if isinstance(user, User):
+            changes.append((user.id, (user.first_name, user.last_name)))
+    for user in session.dirty:
+        if isinstance(user, User):
+            attrs = inspect(user).attrs
+            if attrs.first_name.history.has_changes() or \
+                    attrs.last_name.history.has_changes():
+                changes.append((user.id,
+                                (user.first_name, user.last_name)))
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _apply_name_changes(session):
+    changes = session.info.pop('name_changes', None)
+    if not changes or not current_app:
+        return
+    index = current_app.extensions.get('name_index')
+    if index is None:
+        return
+    for user_id, name in changes:
+        if name is None:
+            index.remove(user_id)
+        else:
+            index.set(user_id, *name)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _discard_name_changes(session):
+    session.info.pop('name_changes', None)
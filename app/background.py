@@ -0,0 +1,68 @@
+"""
+Periodic upkeep of in-memory state, run by one daemon thread per process.
+
+The distance indexes (app.geo.distance) and the write-coalescing counters
+(app.counters) register here instead of starting threads of their own. They
+are held by weak reference, so the state of an app that is gone (as after
+each test) is dropped rather than kept alive by the thread, and a process
+runs one thread and one exit hook however many apps it creates.
+"""
+import atexit
+import threading
+import time
+import weakref
+
+# Seconds between calls of each task's tick.
+TICK = 1
+
+_tasks = weakref.WeakSet()
+_lock = threading.Lock()
+_thread = None
+
+
+def register(task):
+    """
+    Call task.tick() every TICK seconds from the background thread, and
+    task.close() (if it has one) when the process exits, for as long as task
+    is alive. task.app is used to log its errors.
+    """
+    global _thread
+    with _lock:
+        _tasks.add(task)
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name='background')
+            _thread.daemon = True
+            _thread.start()
+
+
+def unregister(task):
+    with _lock:
+        _tasks.discard(task)
+
+
+def _live_tasks():
+    with _lock:
+        return list(_tasks)
+
+
+def _run():
+    while True:
+        time.sleep(TICK)
+        for task in _live_tasks():
+            try:
+                task.tick()
+            except Exception:
+                task.app.logger.exception('Background upkeep of %r failed',
+                                          task)
+
+
+@atexit.register
+def _close_all():
+    for task in _live_tasks():
+        close = getattr(task, 'close', None)
+        if close is None:
+            continue
+        try:
+            close()
+        except Exception:
+            task.app.logger.exception('Closing %r failed', task)
@@ -0,0 +1,128 @@
+"""
+Write-coalescing counters.
+
+Clicks on frequently updated counters, such as the likes and dislikes of
+reviews, are added up in memory and written to the database every
+COUNTER_FLUSH_INTERVAL seconds by the process's background thread (see
+app.background). Each flush runs one
+`UPDATE ... SET column = column + n` per distinct (column, n) pair, so the
+database sees a steady trickle of writes however fast votes arrive, and
+increments from other processes are never overwritten. Pending increments
+are flushed when the process exits cleanly.
+"""
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import current_app
+from sqlalchemy import func
+from . import background, db
+
+
+class CounterBuffer(object):
+    def __init__(self, app, model, columns, flush_interval=5,
+                 clock=time.time):
+        """
+        Buffer increments to the given integer columns of model's rows, and
+        flush them every flush_interval seconds.
+        """
+        self.app = app
+        self.model = model
+        self.columns = columns
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self._next_flush = clock() + flush_interval
+        # (row id, column) -> increment not yet written, and increments
+        # being written by a flush in progress.
+        self._pending = Counter()
+        self._flushing = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        background.register(self)
+
+    def increment(self, id, column, n=1):
+        """Add n to column of the row with the given id."""
+        if column not in self.columns:
+            raise ValueError('%s is not a buffered column' % column)
+        with self._lock:
+            self._pending[(id, column)] += n
+
+    def pending(self, id):
+        """
+        Return a dict of the increments to each column of the row with the
+        given id that have not been written yet.
+        """
+        with self._lock:
+            return dict((column, self._pending[(id, column)] +
+                         self._flushing[(id, column)])
+                        for column in self.columns)
+
+    def flush(self):
+        """
+        Write all pending increments. Returns the number of counters
+        written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, Counter()
+                self._flushing = pending
+            if not pending:
+                return 0
+            # Group rows by the increment they need, to update them together.
+            groups = defaultdict(list)
+            for (id, column), n in pending.items():
+                if n:
+                    groups[(column, n)].append(id)
+            table = self.model.__table__
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as connection:
+                        for (column, n), ids in groups.items():
+                            connection.execute(
+                                table.update()
+                                .where(table.c.id.in_(ids))
+                                .values({column: func.coalesce(
+                                    table.c[column], 0) + n}))
+            except Exception:
+                # Keep the increments to retry them on the next flush.
+                with self._lock:
+                    self._pending.update(pending)
+                    self._flushing = Counter()
+                raise
+            with self._lock:
+                self._flushing = Counter()
+            return len(pending)
+
+    def tick(self):
+        if self.clock() >= self._next_flush:
+            self._next_flush = self.clock() + self.flush_interval
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+    def stop(self):
+        """Stop the periodic flushes and write any pending increments."""
+        background.unregister(self)
+        self.flush()
+
+
+_buffer_lock = threading.Lock()
+
+
+def get_vote_counter(app=None):
+    """
+    Return the CounterBuffer of review likes and dislikes for app, starting
+    it on first use.
+    """
+    from .models import ResourceReview
+
+    app = app or current_app._get_current_object()
+    with _buffer_lock:
+        counter = app.extensions.get('vote_counter')
+        if counter is None:
+            counter = CounterBuffer(
+                app, ResourceReview, ['count_likes', 'count_dislikes'],
+                flush_interval=app.config['COUNTER_FLUSH_INTERVAL'])
+            app.extensions['vote_counter'] = counter
+    return counter
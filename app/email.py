@@ -1,21 +1,236 @@
-from threading import Thread
+"""
+Outgoing email.
+
+Messages are rendered in the request that sends them, then queued for a
+small pool of EMAIL_WORKERS threads. Each worker keeps its SMTP connection
+open while there is more mail to send, sending up to EMAIL_BATCH_SIZE
+messages per connection, and closes it once the queue has been empty for
+EMAIL_IDLE_TIMEOUT seconds. Together, the workers send at most
+EMAIL_RATE_LIMIT messages per second. A message whose connection breaks is
+sent once more over a new connection before it is given up on. A worker
+that fails to connect or loses its connection waits EMAIL_RETRY_DELAY
+seconds before connecting again, doubling the wait with each failure in a
+row. The queue holds at most EMAIL_QUEUE_SIZE messages; when it is full,
+send_email waits up to EMAIL_QUEUE_TIMEOUT seconds for room, then sends the
+message itself, so that it is neither lost nor reported as sent when it
+was not.
+
+With JOB_QUEUE_ENABLED, messages are instead saved as jobs (see app.jobs)
+with the current transaction, and sent by `manage.py worker`.
+"""
+import atexit
+import itertools
+import smtplib
+import socket
+import threading
+import time
+from collections import Counter
+from Queue import Queue, Empty, Full
 
 from flask import current_app, render_template
 from flask.ext.mail import Message
 from . import mail
+from .geo.batch import RateLimiter
+from .jobs import enqueue
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class EmailQueueFull(Exception):
+    pass
 
 
-def send_email(to, subject, template, **kwargs):
+class EmailPool(object):
+    # Longest wait in seconds before reconnecting after failures.
+    MAX_RETRY_DELAY = 60
+
+    def __init__(self, app, workers=2, queue_size=1000, batch_size=50,
+                 idle_timeout=5, rate_limit=None, retry_delay=1):
+        """
+        Send messages queued with submit using workers threads, at most
+        rate_limit per second (unlimited if None).
+        """
+        self.app = app
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.retry_delay = retry_delay
+        self.queue = Queue(maxsize=queue_size)
+        # Delivery counts: queued, overflowed (queue full), sent, retried,
+        # failed and connections (SMTP connections opened).
+        self._stats = Counter()
+        self._lock = threading.Lock()
+        # Connection failures in a row of each worker.
+        self._local = threading.local()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run,
+                                      name='email-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        atexit.register(self.stop)
+
+    def submit(self, msg, timeout=None):
+        """
+        Queue msg to be sent, waiting up to timeout seconds (forever if
+        None) for room in the queue. Raises EmailQueueFull if there is none.
+        """
+        try:
+            self.queue.put(msg, timeout=timeout)
+        except Full:
+            self._count('overflowed')
+            raise EmailQueueFull('%d emails are waiting to be sent' %
+                                 self.queue.qsize())
+        self._count('queued')
+
+    def stats(self):
+        """Return a dict of delivery counts and the current queue length."""
+        with self._lock:
+            stats = dict(self._stats)
+        for key in ('queued', 'overflowed', 'sent', 'retried', 'failed',
+                    'connections'):
+            stats.setdefault(key, 0)
+        stats['waiting'] = self.queue.qsize()
+        return stats
+
+    def join(self):
+        """Wait until every queued message has been sent or has failed."""
+        self.queue.join()
+
+    def stop(self, timeout=10):
+        """
+        Let the workers send the messages already queued, then stop them,
+        waiting up to timeout seconds for each.
+        """
+        for thread in self.threads:
+            try:
+                self.queue.put(None, timeout=timeout)
+            except Full:
+                break
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _run(self):
+        self._local.failures = 0
+        with self.app.app_context():
+            msg, retry = self.queue.get(), False
+            while msg is not None:
+                msg, retry = self._send_batch(msg, retry)
+
+    def _send_batch(self, msg, retry=False):
+        """
+        Send msg and the messages queued after it over one connection.
+        retry is True if msg has already failed on a broken connection.
+        Returns the next message to send (None to stop the worker) and
+        whether it is a retry.
+        """
+        connection = mail.connect()
+        try:
+            connection.__enter__()
+        except (smtplib.SMTPException, socket.error):
+            self.app.logger.exception('Connecting to the mail server failed')
+            return self._connection_failed(msg, retry)
+        self._count('connections')
+        self._local.failures = 0
+        try:
+            for sent in itertools.count(1):
+                self.rate_limiter.acquire()
+                try:
+                    connection.send(msg)
+                    self._count('sent')
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    self.app.logger.exception('Sending email to %s failed',
+                                              ', '.join(msg.recipients))
+                    return self._connection_failed(msg, retry)
+                except Exception:
+                    self.app.logger.exception('Sending email to %s failed',
+                                              ', '.join(msg.recipients))
+                    self._count('failed')
+                self.queue.task_done()
+                retry = False
+                if sent == self.batch_size:
+                    break
+                try:
+                    msg = self.queue.get(timeout=self.idle_timeout)
+                except Empty:
+                    break
+                if msg is None:
+                    return None, False
+        finally:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, socket.error):
+                pass
+        return self.queue.get(), False
+
+    def _connection_failed(self, msg, retry):
+        """
+        Wait before connecting again, then return msg to be sent again over
+        a new connection, or, if it has been retried already, give up on it
+        and return the next message.
+        """
+        self._local.failures += 1
+        time.sleep(min(self.retry_delay * 2 ** (self._local.failures - 1),
+                       self.MAX_RETRY_DELAY))
+        if not retry:
+            self._count('retried')
+            return msg, True
+        self._count('failed')
+        self.queue.task_done()
+        return self.queue.get(), False
+
+
+_pool_lock = threading.Lock()
+
+
+def get_email_pool(app=None):
+    """Return the EmailPool of app, starting it on first use."""
+    app = app or current_app._get_current_object()
+    with _pool_lock:
+        pool = app.extensions.get('email_pool')
+        if pool is None:
+            pool = EmailPool(app,
+                             workers=app.config['EMAIL_WORKERS'],
+                             queue_size=app.config['EMAIL_QUEUE_SIZE'],
+                             batch_size=app.config['EMAIL_BATCH_SIZE'],
+                             idle_timeout=app.config['EMAIL_IDLE_TIMEOUT'],
+                             rate_limit=app.config['EMAIL_RATE_LIMIT'],
+                             retry_delay=app.config['EMAIL_RETRY_DELAY'])
+            app.extensions['email_pool'] = pool
+    return pool
+
+
+def make_message(to, subject, template, **kwargs):
+    """Return a Message to the address to, rendered from template."""
     app = current_app._get_current_object()
     msg = Message(app.config['EMAIL_SUBJECT_PREFIX'] + ' ' + subject,
                   sender=app.config['EMAIL_SENDER'], recipients=[to])
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    return msg
+
+
+def send_email(to, subject, template, **kwargs):
+    """
+    Render template and send it to the address to. Returns the Message.
+    If the email queue is full, the message is sent before returning, and
+    an error sending it is raised.
+    """
+    app = current_app._get_current_object()
+    msg = make_message(to, subject, template, **kwargs)
+    if app.config['JOB_QUEUE_ENABLED']:
+        enqueue('send_email', {'subject': msg.subject, 'sender': msg.sender,
+                               'recipients': msg.recipients,
+                               'body': msg.body, 'html': msg.html})
+    else:
+        try:
+            get_email_pool(app).submit(
+                msg, timeout=app.config['EMAIL_QUEUE_TIMEOUT'])
+        except EmailQueueFull:
+            app.logger.warning('Email queue is full, sending email to %s '
+                               'from the request', to)
+            mail.send(msg)
+    return msg
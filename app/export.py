@@ -0,0 +1,150 @@
+"""
+Streaming export of members as CSV or JSON lines.
+
+Users are read by a single query with yield_per, which fetches them from a
+server-side cursor where the database supports one, and the affiliations of
+each batch of EXPORT_BATCH_SIZE users are read with one more query. Output
+is produced in chunks as rows arrive, so memory use does not grow with the
+number of members. Pass a since time to export only the users added or
+changed since then.
+"""
+import csv
+import json
+import zlib
+from collections import OrderedDict, defaultdict
+from cStringIO import StringIO
+from datetime import datetime
+
+from flask import current_app
+from . import db
+from .models import User, Role, DonorLevel, ZIPCode, Tag, \
+    user_tag_associations_table
+
+COLUMNS = ['id', 'first_name', 'last_name', 'email', 'confirmed', 'role',
+           'donor_level', 'zip_code', 'affiliations', 'created_at',
+           'updated_at']
+MIMETYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson'
+}
+# Bytes of output collected before a chunk is handed on.
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_since(value):
+    """
+    Return the datetime given as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS[.ffffff],
+    or None if value is empty. Raises ValueError if it is malformed.
+    """
+    if not value:
+        return None
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('%s is not a date or time' % value)
+
+
+def user_rows(since=None, batch_size=None):
+    """
+    Yield a dict of COLUMNS for each user updated at or after since (every
+    user if None), in order of id.
+    """
+    batch_size = batch_size or current_app.config['EXPORT_BATCH_SIZE']
+    query = db.session.query(User.id, User.first_name, User.last_name,
+                             User.email, User.confirmed,
+                             Role.name.label('role'),
+                             DonorLevel.name.label('donor_level'),
+                             ZIPCode.zip_code, User.created_at,
+                             User.updated_at)\
+        .outerjoin(Role, User.role_id == Role.id)\
+        .outerjoin(DonorLevel, User.donor_level_id == DonorLevel.id)\
+        .outerjoin(ZIPCode, User.zip_code_id == ZIPCode.id)
+    if since is not None:
+        query = query.filter(User.updated_at >= since)
+    batch = []
+    for row in query.order_by(User.id).yield_per(batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            for values in _with_affiliations(batch):
+                yield values
+            batch = []
+    for values in _with_affiliations(batch):
+        yield values
+
+
+def _with_affiliations(rows):
+    if not rows:
+        return
+    users = user_tag_associations_table.c
+    affiliations = defaultdict(list)
+    for user_id, name in db.session.query(users.user_id, Tag.name)\
+            .join(Tag, Tag.id == users.tag_id)\
+            .filter(users.user_id.in_([row.id for row in rows]),
+                    Tag.type == 'AffiliationTag')\
+            .order_by(Tag.name):
+        affiliations[user_id].append(name)
+    for row in rows:
+        values = row._asdict()
+        values['affiliations'] = affiliations[row.id]
+        yield values
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def csv_lines(rows):
+    """Yield the header and then a line of UTF-8 CSV for each row."""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for values in rows:
+        values['affiliations'] = '; '.join(values['affiliations'])
+        values['created_at'] = _isoformat(values['created_at'])
+        values['updated_at'] = _isoformat(values['updated_at'])
+        writer.writerow([unicode(values[column]).encode('utf-8')
+                         if values[column] is not None else ''
+                         for column in COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def jsonl_lines(rows):
+    """Yield a line of JSON for each row."""
+    for values in rows:
+        values['created_at'] = _isoformat(values['created_at'])
+        values['updated_at'] = _isoformat(values['updated_at'])
+        yield json.dumps(OrderedDict((column, values[column])
+                                     for column in COLUMNS)) + '\n'
+
+
+def export_users(format, since=None):
+    """
+    Yield chunks of the export of users updated since (all if None) in
+    format, 'csv' or 'jsonl'.
+    """
+    lines = csv_lines if format == 'csv' else jsonl_lines
+    chunk = []
+    size = 0
+    for line in lines(user_rows(since)):
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def gzipped(chunks, level=6):
+    """Compress a stream of chunks into a stream of gzip data."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
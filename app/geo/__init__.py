@@ -0,0 +1,52 @@
+"""
+Helpers for turning ZIP codes into coordinates.
+
+ZIP codes are resolved from the bundled gazetteer, which needs no network and
+answers in constant time. The remote geocoder is only used as a fallback for
+ZIP codes missing from the gazetteer, and only if GEOCODER_REMOTE_FALLBACK is
+enabled. Remote results, including misses, are cached, and concurrent
+lookups of the same query within a process share a single remote request.
+"""
+from flask import current_app
+from .cache import GeocodeCache, get_cache
+from .gazetteer import get_gazetteer
+from .singleflight import SingleFlight
+
+_remote_lookups = SingleFlight()
+
+
+def geocode_zip_code(zip_code, remote=True):
+    """
+    Return the (latitude, longitude) of a 5 digit ZIP code, or None if it
+    cannot be located. Pass remote=False to only consult the gazetteer.
+    """
+    coordinates = get_gazetteer().lookup(zip_code)
+    if coordinates is None and remote and \
+            current_app.config['GEOCODER_REMOTE_FALLBACK']:
+        coordinates = geocode_remote(zip_code)
+    return coordinates
+
+
+def geocode_remote(query):
+    """
+    Look up query with the remote geocoder, going through the geocode cache.
+    Returns (latitude, longitude) or None if the geocoder has no match.
+    Network failures raise a geopy.exc.GeopyError and are not cached.
+    """
+    return get_cache().get_or_lookup(query, _geocode_remote_once)
+
+
+def _geocode_remote_once(query):
+    return _remote_lookups.do(GeocodeCache.normalize(query),
+                              _geocode_remote, query)
+
+
+def _geocode_remote(query):
+    from geopy.geocoders import Nominatim
+
+    geocoder = Nominatim(country_bias='us',
+                         timeout=current_app.config['GEOCODER_TIMEOUT'])
+    loc = geocoder.geocode(query)
+    if loc is None:
+        return None
+    return loc.latitude, loc.longitude
@@ -0,0 +1,108 @@
+"""Fill in coordinates for rows that were stored without them."""
+from .. import db
+from ..models import ZIPCode, Address
+from .gazetteer import get_gazetteer
+
+
+def backfill_zip_codes(batch_geocoder, commit_every=100):
+    """
+    Geocode every pending ZIPCode, trying the gazetteer before
+    batch_geocoder, and mark those it can't find unresolvable. Returns a
+    dict with the number of ZIP codes that were `located`, `not_found` or
+    `failed`, and a list of `errors` as (zip_code, exception) pairs.
+    """
+    report = {'located': 0, 'not_found': 0, 'failed': 0, 'errors': []}
+    pending = db.session.query(ZIPCode.id, ZIPCode.zip_code)\
+        .filter(ZIPCode.latitude.is_(None) | ZIPCode.longitude.is_(None),
+                ZIPCode.unresolvable.isnot(True))
+    ids = dict((zip_code, id) for id, zip_code in pending)
+
+    gazetteer = get_gazetteer()
+    remote = []
+    results = []
+    for zip_code in ids:
+        coordinates = gazetteer.lookup(zip_code)
+        if coordinates is None:
+            remote.append(zip_code)
+        else:
+            results.append((zip_code, coordinates, None))
+
+    # ZIP codes processed since the last commit, as a list so that apply
+    # can update it.
+    uncommitted = [0]
+
+    def apply(zip_code, coordinates, error):
+        if error is not None:
+            report['failed'] += 1
+            report['errors'].append((zip_code, error))
+        elif coordinates is None:
+            ZIPCode.query.filter_by(id=ids[zip_code])\
+                .update({'unresolvable': True}, synchronize_session=False)
+            report['not_found'] += 1
+        else:
+            ZIPCode.query.filter_by(id=ids[zip_code]).update({
+                'latitude': coordinates[0],
+                'longitude': coordinates[1]
+            }, synchronize_session=False)
+            report['located'] += 1
+        uncommitted[0] += 1
+        if uncommitted[0] >= commit_every:
+            db.session.commit()
+            uncommitted[0] = 0
+
+    for result in results:
+        apply(*result)
+    for result in batch_geocoder.geocode_all(remote):
+        apply(*result)
+    db.session.commit()
+    return report
+
+
+def backfill_addresses(batch_geocoder, commit_every=100):
+    """
+    Geocode every Address that has no street-level coordinates yet.
+    Addresses the geocoder cannot locate are marked unresolvable and keep
+    (or get) the centroid of their ZIP code. Returns a report like
+    backfill_zip_codes.
+    """
+    report = {'located': 0, 'not_found': 0, 'failed': 0, 'errors': []}
+    pending = Address.query.filter(Address.is_geocoded.isnot(True),
+                                   Address.unresolvable.isnot(True))
+    ids = {}
+    for address in pending:
+        ids.setdefault(address.geocoder_query(), []).append(address.id)
+
+    # Addresses processed since the last commit; each query covers several
+    # addresses at once, so the total may step over multiples of
+    # commit_every.
+    uncommitted = 0
+    for query, coordinates, error in batch_geocoder.geocode_all(ids):
+        uncommitted += len(ids[query])
+        if error is not None:
+            report['failed'] += len(ids[query])
+            report['errors'].append((query, error))
+        elif coordinates is None:
+            Address.query.filter(Address.id.in_(ids[query]))\
+                .update({'unresolvable': True}, synchronize_session=False)
+            report['not_found'] += len(ids[query])
+        else:
+            values = Address.location_values(*coordinates)
+            values['is_geocoded'] = True
+            Address.query.filter(Address.id.in_(ids[query]))\
+                .update(values, synchronize_session=False)
+            report['located'] += len(ids[query])
+        if uncommitted >= commit_every:
+            db.session.commit()
+            uncommitted = 0
+
+    # Fall back to the ZIP centroid for anything still without coordinates,
+    # and index rows that have coordinates but no grid cell.
+    for address in Address.query.filter(Address.latitude.is_(None),
+                                        Address.zip_code_id.isnot(None)):
+        if address.zip_code.is_located():
+            address.set_zip_code(address.zip_code)
+    for address in Address.query.filter(Address.latitude.isnot(None),
+                                        Address.grid_cell.is_(None)):
+        address.set_location(address.latitude, address.longitude)
+    db.session.commit()
+    return report
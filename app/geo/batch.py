@@ -0,0 +1,139 @@
+"""
+Concurrent, rate-limited geocoding of many queries at once.
+
+BatchGeocoder runs a geocode callable on a pool of threads while keeping the
+combined request rate under a limit (Nominatim allows 1 request per second),
+retries failed lookups with exponential backoff, and can record finished
+lookups in a checkpoint file so an interrupted batch resumes where it left
+off. Results are handed back to the calling thread, which is the only one
+that should touch the database session.
+"""
+import json
+import os
+import threading
+import time
+from Queue import Queue
+
+from geopy.exc import GeopyError
+
+_STOP = object()
+
+
+class RateLimiter(object):
+    """Spaces calls to acquire at least 1 / rate seconds apart."""
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self.clock()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            self.sleep(wait)
+
+
+class BatchGeocoder(object):
+    def __init__(self, geocode, workers=4, rate_limit=1.0, max_retries=3,
+                 backoff=1.0, checkpoint_path=None,
+                 retry_on=(GeopyError, IOError), sleep=time.sleep):
+        """
+        geocode is called with a query string and returns (latitude,
+        longitude) or None. Exceptions in retry_on are retried up to
+        max_retries times, waiting backoff * 2 ** attempt seconds in between.
+        """
+        self.geocode = geocode
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate_limit, sleep=sleep)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.checkpoint_path = checkpoint_path
+        self.retry_on = retry_on
+        self.sleep = sleep
+
+    def geocode_all(self, queries):
+        """
+        Geocode each distinct query, yielding (query, coordinates, error)
+        tuples as lookups finish. coordinates is None for a query the
+        geocoder could not locate; error is the exception of a lookup that
+        failed even after retrying. Queries found in the checkpoint are
+        yielded first without calling the geocoder.
+        """
+        finished = self._read_checkpoint()
+        pending = Queue()
+        results = Queue()
+        count = 0
+        for query in set(queries):
+            if query in finished:
+                yield query, finished[query], None
+            else:
+                pending.put(query)
+                count += 1
+        if count == 0:
+            return
+
+        stopped = threading.Event()
+        threads = [threading.Thread(target=self._work,
+                                    args=(pending, results, stopped))
+                   for _ in range(min(self.workers, count))]
+        for thread in threads:
+            pending.put(_STOP)
+            thread.daemon = True
+            thread.start()
+
+        checkpoint = None
+        if self.checkpoint_path is not None:
+            checkpoint = open(self.checkpoint_path, 'a')
+        try:
+            for _ in range(count):
+                query, coordinates, error = results.get()
+                if error is None and checkpoint is not None:
+                    checkpoint.write(json.dumps([query, coordinates]) + '\n')
+                    checkpoint.flush()
+                yield query, coordinates, error
+        finally:
+            stopped.set()
+            if checkpoint is not None:
+                checkpoint.close()
+
+    def _work(self, pending, results, stopped):
+        while not stopped.is_set():
+            query = pending.get()
+            if query is _STOP:
+                return
+            results.put(self._geocode_with_retries(query))
+
+    def _geocode_with_retries(self, query):
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                coordinates = self.geocode(query)
+                if coordinates is not None:
+                    coordinates = tuple(coordinates)
+                return query, coordinates, None
+            except self.retry_on as e:
+                if attempt == self.max_retries:
+                    return query, None, e
+                self.sleep(self.backoff * 2 ** attempt)
+            except Exception as e:
+                return query, None, e
+
+    def _read_checkpoint(self):
+        finished = {}
+        if self.checkpoint_path is None or \
+                not os.path.exists(self.checkpoint_path):
+            return finished
+        with open(self.checkpoint_path) as f:
+            for line in f:
+                try:
+                    query, coordinates = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run.
+                    continue
+                finished[query] = tuple(coordinates) if coordinates else None
+        return finished
@@ -0,0 +1,111 @@
+"""
+In-process cache for remote geocoder results.
+
+Both hits and misses are cached, with separate TTLs, so a bot or a user
+retrying a typo does not reach the remote geocoder again on every submit.
+The cache is bounded and evicts the least recently used entry when full.
+Geocoder errors (timeouts, rate limiting) are never cached.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+# Returned by GeocodeCache.get for keys that are not cached, since None is a
+# valid cached value (a negative result).
+NOT_CACHED = object()
+
+
+class GeocodeCache(object):
+    def __init__(self, max_size=10000, ttl=30 * 24 * 3600,
+                 negative_ttl=24 * 3600, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(query):
+        return ' '.join(query.lower().split())
+
+    def get(self, query):
+        """
+        Return the cached result for query, which is None for a cached miss,
+        or NOT_CACHED if there is no live entry.
+        """
+        key = self.normalize(query)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self.clock():
+                self.misses += 1
+                return NOT_CACHED
+            # Re-inserting moves the key to the most recently used end.
+            self._entries[key] = entry
+            self.hits += 1
+            if entry[1] is None:
+                self.negative_hits += 1
+            return entry[1]
+
+    def set(self, query, value):
+        """Cache value (None for a miss) as the result for query."""
+        key = self.normalize(query)
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock() + ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_lookup(self, query, lookup):
+        """
+        Return the cached result for query, calling lookup(query) and caching
+        its result on a cache miss.
+        """
+        value = self.get(query)
+        if value is NOT_CACHED:
+            value = lookup(query)
+            self.set(query, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache_lock = threading.Lock()
+
+
+def get_cache(app=None):
+    """Return the geocode cache for app, creating it on first use."""
+    app = app or current_app._get_current_object()
+    with _cache_lock:
+        cache = app.extensions.get('geocode_cache')
+        if cache is None:
+            cache = GeocodeCache(
+                max_size=app.config['GEOCODER_CACHE_SIZE'],
+                ttl=app.config['GEOCODER_CACHE_TTL'],
+                negative_ttl=app.config['GEOCODER_CACHE_NEGATIVE_TTL'])
+            app.extensions['geocode_cache'] = cache
+    return cache
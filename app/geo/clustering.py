@@ -0,0 +1,148 @@
+"""
+Server-side clustering of map markers.
+
+Points are merged when they fall into the same grid cell at the given map
+zoom level, so a map sends one marker per occupied cell instead of one per
+row. Cells are about CLUSTER_PIXELS wide on screen at that zoom. The
+database does the grouping, sorting and paging, so a request reads one
+page of clusters however many points are in view.
+
+The map pages fetch clusters for their visible bounding box as they are
+panned and zoomed (see loadMapData in app.js), in pages of parallel arrays
+built by cluster_page.
+"""
+from sqlalchemy import Float, Integer, and_, func, literal, or_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+TILE_PIXELS = 256
+CLUSTER_PIXELS = 60
+# At this zoom and closer, points are only merged with points within about
+# a metre (EXACT_CELL_SIZE degrees).
+MAX_CLUSTER_ZOOM = 12
+EXACT_CELL_SIZE = 1e-5
+# Clusters list the labels of at most this many of their points.
+MAX_LABELS = 5
+# Clusters per page of map data.
+PAGE_SIZE = 500
+# Longitude cells per row of latitude cells, numbering each cell with a
+# single integer.
+_ROW_CELLS = 10 ** 8
+
+
+class _floor(FunctionElement):
+    """FLOOR of a non-negative number, which SQLite lacks."""
+    type = Integer()
+    name = 'floor'
+
+
+@compiles(_floor)
+def _compile_floor(element, compiler, **kwargs):
+    return 'FLOOR(%s)' % compiler.process(element.clauses, **kwargs)
+
+
+@compiles(_floor, 'sqlite')
+def _compile_floor_sqlite(element, compiler, **kwargs):
+    return 'CAST(%s AS INTEGER)' % \
+        compiler.process(element.clauses, **kwargs)
+
+
+def cell_size(zoom):
+    """Return the cluster cell size in degrees at a zoom level."""
+    if zoom is None or zoom >= MAX_CLUSTER_ZOOM:
+        return EXACT_CELL_SIZE
+    return 360.0 / 2 ** zoom * CLUSTER_PIXELS / TILE_PIXELS
+
+
+def _cell(latitude, longitude, size):
+    """Return the number of the cell of size degrees holding a point."""
+    return _floor((latitude + 90) / size) * _ROW_CELLS + \
+        _floor((longitude + 180) / size)
+
+
+def cluster_page(points, zoom=None, page=1, per_page=PAGE_SIZE):
+    """
+    Cluster the points selected by a Query of (latitude, longitude, count,
+    label) columns for display at a zoom level, and return one page of
+    clusters, largest first. The query may select a fifth column, a key
+    such as the id of the row each point stands for.
+
+    The page is a dict of parallel arrays: the count-weighted centre (`lat`,
+    `lng`), total `count`, number of `points` and first few `labels` of
+    each cluster, and the `key` of clusters with a single point. It also
+    has the `page` number, the `next_page` (or None) and the `total` number
+    of clusters.
+    """
+    session = points.session
+    columns = list(points.subquery().c)
+    latitude, longitude, count, label = columns[:4]
+    key = columns[4] if len(columns) > 4 else literal(None)
+    cell = _cell(latitude, longitude, cell_size(zoom))
+    page = max(page, 1)
+
+    total_count = func.sum(count)
+    clusters = session.query(cell, func.sum(latitude * count, type_=Float),
+                             func.sum(longitude * count, type_=Float),
+                             total_count,
+                             func.count(), func.min(key),
+                             func.count().over())\
+        .group_by(cell).order_by(total_count.desc(), cell)\
+        .offset((page - 1) * per_page).limit(per_page).all()
+
+    labels = dict((row[0], []) for row in clusters)
+    if clusters:
+        rank = func.row_number().over(partition_by=cell, order_by=label)
+        ranked = session.query(cell.label('cell'), label.label('label'),
+                               rank.label('rank'))\
+            .filter(cell.in_(labels.keys())).subquery()
+        for row in session.query(ranked.c.cell, ranked.c.label)\
+                .filter(ranked.c.rank <= MAX_LABELS)\
+                .order_by(ranked.c.cell, ranked.c.label):
+            labels[row[0]].append(row[1])
+
+    total = clusters[0][6] if clusters else 0
+    return {
+        'lat': [round(row[1] / row[3], 4) for row in clusters],
+        'lng': [round(row[2] / row[3], 4) for row in clusters],
+        'count': [int(row[3]) for row in clusters],
+        'points': [row[4] for row in clusters],
+        'labels': [labels[row[0]] for row in clusters],
+        'key': [row[5] if row[4] == 1 else None for row in clusters],
+        'page': page,
+        'next_page': page + 1 if page * per_page < total else None,
+        'total': total
+    }
+
+
+def parse_bbox(value):
+    """
+    Parse a `south,west,north,east` bounding box string into a tuple of
+    floats. Returns None if value is missing or malformed.
+    """
+    try:
+        south, west, north, east = [float(part) for part in value.split(',')]
+    except (AttributeError, ValueError):
+        return None
+    if not -90 <= south <= north <= 90:
+        return None
+    return south, west, north, east
+
+
+def within_bbox(latitude, longitude, bbox):
+    """
+    Return a filter for latitude and longitude columns that lie within a
+    bounding box, which may cross the 180th meridian.
+    """
+    south, west, north, east = bbox
+    latitude_filter = latitude.between(south, north)
+    # Zoomed out to the whole world, e.g. west=-180 and east=180, which
+    # would otherwise normalize to the same meridian.
+    if east - west >= 360:
+        return latitude_filter
+    west = (west + 180) % 360 - 180
+    east = (east + 180) % 360 - 180
+    if west <= east:
+        longitude_filter = longitude.between(west, east)
+    else:
+        longitude_filter = or_(longitude >= west, longitude <= east)
+    return and_(latitude_filter, longitude_filter)
@@ -0,0 +1,216 @@
+"""
+Vectorized great-circle distances with NumPy.
+
+haversine_one_to_many and haversine_many_to_many compute distances for whole
+arrays of points at once. CoordinateIndex keeps the ids and coordinates of a
+table (such as zip_codes) in contiguous float arrays for nearest-neighbour
+queries. It is kept up to date off the request path by the background
+thread (see app.background): every DISTANCE_INDEX_REFRESH_INTERVAL seconds
+it loads only the rows added (or located) since the last refresh, and every
+DISTANCE_INDEX_REBUILD_INTERVAL seconds it reloads the table to drop deleted
+and moved rows.
+"""
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+
+from .. import background, db
+from .spatial import EARTH_RADIUS_MILES
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    """Haversine distance in miles between points given in radians."""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def haversine_one_to_many(latitude, longitude, latitudes, longitudes):
+    """
+    Return an array of the distances in miles from (latitude, longitude) to
+    each point in latitudes, longitudes.
+    """
+    return _haversine(np.radians(latitude), np.radians(longitude),
+                      np.radians(np.asarray(latitudes, dtype=np.float64)),
+                      np.radians(np.asarray(longitudes, dtype=np.float64)))
+
+
+def haversine_many_to_many(latitudes1, longitudes1, latitudes2, longitudes2):
+    """
+    Return a len(latitudes1) x len(latitudes2) matrix of the distances in
+    miles between every pair of points.
+    """
+    lat1 = np.radians(np.asarray(latitudes1, dtype=np.float64))
+    lon1 = np.radians(np.asarray(longitudes1, dtype=np.float64))
+    lat2 = np.radians(np.asarray(latitudes2, dtype=np.float64))
+    lon2 = np.radians(np.asarray(longitudes2, dtype=np.float64))
+    return _haversine(lat1[:, np.newaxis], lon1[:, np.newaxis], lat2, lon2)
+
+
+def rank_by_distance(latitude, longitude, rows, radius_miles=None,
+                     limit=None):
+    """
+    Rank (id, latitude, longitude) rows by distance from (latitude,
+    longitude). Returns (id, distance) pairs, nearest first, leaving out
+    rows farther than radius_miles.
+    """
+    if not rows:
+        return []
+    ids, latitudes, longitudes = zip(*rows)
+    distances = haversine_one_to_many(latitude, longitude,
+                                      latitudes, longitudes)
+    return _select(np.asarray(ids), distances, radius_miles, limit)
+
+
+def _select(ids, distances, radius_miles, limit):
+    # NaN (unlocated) distances never pass the radius check and sort last.
+    keep = ~np.isnan(distances)
+    if radius_miles is not None:
+        keep[keep] = distances[keep] <= radius_miles
+    ids, distances = ids[keep], distances[keep]
+    if limit is not None and limit < len(distances):
+        nearest = np.argpartition(distances, limit)[:limit]
+        ids, distances = ids[nearest], distances[nearest]
+    order = np.argsort(distances, kind='mergesort')
+    return zip(ids[order].tolist(), distances[order].tolist())
+
+
+class CoordinateIndex(object):
+    def __init__(self, app, model, refresh_interval=60,
+                 rebuild_interval=3600, clock=time.time):
+        """
+        Index the id, latitude and longitude columns of model for app. The
+        index is refreshed every refresh_interval seconds and rebuilt every
+        rebuild_interval seconds by the background thread.
+        """
+        self.app = app
+        self.model = model
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.clock = clock
+        # Ids are kept sorted; coordinates are in radians, NaN if unknown.
+        self._arrays = None
+        self._next_refresh = self._next_rebuild = 0
+        # Held while the index is being loaded, but not by readers.
+        self._load_lock = threading.Lock()
+        background.register(self)
+
+    def __len__(self):
+        return len(self._loaded()[0])
+
+    def tick(self):
+        # The index is loaded on first use, and kept up to date from then.
+        if self._arrays is None:
+            return
+        now = self.clock()
+        if now >= self._next_rebuild or now >= self._next_refresh:
+            with self.app.app_context():
+                if now >= self._next_rebuild:
+                    self.rebuild()
+                else:
+                    self.refresh()
+
+    def rebuild(self):
+        """Reload every row."""
+        with self._load_lock:
+            now = self.clock()
+            self._next_refresh = now + self.refresh_interval
+            self._next_rebuild = now + self.rebuild_interval
+            model = self.model
+            self._arrays = self._to_arrays(
+                db.session.query(model.id, model.latitude, model.longitude)
+                .order_by(model.id).all())
+
+    def refresh(self):
+        """
+        Load rows added since the last refresh, and re-check rows that had
+        no coordinates then.
+        """
+        if self._arrays is None:
+            return self.rebuild()
+        with self._load_lock:
+            self._next_refresh = self.clock() + self.refresh_interval
+            ids, latitudes, longitudes = self._arrays
+            model = self.model
+            condition = model.id > (int(ids[-1]) if len(ids) else 0)
+            pending = ids[np.isnan(latitudes)]
+            if len(pending):
+                condition = condition | model.id.in_(pending.tolist())
+            rows = db.session.query(model.id, model.latitude,
+                                    model.longitude)\
+                .filter(condition).order_by(model.id).all()
+            if not rows:
+                return
+            new_ids, new_latitudes, new_longitudes = self._to_arrays(rows)
+            # Copy rather than update in place, so readers holding the old
+            # arrays see a consistent snapshot.
+            existing = np.in1d(new_ids, ids)
+            latitudes, longitudes = latitudes.copy(), longitudes.copy()
+            positions = np.searchsorted(ids, new_ids[existing])
+            latitudes[positions] = new_latitudes[existing]
+            longitudes[positions] = new_longitudes[existing]
+            added = ~existing
+            self._arrays = (np.concatenate([ids, new_ids[added]]),
+                            np.concatenate([latitudes,
+                                            new_latitudes[added]]),
+                            np.concatenate([longitudes,
+                                            new_longitudes[added]]))
+
+    @staticmethod
+    def _to_arrays(rows):
+        coordinates = np.array([row[1:] for row in rows],
+                               dtype=np.float64).reshape(len(rows), 2)
+        return (np.array([row[0] for row in rows], dtype=np.int64),
+                np.radians(coordinates[:, 0]),
+                np.radians(coordinates[:, 1]))
+
+    def _loaded(self):
+        """Return the arrays, loading them on first use."""
+        arrays = self._arrays
+        if arrays is None:
+            self.rebuild()
+            arrays = self._arrays
+        return arrays
+
+    def distances(self, latitude, longitude):
+        """
+        Return (ids, distances) arrays with the distance in miles from
+        (latitude, longitude) to every indexed row.
+        """
+        ids, latitudes, longitudes = self._loaded()
+        return ids, _haversine(np.radians(latitude), np.radians(longitude),
+                               latitudes, longitudes)
+
+    def within(self, latitude, longitude, radius_miles, limit=None):
+        """
+        Return (id, distance) pairs for rows within radius_miles of
+        (latitude, longitude), nearest first.
+        """
+        ids, distances = self.distances(latitude, longitude)
+        return _select(ids, distances, radius_miles, limit)
+
+    def nearest(self, latitude, longitude, k=1):
+        """Return (id, distance) pairs for the k rows nearest a point."""
+        ids, distances = self.distances(latitude, longitude)
+        return _select(ids, distances, None, k)
+
+
+_index_lock = threading.Lock()
+
+
+def get_zip_code_index(app=None):
+    """Return the CoordinateIndex of ZIP codes for app."""
+    from ..models import ZIPCode
+
+    app = app or current_app._get_current_object()
+    with _index_lock:
+        index = app.extensions.get('zip_code_index')
+        if index is None:
+            index = CoordinateIndex(
+                app, ZIPCode,
+                refresh_interval=app.config['DISTANCE_INDEX_REFRESH_INTERVAL'],
+                rebuild_interval=app.config['DISTANCE_INDEX_REBUILD_INTERVAL'])
+            app.extensions['zip_code_index'] = index
+    return index
@@ -0,0 +1,139 @@
+"""
+Offline lookup table from 5 digit US ZIP codes to (latitude, longitude).
+
+The table is a flat binary file that is memory-mapped read-only, so every
+worker process on a host shares the same physical pages. After a 16 byte
+header, record ``n`` holds the centroid of ZIP code ``n`` as two
+little-endian float32 values (latitude, longitude). ZIP codes without a known
+location are stored as NaN, which makes every lookup a single read at a fixed
+offset.
+
+The bundled data/zip_codes.bin was built from the MIT licensed ``zipcodes``
+package (USPS ZIP codes with centroid coordinates). Use `manage.py
+build_gazetteer` to regenerate it from a newer CSV.
+"""
+import csv
+import math
+import mmap
+import os
+import struct
+import threading
+
+HEADER = struct.Struct('<8sII')
+RECORD = struct.Struct('<ff')
+MAGIC = b'ZIPGAZ01'
+NUM_ZIP_CODES = 100000
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data', 'zip_codes.bin')
+
+
+class Gazetteer(object):
+    def __init__(self, path=DEFAULT_PATH):
+        """
+        Memory-map the gazetteer file at path. If possible, get_gazetteer
+        should be used instead so the map is shared within the process.
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, _ = HEADER.unpack_from(self._map, 0)
+        expected_size = HEADER.size + RECORD.size * NUM_ZIP_CODES
+        if magic != MAGIC or count != NUM_ZIP_CODES or \
+                len(self._map) != expected_size:
+            self._map.close()
+            raise ValueError('\'%s\' is not a ZIP code gazetteer' % path)
+
+    def lookup(self, zip_code):
+        """
+        Return the (latitude, longitude) centroid of zip_code, or None if
+        zip_code is malformed or not in the table.
+        """
+        if zip_code is None or len(zip_code) != 5 or not zip_code.isdigit():
+            return None
+        latitude, longitude = RECORD.unpack_from(
+            self._map, HEADER.size + RECORD.size * int(zip_code))
+        if math.isnan(latitude):
+            return None
+        # float32 carries ~7 significant digits; the source has 4 decimals.
+        return round(latitude, 4), round(longitude, 4)
+
+    def __contains__(self, zip_code):
+        return self.lookup(zip_code) is not None
+
+    def is_plausible(self, zip_code):
+        """
+        True if zip_code is well formed and the table has a ZIP code with
+        the same 3 digit prefix (sectional center), which a ZIP code added
+        since the table was built would share.
+        """
+        if zip_code is None or len(zip_code) != 5 or not zip_code.isdigit():
+            return False
+        start = HEADER.size + RECORD.size * (int(zip_code) // 100 * 100)
+        for i in range(100):
+            latitude, longitude = RECORD.unpack_from(
+                self._map, start + RECORD.size * i)
+            if not math.isnan(latitude):
+                return True
+        return False
+
+    def close(self):
+        self._map.close()
+
+    def __repr__(self):
+        return '<Gazetteer \'%s\'>' % self.path
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    """Return the process-wide Gazetteer, opening it on first use."""
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer()
+    return _gazetteer
+
+
+def write_gazetteer(rows, path=DEFAULT_PATH):
+    """
+    Write an iterable of (zip_code, latitude, longitude) rows to a gazetteer
+    file at path. Rows with malformed ZIP codes or (0, 0) placeholder
+    coordinates are skipped. Returns the number of ZIP codes written.
+    """
+    nan = float('nan')
+    data = bytearray(HEADER.size + RECORD.size * NUM_ZIP_CODES)
+    HEADER.pack_into(data, 0, MAGIC, NUM_ZIP_CODES, 0)
+    for i in range(NUM_ZIP_CODES):
+        RECORD.pack_into(data, HEADER.size + RECORD.size * i, nan, nan)
+
+    written = set()
+    for zip_code, latitude, longitude in rows:
+        zip_code = zip_code.strip().zfill(5)
+        latitude, longitude = float(latitude), float(longitude)
+        if len(zip_code) != 5 or not zip_code.isdigit():
+            continue
+        if latitude == 0 and longitude == 0:
+            continue
+        RECORD.pack_into(data, HEADER.size + RECORD.size * int(zip_code),
+                         latitude, longitude)
+        written.add(zip_code)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+    return len(written)
+
+
+def read_csv_rows(path):
+    """
+    Yield (zip_code, latitude, longitude) from a CSV file with `zip_code`,
+    `latitude` and `longitude` columns.
+    """
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f):
+            yield row['zip_code'], row['latitude'], row['longitude']
@@ -0,0 +1,69 @@
+"""
+Grid-cell spatial index and great-circle distances.
+
+The globe is divided into CELL_SIZE x CELL_SIZE degree cells, each with an
+integer key. Rows with coordinates store the key of their cell in an indexed
+column, so "everything within r miles of a point" becomes an indexed
+`grid_cell IN (...)` lookup over the handful of cells covering the circle,
+followed by an exact distance check on just those candidates.
+"""
+import math
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LATITUDE = 69.05
+
+# 0.25 degrees is ~17 miles north-south, so a 25 mile search touches ~20
+# cells.
+CELL_SIZE = 0.25
+NUM_ROWS = int(180 / CELL_SIZE)
+NUM_COLUMNS = int(360 / CELL_SIZE)
+
+
+def _row(latitude):
+    return min(int(math.floor((latitude + 90) / CELL_SIZE)), NUM_ROWS - 1)
+
+
+def _column(longitude):
+    return int(math.floor((longitude + 180) / CELL_SIZE)) % NUM_COLUMNS
+
+
+def cell_for(latitude, longitude):
+    """Return the grid cell key of a point, or None without coordinates."""
+    if latitude is None or longitude is None:
+        return None
+    return _row(latitude) * NUM_COLUMNS + _column(longitude)
+
+
+def bounding_box(latitude, longitude, radius_miles):
+    """
+    Return (south, west, north, east) of a box that contains every point
+    within radius_miles of (latitude, longitude).
+    """
+    dlat = radius_miles / MILES_PER_DEGREE_LATITUDE
+    cos_lat = math.cos(math.radians(min(abs(latitude) + dlat, 89.9)))
+    dlon = min(radius_miles / (MILES_PER_DEGREE_LATITUDE * cos_lat), 180)
+    return (max(latitude - dlat, -90), longitude - dlon,
+            min(latitude + dlat, 90), longitude + dlon)
+
+
+def cells_within(latitude, longitude, radius_miles):
+    """Return the keys of every cell within radius_miles of a point."""
+    south, west, north, east = bounding_box(latitude, longitude,
+                                            radius_miles)
+    columns = set()
+    longitude = west
+    while longitude < east + CELL_SIZE:
+        columns.add(_column(min(longitude, east)))
+        longitude += CELL_SIZE
+    return [row * NUM_COLUMNS + column
+            for row in range(_row(south), _row(north) + 1)
+            for column in columns]
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    """Return the great-circle distance in miles between two points."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (latitude1, longitude1,
+                                                latitude2, longitude2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
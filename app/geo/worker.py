@@ -0,0 +1,124 @@
+"""
+Background geocoding for rows that were stored without final coordinates.
+
+When GEOCODER_ASYNC is enabled, ZIPCode.create_zip_code inserts ZIP codes
+that are missing from the gazetteer with pending (NULL) coordinates and hands
+their ids to a per-process worker thread, so the request that created them
+never waits on the remote geocoder. New addresses are queued the same way to
+replace their ZIP centroid with street-level coordinates. Rows become visible
+on the maps once they have coordinates.
+
+A row whose lookup raises (the geocoder timed out, say) is queued again
+after GEOCODER_RETRY_DELAY seconds, doubled with each attempt, up to
+GEOCODER_MAX_ATTEMPTS times in all. After that it is left pending for
+`manage.py geocode_backfill`.
+
+With JOB_QUEUE_ENABLED, the rows are geocoded by durable jobs (see app.jobs)
+instead of this thread.
+"""
+import threading
+from Queue import Queue
+
+from flask import current_app
+
+
+class GeocodingWorker(object):
+    def __init__(self, app, max_attempts=3, retry_delay=10):
+        self.app = app
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run,
+                                       name='geocoding-worker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enqueue(self, model, id):
+        """
+        Queue the row of model (ZIPCode or Address) with the given id for
+        geocoding.
+        """
+        self.queue.put((model, id, 1))
+
+    def join(self):
+        """
+        Block until every queued row has been processed, including the
+        retries of failed ones.
+        """
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            model, id, attempt = self.queue.get()
+            try:
+                with self.app.app_context():
+                    row = model.query.get(id)
+                    if row is not None and row.is_pending():
+                        row.geocode()
+            except Exception:
+                self.app.logger.exception(
+                    'Geocoding %s id %s failed (attempt %d of %d)',
+                    model.__name__, id, attempt, self.max_attempts)
+                if attempt < self.max_attempts:
+                    self._retry(model, id, attempt)
+                    continue
+            self.queue.task_done()
+
+    def _retry(self, model, id, attempt):
+        """
+        Queue the row again after a delay. Its current task stays
+        unfinished until then, so join keeps waiting for it.
+        """
+        def requeue():
+            self.queue.put((model, id, attempt + 1))
+            self.queue.task_done()
+
+        timer = threading.Timer(self.retry_delay * 2 ** (attempt - 1),
+                                requeue)
+        timer.daemon = True
+        timer.start()
+
+
+_worker_lock = threading.Lock()
+
+
+def get_worker(app=None):
+    """Return the geocoding worker for app, starting it on first use."""
+    app = app or current_app._get_current_object()
+    with _worker_lock:
+        worker = app.extensions.get('geocoding_worker')
+        if worker is None or not worker.thread.is_alive():
+            worker = GeocodingWorker(
+                app,
+                max_attempts=app.config['GEOCODER_MAX_ATTEMPTS'],
+                retry_delay=app.config['GEOCODER_RETRY_DELAY'])
+            app.extensions['geocoding_worker'] = worker
+    return worker
+
+
+def _enqueue_job(task_name, id):
+    from .. import db
+    from ..jobs import enqueue
+
+    enqueue(task_name, id)
+    db.session.commit()
+
+
+def enqueue_zip_code(zip_code_id):
+    """Resolve the ZIPCode with the given id in the background."""
+    from ..models import ZIPCode
+
+    if current_app.config['JOB_QUEUE_ENABLED']:
+        _enqueue_job('geocode_zip_code', zip_code_id)
+    else:
+        get_worker().enqueue(ZIPCode, zip_code_id)
+
+
+def enqueue_address(address_id):
+    """Geocode the street address of the Address with the given id."""
+    from ..models import Address
+
+    if current_app.config['JOB_QUEUE_ENABLED']:
+        _enqueue_job('geocode_address', address_id)
+    else:
+        get_worker().enqueue(Address, address_id)
@@ -0,0 +1,263 @@
+"""
+Bulk invitation of members from a CSV file.
+
+The file is read one batch of INVITE_BATCH_SIZE rows at a time. Each batch
+is checked against the users table with a single query on the email index
+and inserted with one bulk insert. Listed users who were invited before but
+have not joined yet are invited again.
+
+The invitations don't go through the email pool that confirmation and
+password reset emails share. Each batch of them is handed to a per-process
+sender thread, or with JOB_QUEUE_ENABLED saved as a send_invitations job
+(see app.jobs), and sent over its own SMTP connection at no more than
+INVITE_RATE_LIMIT per second, so the upload returns straight away.
+"""
+import csv
+import re
+import smtplib
+import socket
+import threading
+from Queue import Queue
+
+from flask import current_app, request
+from sqlalchemy.orm import lazyload
+from . import db, mail
+from .email import make_message
+from .geo.batch import RateLimiter
+from .jobs import enqueue
+from .models import User
+
+# Columns a CSV file of invitations must have, in any order.
+COLUMNS = ('first_name', 'last_name', 'email')
+# Same check as wtforms' Email validator, used by the invite form.
+EMAIL_RE = re.compile(r'^.+@([^.@][^@]+)$')
+
+
+class InviteFileError(Exception):
+    pass
+
+
+def read_rows(csvfile):
+    """
+    Yield (line number, row) for each row of an open CSV file, where row is
+    a dict of COLUMNS to unicode values. Raises InviteFileError if the file
+    has no header row naming COLUMNS.
+    """
+    reader = csv.reader(csvfile)
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise InviteFileError('The file is empty.')
+    if header:
+        header[0] = header[0].decode('utf-8-sig')
+    header = [column.strip().lower() for column in header]
+    missing = [column for column in COLUMNS if column not in header]
+    if missing:
+        raise InviteFileError('The file has no {} column.'.format(
+            ', '.join(missing)))
+    indexes = [header.index(column) for column in COLUMNS]
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        values = [row[i] if i < len(row) else '' for i in indexes]
+        try:
+            values = [value.decode('utf-8').strip() for value in values]
+        except UnicodeDecodeError:
+            yield reader.line_num, None
+            continue
+        yield reader.line_num, dict(zip(COLUMNS, values))
+
+
+def check_row(row):
+    """Return why row can't be invited, or None if it can."""
+    if row is None:
+        return 'Not UTF-8 text.'
+    for column in COLUMNS:
+        if not row[column]:
+            return 'No {}.'.format(column.replace('_', ' '))
+        if len(row[column]) > 64:
+            return 'The {} is longer than 64 characters.'.format(
+                column.replace('_', ' '))
+    if not EMAIL_RE.match(row['email']):
+        return 'Invalid email address.'
+    return None
+
+
+def invite_users(csvfile, role, batch_size=None, progress=None):
+    """
+    Invite the members listed in csvfile with the given role, and invite
+    again those who were invited before but have not joined. The emails are
+    sent in the background, with links to the site of the current request.
+    After each batch, progress (if given) is called with the report so far:
+    a dict of the number of rows read, of users invited and of invitations
+    resent, and a list of (line number, email, error) for each row that
+    wasn't invited.
+    """
+    batch_size = batch_size or current_app.config['INVITE_BATCH_SIZE']
+    report = {'rows': 0, 'invited': 0, 'resent': 0, 'errors': []}
+    seen = set()
+    batch = []
+    reported = 0
+    for line, row in read_rows(csvfile):
+        report['rows'] += 1
+        error = check_row(row)
+        if error is None and row['email'] in seen:
+            error = 'Listed more than once.'
+        if error is not None:
+            report['errors'].append((line, row and row['email'], error))
+            continue
+        seen.add(row['email'])
+        batch.append((line, row))
+        if len(batch) == batch_size:
+            _invite_batch(batch, role, report)
+            batch = []
+            if progress is not None:
+                progress(report)
+                reported = report['rows']
+    if batch:
+        _invite_batch(batch, role, report)
+    report['errors'].sort()
+    if progress is not None and report['rows'] != reported:
+        progress(report)
+    return report
+
+
+def _invite_batch(batch, role, report):
+    emails = [row['email'] for line, row in batch]
+    registered = dict((email, (id, password_hash, confirmed))
+                      for id, email, password_hash, confirmed in
+                      db.session.query(User.id, User.email,
+                                       User.password_hash, User.confirmed)
+                      .filter(User.email.in_(emails)))
+    invitations = []
+    mappings = []
+    for line, row in batch:
+        if row['email'] not in registered:
+            mappings.append(dict(row, role_id=role.id))
+            continue
+        id, password_hash, confirmed = registered[row['email']]
+        if password_hash is None and not confirmed:
+            # Invited before, but hasn't joined.
+            invitations.append(id)
+            report['resent'] += 1
+        else:
+            report['errors'].append((line, row['email'],
+                                     'Email already registered.'))
+    if mappings:
+        db.session.bulk_insert_mappings(User, mappings)
+        db.session.commit()
+        report['invited'] += len(mappings)
+
+        index = current_app.extensions.get('name_index')
+        for id, first_name, last_name in \
+                db.session.query(User.id, User.first_name, User.last_name)\
+                .filter(User.email.in_([row['email'] for row in mappings])):
+            invitations.append(id)
+            # Bulk inserts bypass the session events that keep the name
+            # index up to date.
+            if index is not None:
+                index.set(id, first_name, last_name)
+    if invitations:
+        queue_invitations(invitations)
+
+
+def queue_invitations(user_ids):
+    """
+    Have invitations sent in the background to the users with the given
+    ids, with links to the site of the current request.
+    """
+    base_url = request.url_root
+    if current_app.config['JOB_QUEUE_ENABLED']:
+        enqueue('send_invitations', user_ids, base_url)
+        db.session.commit()
+    else:
+        get_invitation_sender().enqueue(user_ids, base_url)
+
+
+def _rate_limiter(app):
+    with _sender_lock:
+        limiter = app.extensions.get('invite_rate_limiter')
+        if limiter is None:
+            limiter = RateLimiter(app.config['INVITE_RATE_LIMIT'])
+            app.extensions['invite_rate_limiter'] = limiter
+    return limiter
+
+
+def send_invitations(user_ids, base_url):
+    """
+    Email an invitation to each of the users with the given ids who has not
+    joined yet, with links to base_url. Returns the number sent. Errors
+    sending one invitation are logged; a failed SMTP connection is raised.
+    """
+    app = current_app._get_current_object()
+    rate_limiter = _rate_limiter(app)
+    sent = 0
+    with app.test_request_context(base_url=base_url):
+        users = User.query.options(lazyload(User.user_links))\
+            .filter(User.id.in_(user_ids), User.password_hash.is_(None))\
+            .order_by(User.id).all()
+        with mail.connect() as connection:
+            for user in users:
+                if user.confirmed:
+                    continue
+                msg = make_message(user.email,
+                                   'You Are Invited To Join',
+                                   'account/email/invite',
+                                   user=user,
+                                   user_id=user.id,
+                                   token=user.generate_confirmation_token())
+                rate_limiter.acquire()
+                try:
+                    connection.send(msg)
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    # The job is retried, or the sender thread logs it.
+                    raise
+                except Exception:
+                    app.logger.exception('Sending an invitation to %s '
+                                         'failed', user.email)
+                else:
+                    sent += 1
+    return sent
+
+
+class InvitationSender(object):
+    def __init__(self, app):
+        """Send invitations for app from a background thread."""
+        self.app = app
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run,
+                                       name='invitation-sender')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enqueue(self, user_ids, base_url):
+        self.queue.put((user_ids, base_url))
+
+    def join(self):
+        """Block until every queued invitation has been sent or failed."""
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            user_ids, base_url = self.queue.get()
+            try:
+                with self.app.app_context():
+                    send_invitations(user_ids, base_url)
+            except Exception:
+                self.app.logger.exception('Sending invitations failed')
+            finally:
+                self.queue.task_done()
+
+
+_sender_lock = threading.Lock()
+
+
+def get_invitation_sender(app=None):
+    """Return the InvitationSender of app, starting it on first use."""
+    app = app or current_app._get_current_object()
+    with _sender_lock:
+        sender = app.extensions.get('invitation_sender')
+        if sender is None or not sender.thread.is_alive():
+            sender = InvitationSender(app)
+            app.extensions['invitation_sender'] = sender
+    return sender
@@ -0,0 +1,231 @@
+"""
+Durable background jobs.
+
+Slow work is saved as a Job row by enqueue, in the same transaction as the
+change that called for it, and run by `manage.py worker` processes. Any
+number of workers can share the jobs table: a worker claims a job with a
+conditional UPDATE, so no broker is needed. A claimed job is hidden from
+other workers for its task's timeout (JOB_VISIBILITY_TIMEOUT by default);
+if its worker dies, the job becomes visible again and is retried. Failed
+jobs are retried after JOB_RETRY_DELAY seconds, doubling with each attempt,
+until they have been tried max_attempts times.
+
+Workers also enqueue the maintenance tasks in JOB_SCHEDULE, a dict of task
+names to intervals in seconds. The unique key of a scheduled job keeps the
+workers from queueing it more than once at a time.
+
+Tasks are functions registered with the task decorator, see app.tasks.
+"""
+import json
+import os
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, or_, func
+from sqlalchemy.exc import IntegrityError
+from . import db
+from .models import Job
+
+# Task name -> Task.
+TASKS = {}
+# Seconds between checks of a worker for scheduled tasks that are due.
+SCHEDULE_CHECK_INTERVAL = 60
+
+
+class Task(object):
+    def __init__(self, function, name, max_attempts=None, timeout=None):
+        """
+        A function that can be run as a job. max_attempts and timeout
+        default to JOB_MAX_ATTEMPTS and JOB_VISIBILITY_TIMEOUT.
+        """
+        self.function = function
+        self.name = name
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+    def __call__(self, *args):
+        return self.function(*args)
+
+
+def task(name=None, max_attempts=None, timeout=None):
+    """Register the decorated function as a task."""
+    def register(function):
+        registered = Task(function, name or function.__name__,
+                          max_attempts=max_attempts, timeout=timeout)
+        TASKS[registered.name] = registered
+        return registered
+    return register
+
+
+def enqueue(task_name, *args, **options):
+    """
+    Add a job running task_name with args (which must be JSON serializable)
+    to the session, to be saved when it is committed. Options:
+
+    delay: seconds to wait before running the job.
+    max_attempts: times to try the job, JOB_MAX_ATTEMPTS by default.
+    unique_key: if given, the job is not queued while another queued or
+        running job has the same key.
+
+    Returns the Job, or None if it was not queued because of its unique key.
+    """
+    registered = TASKS.get(task_name)
+    max_attempts = options.get('max_attempts') or \
+        (registered and registered.max_attempts) or \
+        current_app.config['JOB_MAX_ATTEMPTS']
+    run_at = datetime.utcnow() + timedelta(seconds=options.get('delay', 0))
+    job = Job(task=task_name, args=json.dumps(args), run_at=run_at,
+              max_attempts=max_attempts,
+              unique_key=options.get('unique_key'))
+    if job.unique_key is not None and \
+            Job.query.filter_by(unique_key=job.unique_key).first():
+        return None
+    db.session.add(job)
+    return job
+
+
+def _retry_delay(attempts):
+    return current_app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1)
+
+
+class Worker(object):
+    def __init__(self, app, poll_interval=None, schedule=None):
+        """
+        Run jobs for app, checking for new ones every poll_interval seconds
+        when idle, and enqueueing the tasks in schedule (JOB_SCHEDULE by
+        default) at their intervals.
+        """
+        self.app = app
+        self.poll_interval = app.config['JOB_POLL_INTERVAL'] \
+            if poll_interval is None else poll_interval
+        self.schedule = app.config['JOB_SCHEDULE'] \
+            if schedule is None else schedule
+        self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.stopped = False
+        self._next_schedule = 0
+
+    def stop(self, *args):
+        """Stop once the job being run is finished."""
+        self.stopped = True
+
+    def run(self, burst=False):
+        """
+        Run jobs until stopped, or until none are ready if burst is True.
+        Returns the number of jobs run.
+        """
+        count = 0
+        with self.app.app_context():
+            while not self.stopped:
+                if time.time() >= self._next_schedule:
+                    self.enqueue_scheduled()
+                    self._next_schedule = time.time() + \
+                        SCHEDULE_CHECK_INTERVAL
+                if self.run_one():
+                    count += 1
+                elif burst:
+                    break
+                else:
+                    time.sleep(self.poll_interval)
+        return count
+
+    def enqueue_scheduled(self):
+        """Queue the scheduled tasks that are due and not queued already."""
+        for task_name, interval in self.schedule.items():
+            last = db.session.query(func.max(Job.finished_at))\
+                .filter(Job.task == task_name, Job.status == Job.DONE)\
+                .scalar()
+            delay = 0
+            if last is not None:
+                due = last + timedelta(seconds=interval)
+                delay = max(0, (due - datetime.utcnow()).total_seconds())
+            enqueue(task_name, delay=delay,
+                    unique_key='schedule:%s' % task_name)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another worker queued it first.
+                db.session.rollback()
+
+    def claim(self):
+        """Claim the next job that is ready to run, and return it."""
+        now = datetime.utcnow()
+        ready = or_(and_(Job.status == Job.QUEUED, Job.run_at <= now),
+                    and_(Job.status == Job.RUNNING, Job.locked_until < now))
+        # Another worker may claim the same job between the SELECT and the
+        # UPDATE, in which case the UPDATE matches no rows; try the next.
+        for attempt in range(5):
+            job = Job.query.filter(ready).order_by(Job.run_at).first()
+            if job is None:
+                db.session.commit()
+                return None
+            timeout = self.timeout(job)
+            claimed = Job.query.filter(Job.id == job.id, ready).update({
+                'status': Job.RUNNING,
+                'locked_by': self.name,
+                'locked_until': now + timedelta(seconds=timeout),
+                'attempts': Job.attempts + 1
+            }, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return Job.query.get(job.id)
+        return None
+
+    def timeout(self, job):
+        task = TASKS.get(job.task)
+        return (task and task.timeout) or \
+            self.app.config['JOB_VISIBILITY_TIMEOUT']
+
+    def run_one(self):
+        """Claim and run one job. Returns False if none was ready."""
+        job = self.claim()
+        if job is None:
+            return False
+        task = TASKS.get(job.task)
+        if job.attempts > job.max_attempts:
+            # It timed out on its last attempt.
+            self._finish(job, Job.FAILED, 'Timed out.')
+        elif task is None:
+            self._finish(job, Job.FAILED, 'No task named %s.' % job.task)
+        else:
+            try:
+                task(*job.get_args())
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                error = traceback.format_exc()
+                self.app.logger.exception('Job %s (%s) failed', job.id,
+                                          job.task)
+                if job.attempts < job.max_attempts:
+                    job.status = Job.QUEUED
+                    job.run_at = datetime.utcnow() + timedelta(
+                        seconds=_retry_delay(job.attempts))
+                    job.locked_until = job.locked_by = None
+                    job.last_error = error
+                    db.session.commit()
+                else:
+                    self._finish(job, Job.FAILED, error)
+            else:
+                self._finish(job, Job.DONE)
+        return True
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.finished_at = datetime.utcnow()
+        job.locked_until = job.locked_by = job.unique_key = None
+        if error is not None:
+            job.last_error = error
+        db.session.commit()
+
+
+def retry(job):
+    """Queue a failed job to run again right away."""
+    job.status = Job.QUEUED
+    job.run_at = datetime.utcnow()
+    job.attempts = 0
+    job.finished_at = None
+
+
+from . import tasks  # noqa, registers the app's tasks
@@ -1,8 +1,14 @@
+from flask import current_app
 from flask import render_template
 from flask import Response
+from flask import request
 from . import main
 import json
-from ..models import User
+from .. import db
+from ..autocomplete import get_name_index
+from ..geo.clustering import cluster_page, parse_bbox, within_bbox
+from ..models import ZIPCode, ZIPCodeCount
+from ..search import search_users
 from flask.ext.login import login_required
 
 
@@ -14,19 +20,70 @@ def index():
 @main.route('/users')
 @login_required
 def user_map():
-    return render_template('main/map.html', users=User.query.all())
+    """
+    Map of members. The markers are fetched from user_map_data as the map
+    is panned and zoomed.
+    """
+    return render_template('main/map.html')
+
+
+@main.route('/users/map-data')
+@login_required
+def user_map_data():
+    """
+    Member counts per ZIP code within the `bbox` (south,west,north,east),
+    clustered for the map `zoom` level, one `page` of clusters at a time.
+    """
+    bbox = parse_bbox(request.args.get('bbox'))
+    zoom = request.args.get('zoom', type=int)
+    page = request.args.get('page', 1, type=int)
+    # Users whose ZIP code is still being geocoded are left off the map.
+    points = db.session.query(ZIPCode.latitude,
+                              ZIPCode.longitude,
+                              ZIPCodeCount.user_count,
+                              ZIPCode.zip_code)\
+        .join(ZIPCodeCount)\
+        .filter(ZIPCodeCount.user_count > 0,
+                ZIPCode.latitude.isnot(None))
+    if bbox is not None:
+        points = points.filter(within_bbox(ZIPCode.latitude,
+                                           ZIPCode.longitude, bbox))
+    data = cluster_page(points, zoom, page)
+    return Response(response=json.dumps(data), status=200,
+                    mimetype='application/json')
 
 
 @main.route('/search/<query>')
 @login_required
 def search_query(query):
-    looking_for = '%'+query+'%'
-    users = User.query.filter((User.first_name.ilike(looking_for)) |
-                              User.last_name.ilike(looking_for))\
-        .order_by(User.first_name).all()
+    """
+    Members whose names match query, best match first, one `page` at a
+    time.
+    """
+    page = request.args.get('page', 1, type=int)
+    users, has_next = search_users(
+        query, page, current_app.config['SEARCH_RESULTS_PER_PAGE'])
     data = dict()
     data['results'] = [{'title': u.full_name(),
                         'url': '/account/profile/' + str(u.id)} for u in users]
+    data['next_page'] = page + 1 if has_next else None
+    json_data = json.dumps(data)
+    return Response(response=json_data, status=200,
+                    mimetype='application/json')
+
+
+@main.route('/autocomplete/<query>')
+@login_required
+def autocomplete(query):
+    """
+    Members whose names complete query, from the in-memory name index.
+    """
+    completions = get_name_index().complete(
+        query, current_app.config['AUTOCOMPLETE_RESULTS'])
+    data = dict()
+    data['results'] = [{'title': name,
+                        'url': '/account/profile/' + str(user_id)}
+                       for user_id, name in completions]
     json_data = json.dumps(data)
     return Response(response=json_data, status=200,
                     mimetype='application/json')
@@ -7,3 +7,4 @@ from user import *  # noqa
 from location import *  # noqa
 from resource import *  # noqa
 from attribute import *  # noqa
+from job import *  # noqa
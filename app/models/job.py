@@ -0,0 +1,42 @@
+import json
+from datetime import datetime
+from .. import db
+
+
+class Job(db.Model):
+    """
+    A call of a task (see app.jobs) waiting to be run, running, or finished.
+    """
+    __tablename__ = 'jobs'
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [QUEUED, RUNNING, DONE, FAILED]
+
+    id = db.Column(db.Integer, primary_key=True)
+    task = db.Column(db.String(64), nullable=False, index=True)
+    # JSON list of the task's arguments.
+    args = db.Column(db.Text, nullable=False, default='[]')
+    status = db.Column(db.String(16), nullable=False, default=QUEUED)
+    # Not run before run_at. A running job whose locked_until has passed is
+    # assumed to have died with its worker and is run again.
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(64))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    # Only one queued or running job may have a given key.
+    unique_key = db.Column(db.String(128), unique=True)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, index=True)
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (db.Index('ix_jobs_status_run_at', 'status', 'run_at'),)
+
+    def get_args(self):
+        return json.loads(self.args)
+
+    def __repr__(self):
+        return '<Job %s %s \'%s\'>' % (self.id, self.task, self.status)
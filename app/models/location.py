@@ -1,5 +1,15 @@
+from collections import defaultdict
+from itertools import chain
+from flask import current_app
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.exc import IntegrityError
 from .. import db
-from geopy.geocoders import Nominatim
+from ..geo import geocode_zip_code, geocode_remote
+from ..geo.distance import get_zip_code_index
+from ..geo.gazetteer import get_gazetteer
+from ..geo.spatial import cell_for
+from ..geo.worker import enqueue_zip_code, enqueue_address
 
 
 class ZIPCode(db.Model):
@@ -8,21 +18,82 @@ class ZIPCode(db.Model):
     zip_code = db.Column(db.String(5), unique=True, index=True)
     users = db.relationship('User', backref='zip_code', lazy='dynamic')
     addresses = db.relationship('Address', backref='zip_code', lazy='dynamic')
+    counts = db.relationship('ZIPCodeCount', uselist=False,
+                             cascade='all, delete-orphan')
     longitude = db.Column(db.Float)
-    latitude = db.Column(db.Float)
+    # Indexed for the map's bounding box queries.
+    latitude = db.Column(db.Float, index=True)
+    # Set when the remote geocoder could not locate a deferred ZIP code.
+    unresolvable = db.Column(db.Boolean, nullable=False, default=False)
 
-    def __init__(self, zip_code):
+    def __init__(self, zip_code, defer=False):
         """
         If possible, the helper methods get_by_zip_code and create_zip_code
         should be used instead of explicitly using this constructor.
+
+        If defer is True, a ZIP code that is not in the gazetteer is created
+        with pending (None) coordinates instead of waiting on the remote
+        geocoder; call geocode later to fill them in. It must still look
+        like a real ZIP code to the gazetteer, or ValueError is raised.
         """
-        getcoords = Nominatim(country_bias='us')
-        loc = getcoords.geocode(zip_code)
-        if loc is None:
-            raise ValueError('zip code \'%s\' is invalid' % zip_code)
-        self.longitude = loc.longitude
-        self.latitude = loc.latitude
         self.zip_code = zip_code
+        coordinates = geocode_zip_code(zip_code, remote=not defer)
+        if coordinates is not None:
+            self.latitude, self.longitude = coordinates
+        elif not defer or not get_gazetteer().is_plausible(zip_code):
+            raise ValueError('zip code \'%s\' is invalid' % zip_code)
+
+    def is_pending(self):
+        """True if this ZIP code is still waiting for its coordinates."""
+        return not self.unresolvable and \
+            (self.latitude is None or self.longitude is None)
+
+    def is_located(self):
+        """True if this ZIP code has coordinates."""
+        return self.latitude is not None and self.longitude is not None
+
+    def geocode(self):
+        """
+        Look up and store the coordinates of a pending ZIP code. Returns True
+        if the ZIP code could be located; if not, it is marked unresolvable.
+        """
+        coordinates = geocode_zip_code(self.zip_code)
+        if coordinates is None:
+            self.unresolvable = True
+            db.session.commit()
+            return False
+        self.set_coordinates(*coordinates)
+        db.session.commit()
+        return True
+
+    def set_coordinates(self, latitude, longitude):
+        """
+        Set the coordinates of this ZIP code, and use them as the fallback
+        location of its addresses that have none yet.
+        """
+        self.latitude = latitude
+        self.longitude = longitude
+        db.session.add(self)
+        if self.id is not None:
+            Address.query.filter(Address.zip_code_id == self.id,
+                                 Address.latitude.is_(None))\
+                .update(Address.location_values(latitude, longitude),
+                        synchronize_session=False)
+
+    @staticmethod
+    def within(latitude, longitude, radius_miles, limit=None):
+        """
+        Return (ZIPCode id, distance in miles) pairs for ZIP codes within
+        radius_miles of (latitude, longitude), nearest first. This reads the
+        in-memory distance index rather than the database.
+        """
+        return get_zip_code_index().within(latitude, longitude,
+                                           radius_miles, limit)
+
+    @staticmethod
+    def nearest(latitude, longitude, k=1):
+        """Return (ZIPCode id, distance) pairs for the k nearest ZIP codes."""
+        return get_zip_code_index().nearest(latitude, longitude, k)
 
     @staticmethod
     def get_by_zip_code(zip_code):
@@ -35,12 +106,40 @@ class ZIPCode(db.Model):
         """
         Helper to create a ZIPCode entry. Returns the newly created ZIPCode
         or the existing entry if zip_code is already in the table.
+
+        With GEOCODER_ASYNC enabled, a ZIP code that needs the remote
+        geocoder is returned immediately with pending coordinates and
+        resolved by the background geocoding worker. Raises ValueError for
+        a ZIP code that can't be located, including one the worker has
+        marked unresolvable.
+
+        Concurrent calls for the same new ZIP code share one geocoder lookup
+        (see app.geo), and if another request or worker inserts the ZIP
+        code first, its row is returned instead.
         """
         result = ZIPCode.get_by_zip_code(zip_code)
+        if result is not None and result.unresolvable:
+            raise ValueError('zip code \'%s\' is invalid' % zip_code)
         if result is None:
-            result = ZIPCode(zip_code)
-            db.session.add(result)
-            db.session.commit()
+            config = current_app.config
+            defer = config['GEOCODER_ASYNC'] and \
+                config['GEOCODER_REMOTE_FALLBACK']
+            result = ZIPCode(zip_code, defer=defer)
+            try:
+                # Insert in a savepoint, so losing the race rolls back only
+                # this row and not the rest of the caller's session.
+                with db.session.begin_nested():
+                    db.session.add(result)
+            except IntegrityError:
+                # Another request or worker inserted the ZIP code first;
+                # any other integrity error is re-raised.
+                result = ZIPCode.get_by_zip_code(zip_code)
+                if result is None:
+                    raise
+            else:
+                db.session.commit()
+                if result.is_pending():
+                    enqueue_zip_code(result.id)
         return result
 
     @staticmethod
@@ -63,12 +162,23 @@ class ZIPCode(db.Model):
 class Address(db.Model):
     __tablename__ = 'addresses'
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.Text)         # ABC MOVERS
+    # Indexed to find existing addresses when importing resources.
+    name = db.Column(db.Text, index=True)  # ABC MOVERS
     street_address = db.Column(db.Text)  # 1500 E MAIN AVE STE 201
     city = db.Column(db.Text)
     state = db.Column(db.String(2))
     zip_code_id = db.Column(db.Integer, db.ForeignKey('zip_codes.id'))
     resources = db.relationship('Resource', backref='address', lazy='dynamic')
+    # Street-level coordinates if is_geocoded, otherwise the centroid of the
+    # address's ZIP code until the geocoder has located it. The latitude is
+    # indexed for the map's bounding box queries.
+    latitude = db.Column(db.Float, index=True)
+    longitude = db.Column(db.Float)
+    is_geocoded = db.Column(db.Boolean, default=False)
+    # Set when the geocoder could not locate the address.
+    unresolvable = db.Column(db.Boolean, nullable=False, default=False)
+    # Spatial index key of (latitude, longitude), see app.geo.spatial.
+    grid_cell = db.Column(db.Integer, index=True)
 
     def __init__(self, name, street_address, city, state):
         """
@@ -80,6 +190,66 @@ class Address(db.Model):
         self.city = city
         self.state = state
 
+    def geocoder_query(self):
+        """Return the one-line form of this address sent to the geocoder."""
+        parts = [self.street_address, self.city, self.state]
+        if self.zip_code is not None:
+            parts.append(self.zip_code.zip_code)
+        return ', '.join(part.strip() for part in parts if part)
+
+    def is_pending(self):
+        """True if this address is still waiting for street-level
+        coordinates."""
+        return not self.is_geocoded and not self.unresolvable
+
+    def geocode(self):
+        """
+        Look up and store the street-level coordinates of this address.
+        Returns True if the address could be located; if not, it is marked
+        unresolvable.
+        """
+        coordinates = geocode_remote(self.geocoder_query())
+        if coordinates is None:
+            self.unresolvable = True
+            db.session.commit()
+            return False
+        self.set_coordinates(*coordinates)
+        db.session.commit()
+        return True
+
+    @staticmethod
+    def location_values(latitude, longitude):
+        """
+        Return the column values that place an address at (latitude,
+        longitude), for use with Query.update.
+        """
+        return {
+            'latitude': latitude,
+            'longitude': longitude,
+            'grid_cell': cell_for(latitude, longitude)
+        }
+
+    def set_location(self, latitude, longitude):
+        for name, value in Address.location_values(latitude,
+                                                   longitude).items():
+            setattr(self, name, value)
+        db.session.add(self)
+
+    def set_coordinates(self, latitude, longitude):
+        """Store street-level coordinates for this address."""
+        self.set_location(latitude, longitude)
+        self.is_geocoded = True
+
+    def set_zip_code(self, zip_code):
+        """
+        Set the ZIPCode of this address. Until the address is geocoded, its
+        coordinates fall back to the centroid of zip_code.
+        """
+        self.zip_code = zip_code
+        if not self.is_geocoded:
+            self.set_location(zip_code.latitude, zip_code.longitude)
+        db.session.add(self)
+
     @staticmethod
     def get_by_address(name, street_address, city, state):
         """Helper for searching by all address fields."""
@@ -90,10 +260,14 @@ class Address(db.Model):
         return result
 
     @staticmethod
-    def create_address(name, street_address, city, state):
+    def create_address(name, street_address, city, state, zip_code=None):
         """
         Helper to create an Address entry. Returns the newly created Address
         or the existing entry if all address fields are already in the table.
+
+        A new address starts out at the centroid of zip_code and, if
+        GEOCODER_ADDRESSES is enabled, is geocoded to street level in the
+        background.
         """
         result = Address.get_by_address(name,
                                         street_address,
@@ -104,8 +278,15 @@ class Address(db.Model):
                              street_address=street_address,
                              city=city,
                              state=state)
+            if zip_code is not None:
+                result.set_zip_code(zip_code)
             db.session.add(result)
             db.session.commit()
+            if current_app.config['GEOCODER_ADDRESSES']:
+                enqueue_address(result.id)
+        elif zip_code is not None and result.zip_code is None:
+            result.set_zip_code(zip_code)
+            db.session.commit()
         return result
 
     @staticmethod
@@ -169,15 +350,236 @@ class Address(db.Model):
             }
         ]
         for address in addresses:
-            a = Address.create_address(
+            Address.create_address(
                 name=fake.name(),
                 street_address=address['street_address'],
                 city=address['city'],
-                state=address['state']
+                state=address['state'],
+                zip_code=ZIPCode.create_zip_code(address['zip_code'])
             )
-            a.zip_code = ZIPCode.create_zip_code(address['zip_code'])
-            db.session.add(a)
-            db.session.commit()
 
     def __repr__(self):
         return '<Address \'%s\'>' % self.name
+
+
+class ZIPCodeCount(db.Model):
+    """
+    Number of users and resources in each ZIP code, kept up to date as they
+    are added, removed or moved between ZIP codes, so that aggregates read
+    one row per ZIP code instead of every user. The counts can be rebuilt
+    from scratch with rebuild.
+
+    Each ZIP code's row is inserted along with the ZIP code, so the counts
+    are only ever updated in place and concurrent flushes can't both insert
+    it.
+    """
+    __tablename__ = 'zip_code_counts'
+    zip_code_id = db.Column(db.Integer, db.ForeignKey('zip_codes.id'),
+                            primary_key=True)
+    user_count = db.Column(db.Integer, nullable=False, default=0)
+    resource_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def within(latitude, longitude, radius_miles):
+        """
+        Return the total (user count, resource count) of the ZIP codes
+        within radius_miles of (latitude, longitude).
+        """
+        ids = [zip_code_id for zip_code_id, distance in
+               ZIPCode.within(latitude, longitude, radius_miles)]
+        if not ids:
+            return 0, 0
+        users, resources = db.session.query(
+            func.sum(ZIPCodeCount.user_count),
+            func.sum(ZIPCodeCount.resource_count))\
+            .filter(ZIPCodeCount.zip_code_id.in_(ids)).one()
+        return users or 0, resources or 0
+
+    @staticmethod
+    def rebuild():
+        """
+        Recount the users and resources in every ZIP code, creating the
+        missing rows. Returns the number of ZIP codes with any.
+        """
+        from . import User, Resource
+
+        counts = defaultdict(dict)
+        users = db.session.query(User.zip_code_id, func.count(User.id))\
+            .filter(User.zip_code_id.isnot(None))\
+            .group_by(User.zip_code_id)
+        for zip_code_id, count in users:
+            counts[zip_code_id]['user_count'] = count
+        resources = db.session.query(Address.zip_code_id,
+                                     func.count(Resource.id))\
+            .join(Resource)\
+            .filter(Address.zip_code_id.isnot(None))\
+            .group_by(Address.zip_code_id)
+        for zip_code_id, count in resources:
+            counts[zip_code_id]['resource_count'] = count
+
+        ZIPCodeCount.query.delete()
+        rows = [{
+            'zip_code_id': zip_code_id,
+            'user_count': counts.get(zip_code_id, {}).get('user_count', 0),
+            'resource_count': counts.get(zip_code_id, {})
+            .get('resource_count', 0)
+        } for zip_code_id, in db.session.query(ZIPCode.id)]
+        if rows:
+            db.session.execute(ZIPCodeCount.__table__.insert(), rows)
+        db.session.commit()
+        return len(counts)
+
+    @staticmethod
+    def add(deltas, session=None):
+        """
+        Add to the counts of ZIP codes, given as a dict of ZIP code ids to
+        dicts of 'user_count' and 'resource_count' increments.
+        """
+        session = session or db.session
+        table = ZIPCodeCount.__table__
+        for zip_code_id, delta in deltas.items():
+            delta = dict((column, value) for column, value in delta.items()
+                         if value)
+            if not delta:
+                continue
+            update = table.update()\
+                .where(table.c.zip_code_id == zip_code_id)\
+                .values(dict((column, table.c[column] + value)
+                             for column, value in delta.items()))
+            if session.execute(update).rowcount:
+                continue
+            # Only ZIP codes saved before their rows were created with them
+            # have none, until rebuild runs. Insert an empty row, ignoring
+            # one inserted meanwhile by another flush, and update it.
+            insert = table.insert().values(zip_code_id=zip_code_id,
+                                           user_count=0, resource_count=0)
+            connection = session.connection()
+            try:
+                with connection.begin_nested():
+                    connection.execute(insert)
+            except IntegrityError:
+                pass
+            session.execute(update)
+
+    def __repr__(self):
+        return '<ZIPCodeCount %s: %s users, %s resources>' % \
+            (self.zip_code_id, self.user_count, self.resource_count)
+
+
+@event.listens_for(ZIPCode, 'after_insert')
+def _create_zip_code_count(mapper, connection, target):
+    connection.execute(ZIPCodeCount.__table__.insert().values(
+        zip_code_id=target.id))
+
+
+# ZIPCodeCount is kept up to date by comparing the ZIP code of each user,
+# resource and address changed in a flush before the flush (read from the
+# database) with its ZIP code after the flush.
+
+def _has_changes(obj, *attributes):
+    attrs = inspect(obj).attrs
+    return any(attrs[name].history.has_changes() for name in attributes)
+
+
+def _scalar(session, query):
+    return session.execute(query).scalar()
+
+
+def _user_zip_code_id(session, user_id):
+    from . import User
+    table = User.__table__
+    return _scalar(session, select([table.c.zip_code_id])
+                   .where(table.c.id == user_id))
+
+
+def _resource_zip_code_id(session, resource_id):
+    from . import Resource
+    resources = Resource.__table__
+    addresses = Address.__table__
+    return _scalar(session, select([addresses.c.zip_code_id])
+                   .select_from(resources.join(addresses))
+                   .where(resources.c.id == resource_id))
+
+
+def _address_zip_code_id(session, address_id):
+    if address_id is None:
+        return None
+    table = Address.__table__
+    return _scalar(session, select([table.c.zip_code_id])
+                   .where(table.c.id == address_id))
+
+
+@event.listens_for(SignallingSession, 'before_flush')
+def _record_zip_code_changes(session, flush_context, instances):
+    from . import User, Resource
+
+    # (count column, object, ZIP code id before the flush, weight, removed)
+    changes = []
+    moved_resources = set()
+    addresses = []
+    for obj in chain(session.new, session.dirty, session.deleted):
+        is_new = obj in session.new
+        removed = obj in session.deleted
+        if isinstance(obj, User):
+            if is_new or removed or \
+                    _has_changes(obj, 'zip_code', 'zip_code_id'):
+                old = None if is_new else \
+                    _user_zip_code_id(session, obj.id)
+                changes.append(('user_count', obj, old, 1, removed))
+        elif isinstance(obj, Resource):
+            if is_new or removed or \
+                    _has_changes(obj, 'address', 'address_id'):
+                old = None if is_new else \
+                    _resource_zip_code_id(session, obj.id)
+                changes.append(('resource_count', obj, old, 1, removed))
+                if not is_new:
+                    moved_resources.add(obj.id)
+        elif isinstance(obj, Address) and not is_new and not removed and \
+                _has_changes(obj, 'zip_code', 'zip_code_id'):
+            addresses.append(obj)
+
+    # Resources that stay at an address that moves to another ZIP code
+    # move with it.
+    resources = Resource.__table__
+    for address in addresses:
+        query = select([func.count(resources.c.id)])\
+            .where(resources.c.address_id == address.id)
+        if moved_resources:
+            query = query.where(~resources.c.id.in_(moved_resources))
+        count = _scalar(session, query)
+        if count:
+            old = _address_zip_code_id(session, address.id)
+            changes.append(('resource_count', address, old, count, False))
+
+    if changes:
+        session.info.setdefault('zip_code_changes', []).extend(changes)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _update_zip_code_counts(session, flush_context):
+    from . import User, Resource
+
+    changes = session.info.pop('zip_code_changes', None)
+    if not changes:
+        return
+    deltas = defaultdict(lambda: defaultdict(int))
+    for column, obj, old, weight, removed in changes:
+        if removed:
+            new = None
+        elif isinstance(obj, Resource):
+            new = _address_zip_code_id(session, obj.address_id)
+        elif isinstance(obj, (User, Address)):
+            new = obj.zip_code_id
+        if old == new:
+            continue
+        if old is not None:
+            deltas[old][column] -= weight
+        if new is not None:
+            deltas[new][column] += weight
+
+    ZIPCodeCount.add(deltas, session)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _discard_zip_code_changes(session):
+    session.info.pop('zip_code_changes', None)
@@ -1,5 +1,9 @@
 from .. import db
 from random import randint
+from sqlalchemy import case, cast, event, func, inspect
+from sqlalchemy.orm import load_only
+from ..geo.distance import rank_by_distance
+from ..geo.spatial import cells_within
 from . import Address
 
 
@@ -9,12 +13,33 @@ class Resource(db.Model):
     name = db.Column(db.String(64))
     description = db.Column(db.Text)
     website = db.Column(db.Text)
-    address_id = db.Column(db.Integer, db.ForeignKey('addresses.id'))
+    address_id = db.Column(db.Integer, db.ForeignKey('addresses.id'),
+                           index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     reviews = db.relationship('ResourceReview', backref='resource',
                               lazy='dynamic')
     closed_resource_details = db.relationship('ClosedResourceDetail',
                                               backref='resource')
+    # Aggregates of the resource's reviews and closed reports, kept up to
+    # date by update_review_counts and add_closed_report so that they can
+    # be listed and sorted without reading the reviews.
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    # Number of reviews with each rating, 1 to 5.
+    rating_1_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_2_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_3_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_4_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_5_count = db.Column(db.Integer, nullable=False, default=0)
+    # None until the resource has a review.
+    average_rating = db.Column(db.Float, index=True)
+    closed_report_count = db.Column(db.Integer, nullable=False, default=0)
+    # Log of the time-decayed review activity, see app.trending. None until
+    # a review is counted. trending_stale is set when a review of the
+    # resource is added, changed or deleted, until the score is recomputed.
+    trending_score = db.Column(db.Float, index=True)
+    trending_stale = db.Column(db.Boolean, nullable=False, default=False,
+                               index=True)
 
     def __init__(self, name, description, website):
         self.name = name
@@ -46,6 +71,128 @@ class Resource(db.Model):
             db.session.commit()
         return result
 
+    @staticmethod
+    def near(latitude, longitude, radius_miles, limit=50):
+        """
+        Return up to limit resources within radius_miles of (latitude,
+        longitude), nearest first, as (distance in miles, row) pairs. Each
+        row is a named tuple of the resource's id, name, description,
+        average_rating and review_count, and the street_address, city,
+        state, latitude and longitude of its address.
+        """
+        # Rank the candidates from the covering grid cells by the
+        # coordinates of their addresses (street level once geocoded), then
+        # load the details of the nearest ones.
+        candidates = db.session.query(Resource.id,
+                                      Address.latitude,
+                                      Address.longitude)\
+            .join(Address)\
+            .filter(Address.grid_cell.in_(cells_within(latitude, longitude,
+                                                       radius_miles)))
+        distances = dict(rank_by_distance(latitude, longitude,
+                                          candidates.all(),
+                                          radius_miles, limit))
+        if not distances:
+            return []
+
+        rows = db.session.query(Resource.id,
+                                Resource.name,
+                                Resource.description,
+                                Resource.average_rating,
+                                Resource.review_count,
+                                Address.street_address,
+                                Address.city,
+                                Address.state,
+                                Address.latitude,
+                                Address.longitude)\
+            .join(Address)\
+            .filter(Resource.id.in_(distances.keys()))
+        results = [(distances[row.id], row) for row in rows]
+        results.sort(key=lambda result: result[0])
+        return results
+
+    def rating_histogram(self):
+        """Return the number of reviews with each rating, 1 to 5."""
+        return [getattr(self, _rating_column(rating))
+                for rating in RATINGS]
+
+    @staticmethod
+    def update_review_counts(resource_id, added=None, removed=None):
+        """
+        Update the review aggregates of a resource for a review with rating
+        added, one with rating removed, or both for a review whose rating
+        was changed. The counts are changed in the database in one UPDATE, so
+        concurrent reviews are not lost.
+        """
+        count = (added is not None) - (removed is not None)
+        total = (added or 0) - (removed or 0)
+        values = {
+            'review_count': Resource.review_count + count,
+            'rating_sum': Resource.rating_sum + total,
+            # All SET expressions read the row as it was before the UPDATE.
+            'average_rating': case(
+                [(Resource.review_count + count > 0,
+                  cast(Resource.rating_sum + total, db.Float) /
+                  (Resource.review_count + count))],
+                else_=None)
+        }
+        for rating, change in [(added, 1), (removed, -1)]:
+            if rating is not None:
+                column = getattr(Resource, _rating_column(rating))
+                values[column.key] = values.get(column.key, column) + change
+        Resource.query.filter_by(id=resource_id)\
+            .update(values, synchronize_session=False)
+
+    @staticmethod
+    def add_closed_report(resource_id):
+        """Count a new closed report for a resource."""
+        Resource.query.filter_by(id=resource_id).update(
+            {'closed_report_count': Resource.closed_report_count + 1},
+            synchronize_session=False)
+
+    @staticmethod
+    def reconcile_counts():
+        """
+        Recompute the review and closed report aggregates of every resource
+        from its reviews and closed reports, and fix those that have
+        drifted. Returns the number of resources fixed.
+        """
+        expected = {}
+        ratings = db.session.query(ResourceReview.resource_id,
+                                   ResourceReview.rating,
+                                   func.count(ResourceReview.id))\
+            .filter(ResourceReview.resource_id.isnot(None),
+                    ResourceReview.rating.in_(RATINGS))\
+            .group_by(ResourceReview.resource_id, ResourceReview.rating)
+        for resource_id, rating, count in ratings:
+            values = expected.setdefault(resource_id, _empty_counts())
+            values[_rating_column(rating)] = count
+            values['review_count'] += count
+            values['rating_sum'] += rating * count
+        closed = db.session.query(ClosedResourceDetail.resource_id,
+                                  func.count(ClosedResourceDetail.id))\
+            .filter(ClosedResourceDetail.resource_id.isnot(None))\
+            .group_by(ClosedResourceDetail.resource_id)
+        for resource_id, count in closed:
+            expected.setdefault(resource_id, _empty_counts())[
+                'closed_report_count'] = count
+        for values in expected.values():
+            if values['review_count']:
+                values['average_rating'] = \
+                    float(values['rating_sum']) / values['review_count']
+
+        fixed = 0
+        columns = _empty_counts().keys()
+        for resource in Resource.query.options(load_only('id', *columns)):
+            values = expected.get(resource.id, _empty_counts())
+            if any(not _same_count(getattr(resource, column), value)
+                   for column, value in values.items()):
+                Resource.query.filter_by(id=resource.id)\
+                    .update(values, synchronize_session=False)
+                fixed += 1
+        db.session.commit()
+        return fixed
+
     @staticmethod
     def generate_fake():
         # TODO: make sure fake resources have users
@@ -72,6 +219,28 @@ class Resource(db.Model):
         return '<Resource \'%s\'>' % self.name
 
 
+RATINGS = [1, 2, 3, 4, 5]
+
+
+def _rating_column(rating):
+    return 'rating_%d_count' % rating
+
+
+def _empty_counts():
+    """Return the review aggregates of a resource with no reviews."""
+    values = dict((_rating_column(rating), 0) for rating in RATINGS)
+    values.update(review_count=0, rating_sum=0, average_rating=None,
+                  closed_report_count=0)
+    return values
+
+
+def _same_count(stored, expected):
+    if stored is None or expected is None:
+        return stored is expected
+    # Averages computed by the database may differ in the last bits.
+    return abs(stored - expected) < 1e-9
+
+
 class ResourceReview(db.Model):
     __tablename__ = 'resource_reviews'
     id = db.Column(db.Integer, primary_key=True)
@@ -80,14 +249,31 @@ class ResourceReview(db.Model):
     rating = db.Column(db.Integer)  # 1 to 5
     count_likes = db.Column(db.Integer, default=0)
     count_dislikes = db.Column(db.Integer, default=0)
-    resource_id = db.Column(db.Integer, db.ForeignKey('resources.id'))
+    # Keeps the old resource when it changes, to update its trending score.
+    resource_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('resources.id')),
+        active_history=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # Serves the pages of a resource's reviews, newest first.
+    __table_args__ = (db.Index('ix_resource_reviews_resource_id_id',
+                               'resource_id', 'id'),)
 
     def __init__(self, timestamp, content, rating):
         self.timestamp = timestamp
         self.content = content
         self.rating = rating
 
+    def vote_counts(self):
+        """
+        Return the (likes, dislikes) of this review, including votes that
+        have not been written to the database yet.
+        """
+        from ..counters import get_vote_counter
+
+        pending = get_vote_counter().pending(self.id)
+        return ((self.count_likes or 0) + pending['count_likes'],
+                (self.count_dislikes or 0) + pending['count_dislikes'])
+
     @staticmethod
     def generate_fake(count=10):
         """Generate count fake Reviews for testing."""
@@ -112,6 +298,31 @@ class ResourceReview(db.Model):
                (self.resource_id, self.content)
 
 
+def _mark_trending_stale(connection, resource_ids):
+    resource_ids = [id for id in resource_ids if id is not None]
+    if resource_ids:
+        table = Resource.__table__
+        connection.execute(table.update()
+                           .where(table.c.id.in_(resource_ids))
+                           .values(trending_stale=True))
+
+
+@event.listens_for(ResourceReview, 'after_insert')
+@event.listens_for(ResourceReview, 'after_delete')
+def _review_added_or_deleted(mapper, connection, target):
+    _mark_trending_stale(connection, [target.resource_id])
+
+
+@event.listens_for(ResourceReview, 'after_update')
+def _review_updated(mapper, connection, target):
+    attrs = inspect(target).attrs
+    if any(attrs[name].history.has_changes()
+           for name in ('resource_id', 'rating', 'timestamp')):
+        _mark_trending_stale(connection,
+                             [target.resource_id] +
+                             list(attrs.resource_id.history.deleted))
+
+
 class ClosedResourceDetail(db.Model):
     __tablename__ = 'closed_resource_details'
     id = db.Column(db.Integer, primary_key=True)
@@ -129,6 +340,7 @@ class ClosedResourceDetail(db.Model):
 
         if resource_id:
             result.resource_id = resource_id
+            Resource.add_closed_report(resource_id)
         if user_id:
             result.user_id = user_id
         db.session.add(result)
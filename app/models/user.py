@@ -1,8 +1,11 @@
+from datetime import datetime
 from flask import current_app
 from flask.ext.login import UserMixin, AnonymousUserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, \
     BadSignature, SignatureExpired
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy import event
 from .. import db, login_manager
 
 
@@ -102,6 +105,10 @@ class User(UserMixin, db.Model):
     birthday = db.Column(db.Date, index=True)
     closed_resource_details = db.relationship('ClosedResourceDetail',
                                               backref='user')
+    # When the user was added and last changed, for incremental exports.
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow, index=True)
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
@@ -285,3 +292,15 @@ login_manager.anonymous_user = AnonymousUser
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
+
+
+@event.listens_for(SignallingSession, 'before_flush')
+def _touch_changed_users(session, flush_context, instances):
+    """
+    Bump updated_at of changed users, including those whose only change is
+    to their tags, which would not update their row.
+    """
+    now = datetime.utcnow()
+    for user in session.dirty:
+        if isinstance(user, User) and session.is_modified(user):
+            user.updated_at = now
@@ -0,0 +1,121 @@
+"""
+Keyset (seek) pagination.
+
+Instead of skipping OFFSET rows, each page continues from the sort key of
+the last row of the previous page, so any page costs the same as the first
+when the sort columns are indexed. The sort columns must end with a unique
+column, such as the primary key, so that every row has a distinct key.
+Nullable sort columns put their NULLs last in ascending order and first in
+descending order, on every database.
+
+Pages are addressed by opaque cursors, which encode a row's sort key.
+"""
+import base64
+import json
+from sqlalchemy import and_, false, or_
+
+
+class KeysetPage(object):
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        """
+        One page of items. next_cursor and prev_cursor address the following
+        and preceding pages, and are None if there are none.
+        """
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor, length):
+    """
+    Return the list of length values encoded in cursor, or None if cursor is
+    missing or malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    return values
+
+
+def _nullable(column):
+    return getattr(getattr(column, 'expression', column), 'nullable', False)
+
+
+def _order(column, reverse):
+    """Sort by column, with NULLs last unless reverse is True."""
+    order = column.desc() if reverse else column.asc()
+    if _nullable(column):
+        order = order.nullsfirst() if reverse else order.nullslast()
+    return order
+
+
+def _after(columns, values, descending):
+    """
+    Filter for rows whose key comes after values in the sort order, i.e.
+    (a, b, c) > (x, y, z) written out as a > x OR (a = x AND (b > y OR ...)).
+    NULLs come after every other value unless descending is True.
+    """
+    column, value = columns[0], values[0]
+    if value is None:
+        after = column.isnot(None) if descending else false()
+        equal = column.is_(None)
+    else:
+        after = column < value if descending else column > value
+        if _nullable(column) and not descending:
+            after = or_(after, column.is_(None))
+        equal = column == value
+    if len(columns) == 1:
+        return after
+    return or_(after, and_(equal,
+                           _after(columns[1:], values[1:], descending)))
+
+
+def keyset_paginate(query, columns, per_page, after=None, before=None,
+                    descending=False):
+    """
+    Return the KeysetPage of query, sorted by columns, that starts after the
+    cursor after or ends before the cursor before (the first page if neither
+    is given).
+    """
+    after = decode_cursor(after, len(columns))
+    before = decode_cursor(before, len(columns)) if after is None else None
+    backwards = before is not None
+    # A page before a cursor is read in reverse order, then flipped.
+    reverse = descending != backwards
+    if after is not None:
+        query = query.filter(_after(columns, after, descending))
+    elif backwards:
+        query = query.filter(_after(columns, before, not descending))
+    query = query.order_by(*[_order(column, reverse) for column in columns])
+    items = query.limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    def key(item):
+        return encode_cursor([getattr(item, column.key)
+                              for column in columns])
+
+    page = KeysetPage(items)
+    if items:
+        if more or backwards:
+            page.next_cursor = key(items[-1])
+        if (more and backwards) or after is not None:
+            page.prev_cursor = key(items[0])
+    return page
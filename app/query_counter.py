@@ -0,0 +1,122 @@
+"""
+Counting of SQL queries per request.
+
+Every statement the db engine runs while a counter is active is counted and
+timed. With QUERY_COUNTER_ENABLED, each request gets a counter, and when it
+ends the totals are logged along with any statement run at least
+QUERY_REPEAT_THRESHOLD times, which usually means a relationship is being
+lazy-loaded once per row of a list (an N+1 query).
+
+Tests can hold a block of code to a query budget with max_queries.
+"""
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryStats(object):
+    """Number, duration and statements of the queries run in a block."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        """
+        Return (statement, count) pairs for the statements run at least
+        threshold times, most repeated first.
+        """
+        return [(statement, count) for statement, count
+                in self.statements.most_common() if count >= threshold]
+
+
+def _active_stats():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def count_queries():
+    """Count the queries run in the current thread within the block."""
+    stats = QueryStats()
+    stack = _active_stats()
+    stack.append(stats)
+    try:
+        yield stats
+    finally:
+        stack.remove(stats)
+
+
+@contextmanager
+def max_queries(limit):
+    """
+    Raise QueryBudgetExceeded if the block runs more than limit queries.
+    """
+    with count_queries() as stats:
+        yield stats
+    if stats.count > limit:
+        raise QueryBudgetExceeded(
+            '%d queries run, expected at most %d:\n%s' % (
+                stats.count, limit,
+                '\n'.join('%d x %s' % (count, statement) for statement, count
+                          in stats.statements.most_common())))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if _active_stats():
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    stack = _active_stats()
+    start_times = conn.info.get('query_start_time')
+    if not stack or not start_times:
+        return
+    duration = time.time() - start_times.pop()
+    for stats in stack:
+        stats.record(statement, duration)
+
+
+def init_query_counter(app):
+    """Count the queries of each request to app (called from __init__.py)."""
+    if not app.config['QUERY_COUNTER_ENABLED']:
+        return
+
+    @app.before_request
+    def start_counting():
+        _local.request_stats = QueryStats()
+        _active_stats().append(_local.request_stats)
+
+    @app.teardown_request
+    def stop_counting(exception=None):
+        stats = getattr(_local, 'request_stats', None)
+        if stats is None:
+            return
+        del _local.request_stats
+        _active_stats().remove(stats)
+        app.logger.debug('%s %s: %d queries in %.1f ms', request.method,
+                         request.path, stats.count, stats.duration * 1000)
+        threshold = app.config['QUERY_REPEAT_THRESHOLD']
+        for statement, count in stats.repeated(threshold):
+            app.logger.warning('Likely N+1 query in %s %s, run %d times: %s',
+                               request.method, request.path, count,
+                               statement)
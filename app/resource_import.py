@@ -0,0 +1,291 @@
+"""
+Bulk import of resources from CSV or JSON lines directories.
+
+Rows are read as a stream and handled IMPORT_BATCH_SIZE at a time. For each
+batch, the ZIP codes and existing addresses are looked up with one query
+each, missing ZIP codes are located in the gazetteer, and the new ZIP codes,
+addresses and resources are written with bulk inserts. A resource with the
+same name and address as an existing one, or as an earlier row, is reported
+as a duplicate instead of being imported.
+
+New addresses are placed at the centroid of their ZIP code, like those
+added through the site. They are not geocoded one by one; run
+`manage.py geocode_backfill` afterwards to locate them at street level,
+along with any ZIP codes that had to be left pending for the remote
+geocoder.
+"""
+import csv
+import json
+import re
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import and_
+from . import db
+from .geo import geocode_zip_code
+from .geo.gazetteer import get_gazetteer
+from .geo.spatial import cell_for
+from .models import Address, Resource, ZIPCode, ZIPCodeCount
+
+FORMATS = ('csv', 'jsonl')
+FIELDS = ('name', 'description', 'website', 'street_address', 'city',
+          'state', 'zip_code')
+REQUIRED_FIELDS = ('name', 'zip_code')
+ZIP_CODE_RE = re.compile(r'^(\d{3,5})(-\d{4})?$')
+
+
+class ImportFileError(Exception):
+    pass
+
+
+def _clean(row):
+    """
+    Return a dict of FIELDS to stripped unicode values (None if empty) from
+    a dict read from a file.
+    """
+    values = {}
+    for field in FIELDS:
+        value = row.get(field)
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        elif value is not None and not isinstance(value, unicode):
+            value = unicode(value)
+        if value is not None:
+            value = value.strip() or None
+        values[field] = value
+    return values
+
+
+def read_csv(f):
+    """
+    Yield (line number, row) for each row of a CSV file with a header row,
+    where row is a dict of FIELDS, or None if it is not UTF-8.
+    """
+    reader = csv.reader(f)
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise ImportFileError('The file is empty.')
+    if header:
+        header[0] = header[0].decode('utf-8-sig')
+    header = [column.strip().lower() for column in header]
+    missing = [field for field in REQUIRED_FIELDS if field not in header]
+    if missing:
+        raise ImportFileError('The file has no {} column.'.format(
+            ', '.join(missing)))
+    for cells in reader:
+        if not any(cell.strip() for cell in cells):
+            continue
+        try:
+            yield reader.line_num, _clean(dict(zip(header, cells)))
+        except UnicodeDecodeError:
+            yield reader.line_num, None
+
+
+def read_jsonl(f):
+    """
+    Yield (line number, row) for each line of a file of JSON objects, one
+    per line, where row is a dict of FIELDS, or None if the line is not a
+    JSON object.
+    """
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, _clean(row) if isinstance(row, dict) else None
+
+
+def check_row(row):
+    """
+    Return why row can't be imported, or None if it can. Normalizes its ZIP
+    code to 5 digits.
+    """
+    if row is None:
+        return 'Not a UTF-8 row or JSON object.'
+    for field in REQUIRED_FIELDS:
+        if not row[field]:
+            return 'No {}.'.format(field.replace('_', ' '))
+    if len(row['name']) > 64:
+        return 'The name is longer than 64 characters.'
+    match = ZIP_CODE_RE.match(row['zip_code'])
+    if match is None:
+        return 'Invalid ZIP code {}.'.format(row['zip_code'])
+    # Spreadsheets drop the leading zeros of ZIP codes.
+    row['zip_code'] = match.group(1).zfill(5)
+    if row['state'] is not None:
+        if len(row['state']) != 2:
+            return 'The state must be a 2 letter code.'
+        row['state'] = row['state'].upper()
+    return None
+
+
+def _address_key(name, street_address, city, state):
+    return (name, street_address, city, state)
+
+
+def import_resources(f, format='csv', user=None, batch_size=None,
+                     progress=None):
+    """
+    Import the resources listed in the open file f, in format 'csv' or
+    'jsonl', added by user if given. After each batch, progress (if given)
+    is called with the report so far: a dict of the number of rows read,
+    resources imported and addresses added, and lists of (line number,
+    name, message) for each row that was a duplicate or had an error.
+    """
+    batch_size = batch_size or current_app.config['IMPORT_BATCH_SIZE']
+    rows = read_csv(f) if format == 'csv' else read_jsonl(f)
+    report = {'rows': 0, 'imported': 0, 'addresses': 0, 'duplicates': [],
+              'errors': []}
+    seen = set()
+    batch = []
+    reported = 0
+    for line, row in rows:
+        report['rows'] += 1
+        error = check_row(row)
+        if error is not None:
+            report['errors'].append((line, row and row['name'], error))
+            continue
+        key = _address_key(row['name'], row['street_address'], row['city'],
+                           row['state'])
+        if key in seen:
+            report['duplicates'].append((line, row['name'],
+                                         'Listed more than once.'))
+            continue
+        seen.add(key)
+        batch.append((line, key, row))
+        if len(batch) == batch_size:
+            _import_batch(batch, user, report)
+            batch = []
+            if progress is not None:
+                progress(report)
+                reported = report['rows']
+    if batch:
+        _import_batch(batch, user, report)
+    report['duplicates'].sort()
+    report['errors'].sort()
+    if progress is not None and report['rows'] != reported:
+        progress(report)
+    return report
+
+
+def _zip_codes(codes):
+    """
+    Return a dict of the given ZIP codes to their (id, latitude, longitude),
+    adding those that are not in the table yet. ZIP codes that can't be
+    located are left out.
+    """
+    found = dict((zip_code, (id, latitude, longitude))
+                 for id, zip_code, latitude, longitude in
+                 db.session.query(ZIPCode.id, ZIPCode.zip_code,
+                                  ZIPCode.latitude, ZIPCode.longitude)
+                 .filter(ZIPCode.zip_code.in_(codes)))
+    remote = current_app.config['GEOCODER_REMOTE_FALLBACK']
+    new = []
+    for zip_code in codes:
+        if zip_code in found:
+            continue
+        coordinates = geocode_zip_code(zip_code, remote=False)
+        if coordinates is not None:
+            new.append({'zip_code': zip_code, 'latitude': coordinates[0],
+                        'longitude': coordinates[1]})
+        elif remote and get_gazetteer().is_plausible(zip_code):
+            # Left pending for the remote geocoder, see the module docstring.
+            new.append({'zip_code': zip_code, 'latitude': None,
+                        'longitude': None})
+    if new:
+        db.session.execute(ZIPCode.__table__.insert(), new)
+        added = dict(
+            (zip_code, (id, latitude, longitude))
+            for id, zip_code, latitude, longitude in
+            db.session.query(ZIPCode.id, ZIPCode.zip_code, ZIPCode.latitude,
+                             ZIPCode.longitude)
+            .filter(ZIPCode.zip_code.in_([row['zip_code'] for row in new])))
+        # Like ZIPCode's after_insert event, which bulk inserts skip.
+        db.session.execute(ZIPCodeCount.__table__.insert(), [
+            {'zip_code_id': id, 'user_count': 0, 'resource_count': 0}
+            for id, latitude, longitude in added.values()])
+        found.update(added)
+    return found
+
+
+def _import_batch(batch, user, report):
+    zip_codes = _zip_codes(set(row['zip_code'] for line, key, row in batch))
+
+    # Existing addresses with the batch's names, and whether they already
+    # have a resource with the same name.
+    addresses = {}
+    for id, name, street_address, city, state, resource_id in \
+            db.session.query(Address.id, Address.name,
+                             Address.street_address, Address.city,
+                             Address.state, Resource.id)\
+            .outerjoin(Resource, and_(Resource.address_id == Address.id,
+                                      Resource.name == Address.name))\
+            .filter(Address.name.in_(set(row['name']
+                                         for line, key, row in batch))):
+        key = _address_key(name, street_address, city, state)
+        if addresses.get(key, (None, None))[1] is None:
+            addresses[key] = (id, resource_id)
+
+    accepted = []
+    new_addresses = []
+    for line, key, row in batch:
+        if row['zip_code'] not in zip_codes:
+            report['errors'].append((line, row['name'],
+                                     'ZIP code {} could not be found.'
+                                     .format(row['zip_code'])))
+            continue
+        address_id, resource_id = addresses.get(key, (None, None))
+        if resource_id is not None:
+            report['duplicates'].append((line, row['name'],
+                                         'Already listed as resource {}.'
+                                         .format(resource_id)))
+            continue
+        accepted.append((key, row))
+        if address_id is None:
+            zip_code_id, latitude, longitude = zip_codes[row['zip_code']]
+            new_addresses.append({
+                'name': row['name'],
+                'street_address': row['street_address'],
+                'city': row['city'],
+                'state': row['state'],
+                'zip_code_id': zip_code_id,
+                'latitude': latitude,
+                'longitude': longitude,
+                'grid_cell': cell_for(latitude, longitude),
+                'is_geocoded': False,
+                'unresolvable': False
+            })
+    if not accepted:
+        return
+
+    if new_addresses:
+        db.session.bulk_insert_mappings(Address, new_addresses)
+        names = set(address['name'] for address in new_addresses)
+        for id, name, street_address, city, state in \
+                db.session.query(Address.id, Address.name,
+                                 Address.street_address, Address.city,
+                                 Address.state)\
+                .filter(Address.name.in_(names)).order_by(Address.id):
+            key = _address_key(name, street_address, city, state)
+            if key not in addresses:
+                addresses[key] = (id, None)
+
+    db.session.bulk_insert_mappings(Resource, [{
+        'name': row['name'],
+        'description': row['description'],
+        'website': row['website'],
+        'address_id': addresses[address_key][0],
+        'user_id': user.id if user is not None else None
+    } for address_key, row in accepted])
+
+    # Bulk inserts skip the session events that keep these counts.
+    deltas = defaultdict(lambda: defaultdict(int))
+    for key, row in accepted:
+        deltas[zip_codes[row['zip_code']][0]]['resource_count'] += 1
+    ZIPCodeCount.add(deltas)
+    db.session.commit()
+    report['imported'] += len(accepted)
+    report['addresses'] += len(new_addresses)
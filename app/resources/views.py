@@ -1,18 +1,114 @@
-from flask import render_template, redirect, url_for, flash
+import json
+from flask import render_template, redirect, url_for, flash, request, \
+    Response, current_app
 from flask.ext.login import login_required, current_user
+from sqlalchemy import literal
+from sqlalchemy.orm import defaultload, joinedload, load_only
 from . import resources
 from .. import db
+from ..counters import get_vote_counter
+from ..pagination import keyset_paginate
+from ..trending import trending_resources
+from ..geo.clustering import cluster_page, parse_bbox, within_bbox
 from ..models import Resource, ZIPCode, Address, ResourceReview,\
     ClosedResourceDetail
 from .forms import ResourceForm, ReviewForm, ClosedResourceDetailForm
 from datetime import datetime
 
+DEFAULT_NEAR_RADIUS = 25
+MAX_NEAR_RADIUS = 100
+NEAR_RADIUS_CHOICES = [5, 10, 25, 50, 100]
+NEAR_RESULTS_LIMIT = 100
+
+
+def get_resource_or_404(resource_id):
+    """
+    Load a resource along with the address and author shown on its page.
+    """
+    return Resource.query.options(
+        joinedload(Resource.address).load_only('street_address'),
+        joinedload(Resource.user).load_only('first_name', 'last_name'),
+        defaultload(Resource.user).lazyload('user_links'))\
+        .filter_by(id=resource_id).first_or_404()
+
+
+def get_reviews(resource_id, after=None, before=None):
+    """
+    Load a page of the reviews of a resource with their authors, newest
+    first, continuing after or before a cursor of the previous page.
+    """
+    reviews = ResourceReview.query.options(
+        joinedload(ResourceReview.user).load_only('first_name', 'last_name'),
+        defaultload(ResourceReview.user).lazyload('user_links'))\
+        .filter_by(resource_id=resource_id)
+    return keyset_paginate(reviews, [ResourceReview.id],
+                           current_app.config['REVIEWS_PER_PAGE'],
+                           after=after, before=before, descending=True)
+
 
 @resources.route('/')
 @login_required
 def index():
-    return render_template('resources/index.html',
-                           resources=Resource.query.all())
+    trending = trending_resources(current_app.config['TRENDING_RESOURCES'])
+    return render_template('resources/index.html', trending=trending)
+
+
+@resources.route('/map-data')
+@login_required
+def map_data():
+    """
+    Resource markers within the `bbox` (south,west,north,east), clustered
+    for the map `zoom` level, one `page` of clusters at a time.
+    """
+    bbox = parse_bbox(request.args.get('bbox'))
+    zoom = request.args.get('zoom', type=int)
+    page = request.args.get('page', 1, type=int)
+    # Markers are read straight from the addresses table; resources whose
+    # address has no coordinates yet are left off the map.
+    points = db.session.query(Address.latitude, Address.longitude,
+                              literal(1), Resource.name, Resource.id)\
+        .join(Resource).filter(Address.latitude.isnot(None))
+    if bbox is not None:
+        points = points.filter(within_bbox(Address.latitude,
+                                           Address.longitude, bbox))
+    data = cluster_page(points, zoom, page)
+    return Response(response=json.dumps(data), status=200,
+                    mimetype='application/json')
+
+
+@resources.route('/near')
+@login_required
+def near():
+    """
+    List resources within `radius` miles of the current user's ZIP code,
+    nearest first. Responds with JSON if `format=json` is given.
+    """
+    radius = request.args.get('radius', DEFAULT_NEAR_RADIUS, type=float)
+    radius = min(max(radius, 0), MAX_NEAR_RADIUS)
+    zip_code = current_user.zip_code
+    results = []
+    if zip_code is not None and zip_code.is_located():
+        results = Resource.near(zip_code.latitude, zip_code.longitude,
+                                radius, limit=NEAR_RESULTS_LIMIT)
+
+    if request.args.get('format') == 'json':
+        data = dict()
+        data['radius'] = radius
+        data['results'] = [{
+            'id': row.id,
+            'name': row.name,
+            'distance': round(distance, 1),
+            'average_rating': row.average_rating,
+            'review_count': row.review_count,
+            'latitude': row.latitude,
+            'longitude': row.longitude,
+            'url': url_for('resources.read_resource', resource_id=row.id)
+        } for distance, row in results]
+        return Response(response=json.dumps(data), status=200,
+                        mimetype='application/json')
+    return render_template('resources/near.html', results=results,
+                           radius=radius, zip_code=zip_code,
+                           radii=NEAR_RADIUS_CHOICES)
 
 
 @resources.route('/create', methods=['GET', 'POST'])
@@ -25,12 +121,18 @@ def create_resource():
         street_address = str(form.street_number.data) + ' ' + form.route.data
         city = form.locality.data
         state = form.administrative_area_level_1.data
-        zip_code = ZIPCode.create_zip_code(form.postal_code.data)
+        try:
+            zip_code = ZIPCode.create_zip_code(form.postal_code.data)
+        except ValueError:
+            flash('ZIP code {} could not be found.'
+                  .format(form.postal_code.data), 'form-error')
+            return render_template('resources/create_resource.html',
+                                   form=form)
         address = Address.create_address(name,
                                          street_address,
                                          city,
-                                         state)
-        address.zip_code = zip_code
+                                         state,
+                                         zip_code=zip_code)
         description = form.description.data
         website = form.website.data
         resource = Resource.create_resource(name,
@@ -61,7 +163,7 @@ def close_resource(resource_id):
 
     return render_template('resources/read_resource.html',
                            resource=resource,
-                           reviews=resource.reviews,
+                           reviews=get_reviews(resource_id),
                            current_user_id=current_user.id,
                            closed_form=closed_form,
                            closed_details=closed_details,
@@ -71,13 +173,15 @@ def close_resource(resource_id):
 @resources.route('/read/<int:resource_id>')
 @login_required
 def read_resource(resource_id):
-    resource = Resource.query.get_or_404(resource_id)
+    resource = get_resource_or_404(resource_id)
     closed_details = ClosedResourceDetail.query.filter_by(
         resource_id=resource_id).all()
     closed_form = ClosedResourceDetailForm()
     return render_template('resources/read_resource.html',
                            resource=resource,
-                           reviews=resource.reviews,
+                           reviews=get_reviews(resource_id,
+                                               request.args.get('after'),
+                                               request.args.get('before')),
                            current_user_id=current_user.id,
                            closed_form=closed_form,
                            closed_details=closed_details)
@@ -86,7 +190,7 @@ def read_resource(resource_id):
 @resources.route('/review/create/<int:resource_id>', methods=['GET', 'POST'])
 @login_required
 def create_review(resource_id):
-    resource = Resource.query.get_or_404(resource_id)
+    resource = get_resource_or_404(resource_id)
     form = ReviewForm()
     if form.validate_on_submit():
         review = ResourceReview(timestamp=datetime.now(),
@@ -95,6 +199,7 @@ def create_review(resource_id):
         review.resource = resource
         review.user = current_user._get_current_object()
         db.session.add(review)
+        Resource.update_review_counts(resource.id, added=review.rating)
         db.session.commit()
         return redirect(url_for('resources.read_resource',
                                 resource_id=resource.id))
@@ -103,7 +208,7 @@ def create_review(resource_id):
     closed_form = ClosedResourceDetailForm()
     return render_template('resources/create_review.html',
                            resource=resource,
-                           reviews=resource.reviews,
+                           reviews=get_reviews(resource_id),
                            current_user_id=current_user.id,
                            form=form,
                            closed_form=closed_form,
@@ -121,6 +226,9 @@ def update_review(review_id):
                                 resource_id=resource.id))
     form = ReviewForm()
     if form.validate_on_submit():
+        Resource.update_review_counts(resource.id,
+                                      added=form.rating.data,
+                                      removed=review.rating)
         review.timestamp = datetime.now()
         review.content = form.content.data
         review.rating = form.rating.data
@@ -136,13 +244,33 @@ def update_review(review_id):
     closed_form = ClosedResourceDetailForm()
     return render_template('resources/create_review.html',
                            resource=resource,
-                           reviews=resource.reviews,
+                           reviews=get_reviews(resource.id),
                            current_user_id=current_user.id,
                            form=form,
                            closed_form=closed_form,
                            closed_details=closed_details)
 
 
+@resources.route('/review/<int:review_id>/<any(like, dislike):vote>',
+                 methods=['POST'])
+@login_required
+def vote_review(review_id, vote):
+    """
+    Like or dislike a review. The vote is counted in memory and written to
+    the database with others in the next flush of the vote counter.
+    """
+    review = ResourceReview.query.options(
+        load_only('id', 'count_likes', 'count_dislikes'))\
+        .get_or_404(review_id)
+    get_vote_counter().increment(review.id, 'count_%ss' % vote)
+    likes, dislikes = review.vote_counts()
+    data = dict()
+    data['likes'] = likes
+    data['dislikes'] = dislikes
+    return Response(response=json.dumps(data), status=200,
+                    mimetype='application/json')
+
+
 @resources.route('/review/delete/<int:review_id>')
 @login_required
 def delete_review(review_id):
@@ -151,6 +279,7 @@ def delete_review(review_id):
     if current_user.id != review.user.id:
         flash('You cannot delete a review you did not write.', 'error')
     else:
+        Resource.update_review_counts(resource.id, removed=review.rating)
         db.session.delete(review)
         db.session.commit()
     return redirect(url_for('resources.read_resource',
@@ -0,0 +1,159 @@
+"""
+Indexed full-text search of members by name.
+
+On SQLite the names are indexed in a user_search FTS5 table, which triggers
+on the users table keep up to date. FTS5 is built into the SQLite of most
+Python builds, but not all; without it, and on databases other than SQLite
+and PostgreSQL, searches fall back to prefix matching on the name columns.
+On PostgreSQL the names are indexed with a GIN index on a tsvector of the
+names.
+
+Every word of a search must match the start of a word in the first or last
+name. Results are ranked by relevance, then by name.
+"""
+import re
+import sqlite3
+from sqlalchemy import DDL, and_, event, func, or_
+from sqlalchemy.orm import lazyload, load_only
+from sqlalchemy.sql import column, table
+from . import db
+from .models import User
+
+# Searches use at most this many words.
+MAX_TERMS = 5
+
+_SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+    "first_name, last_name, content='users', content_rowid='id', "
+    "prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS user_search_insert AFTER INSERT ON users "
+    "BEGIN "
+    "INSERT INTO user_search (rowid, first_name, last_name) "
+    "VALUES (new.id, new.first_name, new.last_name); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS user_search_delete AFTER DELETE ON users "
+    "BEGIN "
+    "INSERT INTO user_search (user_search, rowid, first_name, last_name) "
+    "VALUES ('delete', old.id, old.first_name, old.last_name); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS user_search_update "
+    "AFTER UPDATE OF first_name, last_name ON users "
+    "BEGIN "
+    "INSERT INTO user_search (user_search, rowid, first_name, last_name) "
+    "VALUES ('delete', old.id, old.first_name, old.last_name); "
+    "INSERT INTO user_search (rowid, first_name, last_name) "
+    "VALUES (new.id, new.first_name, new.last_name); "
+    "END"
+]
+
+_POSTGRESQL_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_users_name_search ON users USING gin "
+    "(to_tsvector('simple', coalesce(first_name, '') || ' ' || "
+    "coalesce(last_name, '')))"
+]
+
+# Whether SQLite has FTS5, found on first use.
+_fts5_available = None
+
+
+def _sqlite_has_fts5():
+    """True if the SQLite library has the FTS5 extension."""
+    global _fts5_available
+    if _fts5_available is None:
+        connection = sqlite3.connect(':memory:')
+        try:
+            connection.execute('CREATE VIRTUAL TABLE fts5_check USING '
+                               'fts5(text)')
+            _fts5_available = True
+        except sqlite3.OperationalError:
+            _fts5_available = False
+        finally:
+            connection.close()
+    return _fts5_available
+
+
+def _uses_fts5(dialect_name):
+    return dialect_name == 'sqlite' and _sqlite_has_fts5()
+
+
+for statement in _SQLITE_DDL:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(
+                     callable_=lambda ddl, target, bind, **kwargs:
+                     _uses_fts5(bind.dialect.name)))
+for statement in _POSTGRESQL_DDL:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+event.listen(User.__table__, 'before_drop',
+             DDL('DROP TABLE IF EXISTS user_search')
+             .execute_if(dialect='sqlite'))
+
+_user_search = table('user_search', column('rowid'), column('rank'),
+                     column('user_search'))
+
+
+def search_terms(query):
+    """Split a search into the words that are matched."""
+    return re.findall(r'\w+', query, re.UNICODE)[:MAX_TERMS]
+
+
+def _name_vector():
+    return func.to_tsvector('simple',
+                            func.coalesce(User.first_name, '') + ' ' +
+                            func.coalesce(User.last_name, ''))
+
+
+def _match(terms):
+    """Return a query of the users matching all terms, best first."""
+    users = User.query
+    dialect = db.engine.dialect.name
+    if _uses_fts5(dialect):
+        match = ' '.join('"%s"*' % term for term in terms)
+        users = users.join(_user_search, _user_search.c.rowid == User.id)\
+            .filter(_user_search.c.user_search.op('MATCH')(match))\
+            .order_by(_user_search.c.rank)
+    elif dialect == 'postgresql':
+        tsquery = func.to_tsquery('simple', ' & '.join('%s:*' % term
+                                                       for term in terms))
+        users = users.filter(_name_vector().op('@@')(tsquery))\
+            .order_by(func.ts_rank(_name_vector(), tsquery).desc())
+    else:
+        patterns = [term.replace('_', r'\_') + '%' for term in terms]
+        users = users.filter(and_(*[
+            or_(User.first_name.ilike(pattern, escape='\\'),
+                User.last_name.ilike(pattern, escape='\\'))
+            for pattern in patterns]))
+    return users.order_by(User.last_name, User.first_name, User.id)
+
+
+def search_users(query, page=1, per_page=10):
+    """
+    Return the page of users whose names match query, and whether there is
+    a next page. Only the users' ids and names are loaded.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return [], False
+    page = max(page, 1)
+    users = _match(terms)\
+        .options(load_only('id', 'first_name', 'last_name'),
+                 lazyload(User.user_links))\
+        .offset((page - 1) * per_page).limit(per_page + 1).all()
+    return users[:per_page], len(users) > per_page
+
+
+def rebuild_index():
+    """
+    Create the search index of an existing database if it is missing, and
+    refill it from the users table.
+    """
+    dialect = db.engine.dialect.name
+    if _uses_fts5(dialect):
+        for statement in _SQLITE_DDL:
+            db.session.execute(statement)
+        db.session.execute(
+            "INSERT INTO user_search (user_search) VALUES ('rebuild')")
+    elif dialect == 'postgresql':
+        for statement in _POSTGRESQL_DDL:
+            db.session.execute(statement)
+    db.session.commit()
@@ -0,0 +1,87 @@
+"""
+Tasks run by `manage.py worker`, see app.jobs.
+"""
+from datetime import datetime, timedelta
+
+from flask import current_app
+from .jobs import task
+
+
+@task()
+def geocode_zip_code(zip_code_id):
+    """Resolve the pending coordinates of a ZIP code."""
+    from .models import ZIPCode
+
+    zip_code = ZIPCode.query.get(zip_code_id)
+    if zip_code is not None and zip_code.is_pending():
+        zip_code.geocode()
+
+
+@task()
+def geocode_address(address_id):
+    """Geocode an address to street level."""
+    from .models import Address
+
+    address = Address.query.get(address_id)
+    if address is not None and address.is_pending():
+        address.geocode()
+
+
+@task()
+def send_email(message):
+    """
+    Send an email, given as a dict of the subject, sender, recipients, body
+    and html of a Message.
+    """
+    from flask.ext.mail import Message
+    from . import mail
+
+    mail.send(Message(**message))
+
+
+@task()
+def send_invitations(user_ids, base_url):
+    """Invite the users with the given ids, see app.invites."""
+    from .invites import send_invitations
+
+    send_invitations(user_ids, base_url)
+
+
+@task()
+def update_trending():
+    from .trending import update_trending_scores
+
+    update_trending_scores()
+
+
+@task(timeout=3600)
+def rebuild_trending():
+    """Recompute every trending score, see app.trending."""
+    from .trending import update_trending_scores
+
+    update_trending_scores(rebuild=True)
+
+
+@task(timeout=3600)
+def reconcile_resource_counts():
+    from .models import Resource
+
+    Resource.reconcile_counts()
+
+
+@task(timeout=3600)
+def rebuild_zip_code_counts():
+    from .models import ZIPCodeCount
+
+    ZIPCodeCount.rebuild()
+
+
+@task()
+def purge_jobs():
+    """Delete the jobs that finished more than JOB_RETENTION seconds ago."""
+    from .models import Job
+
+    cutoff = datetime.utcnow() - timedelta(
+        seconds=current_app.config['JOB_RETENTION'])
+    Job.query.filter(Job.status == Job.DONE, Job.finished_at < cutoff)\
+        .delete(synchronize_session=False)
@@ -0,0 +1,112 @@
+"""
+Trending resources.
+
+A resource's trending score is the sum of the weights of its reviews, each
+decayed exponentially with the review's age, halving every
+TRENDING_HALF_LIFE seconds. Better ratings weigh more.
+
+Decaying every score as time passes would mean rewriting every resource.
+Instead, scores are stored relative to a fixed EPOCH: a review at time t
+contributes weight * 2 ** ((t - EPOCH) / half_life), which is its decayed
+weight now times a factor that is the same for every resource. So the
+stored scores rank resources exactly as their current decayed scores do,
+and only resources with new reviews need updating. Scores are kept as
+natural logarithms so that they do not overflow.
+
+Adding, editing or deleting a review marks its resource's score stale (see
+app.models.resource), whenever the change is committed, and
+update_trending_scores recomputes the stale scores from the resources'
+reviews. A periodic rebuild also catches reviews changed outside the ORM.
+"""
+import math
+import time
+from calendar import timegm
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.orm import load_only
+from . import db
+from .models import Resource, ResourceReview
+
+EPOCH = datetime(2016, 1, 1)
+# Resources updated per transaction.
+BATCH_SIZE = 1000
+
+
+def review_weight(rating):
+    """Weight of a review with a rating of 1 to 5 (None if unrated)."""
+    return (rating or 3) / 3.0
+
+
+def log_score(rating, timestamp, half_life):
+    """
+    Return the logarithm of the contribution of a review with rating made
+    at timestamp (a datetime) to its resource's score.
+    """
+    seconds = timegm(timestamp.utctimetuple()) - timegm(EPOCH.utctimetuple())
+    return math.log(review_weight(rating)) + \
+        seconds / float(half_life) * math.log(2)
+
+
+def _log_add(a, b):
+    """Return log(exp(a) + exp(b)), where a may be None for log(0)."""
+    if a is None:
+        return b
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def current_score(score, half_life, now=None):
+    """Return the decayed score now of a stored trending score."""
+    if score is None:
+        return 0.0
+    now = now or time.time()
+    seconds = now - timegm(EPOCH.utctimetuple())
+    return math.exp(score - seconds / float(half_life) * math.log(2))
+
+
+def update_trending_scores(rebuild=False):
+    """
+    Recompute the trending scores of the resources whose reviews changed
+    since the last update, or of every resource if rebuild is True. Returns
+    the number of reviews counted.
+    """
+    half_life = current_app.config['TRENDING_HALF_LIFE']
+    if rebuild:
+        Resource.query.update({'trending_stale': True})
+        db.session.commit()
+
+    counted = 0
+    while True:
+        resource_ids = [id for id, in db.session.query(Resource.id)
+                        .filter(Resource.trending_stale)
+                        .order_by(Resource.id).limit(BATCH_SIZE)]
+        if not resource_ids:
+            return counted
+        # Clear the flags before reading the reviews, so that a review
+        # committed meanwhile marks its resource stale again.
+        Resource.query.filter(Resource.id.in_(resource_ids))\
+            .update({'trending_stale': False}, synchronize_session=False)
+        reviews = db.session.query(ResourceReview.resource_id,
+                                   ResourceReview.rating,
+                                   ResourceReview.timestamp)\
+            .filter(ResourceReview.resource_id.in_(resource_ids)).all()
+        now = datetime.utcnow()
+
+        scores = dict.fromkeys(resource_ids)
+        for review in reviews:
+            scores[review.resource_id] = _log_add(
+                scores[review.resource_id],
+                log_score(review.rating, review.timestamp or now, half_life))
+        db.session.bulk_update_mappings(
+            Resource, [{'id': id, 'trending_score': score}
+                       for id, score in scores.items()])
+        db.session.commit()
+        counted += len(reviews)
+
+
+def trending_resources(limit=10):
+    """Return the limit resources with the highest trending scores."""
+    return Resource.query.options(load_only('id', 'name'))\
+        .filter(Resource.trending_score.isnot(None))\
+        .order_by(Resource.trending_score.desc()).limit(limit).all()
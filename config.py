@@ -20,6 +20,97 @@ class Config:
     EMAIL_SUBJECT_PREFIX = '[{}]'.format(APP_NAME)
     EMAIL_SENDER = '{app_name} Admin <{email}>'.format(app_name=APP_NAME,
                                                        email=MAIL_USERNAME)
+    # Emails are sent by a pool of EMAIL_WORKERS threads, each sending up to
+    # EMAIL_BATCH_SIZE messages per SMTP connection and closing it after
+    # EMAIL_IDLE_TIMEOUT idle seconds. Sending waits up to
+    # EMAIL_QUEUE_TIMEOUT seconds when EMAIL_QUEUE_SIZE emails are waiting.
+    # At most EMAIL_RATE_LIMIT emails are sent per second (None for no limit).
+    # After a connection failure, workers wait EMAIL_RETRY_DELAY seconds
+    # before reconnecting, doubled with each failure in a row.
+    EMAIL_WORKERS = 2
+    EMAIL_BATCH_SIZE = 50
+    EMAIL_IDLE_TIMEOUT = 5
+    EMAIL_QUEUE_SIZE = 1000
+    EMAIL_QUEUE_TIMEOUT = 5
+    EMAIL_RATE_LIMIT = 5
+    EMAIL_RETRY_DELAY = 1
+    # Durable background jobs (app.jobs), run by `manage.py worker`. Without
+    # the job queue, emails and geocoding run on threads of the web process.
+    JOB_QUEUE_ENABLED = bool(os.environ.get('JOB_QUEUE_ENABLED'))
+    # Seconds an idle worker waits before checking for jobs again.
+    JOB_POLL_INTERVAL = 1
+    # Seconds before a job whose worker stopped responding is run again.
+    JOB_VISIBILITY_TIMEOUT = 300
+    # Failed jobs are tried again after JOB_RETRY_DELAY seconds, doubled
+    # with each attempt, up to JOB_MAX_ATTEMPTS times in all.
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_DELAY = 30
+    # Seconds finished jobs are kept for the admin's jobs page.
+    JOB_RETENTION = 7 * 24 * 3600
+    ADMIN_JOBS_PER_PAGE = 50
+    # Maintenance tasks the workers run, with the seconds between runs.
+    JOB_SCHEDULE = {
+        'update_trending': 15 * 60,
+        'rebuild_trending': 24 * 3600,
+        'reconcile_resource_counts': 24 * 3600,
+        'purge_jobs': 24 * 3600
+    }
+    # Users read per query when exporting members.
+    EXPORT_BATCH_SIZE = 1000
+    # Rows of a resource directory imported together.
+    IMPORT_BATCH_SIZE = 1000
+    # Rows of a bulk invitation CSV checked and inserted together.
+    INVITE_BATCH_SIZE = 500
+    # Bulk invitations are sent apart from the other emails, at most
+    # INVITE_RATE_LIMIT per second (None for no limit).
+    INVITE_RATE_LIMIT = 2
+
+    # ZIP codes missing from the bundled gazetteer are looked up remotely.
+    GEOCODER_REMOTE_FALLBACK = True
+    GEOCODER_TIMEOUT = 5
+    # Store such ZIP codes right away and geocode them in the background.
+    GEOCODER_ASYNC = bool(os.environ.get('GEOCODER_ASYNC'))
+    # Failed background lookups are tried again after GEOCODER_RETRY_DELAY
+    # seconds, doubled with each attempt, up to GEOCODER_MAX_ATTEMPTS times
+    # in all.
+    GEOCODER_MAX_ATTEMPTS = 3
+    GEOCODER_RETRY_DELAY = 10
+    # Remote results are cached per process; misses expire sooner.
+    GEOCODER_CACHE_SIZE = 10000
+    GEOCODER_CACHE_TTL = 30 * 24 * 3600
+    GEOCODER_CACHE_NEGATIVE_TTL = 24 * 3600
+    # Geocode new addresses to street level in the background. This sends
+    # every new address to Nominatim, so it has to be enabled explicitly.
+    GEOCODER_ADDRESSES = bool(os.environ.get('GEOCODER_ADDRESSES'))
+    # Batch geocoding (manage.py geocode_backfill). Nominatim's usage policy
+    # allows at most 1 request per second.
+    GEOCODER_RATE_LIMIT = 1.0
+    GEOCODER_BATCH_WORKERS = 4
+    # Seconds between loads of new ZIP codes into the in-memory distance
+    # index, and between full reloads of it (app.geo.distance).
+    DISTANCE_INDEX_REFRESH_INTERVAL = 10
+    DISTANCE_INDEX_REBUILD_INTERVAL = 3600
+    # Count the SQL queries of each request, and log statements run at least
+    # QUERY_REPEAT_THRESHOLD times in one request as likely N+1 queries.
+    # Enabled in development and testing only.
+    QUERY_COUNTER_ENABLED = False
+    QUERY_REPEAT_THRESHOLD = 5
+    # Members listed per page of name search results.
+    SEARCH_RESULTS_PER_PAGE = 10
+    # Name autocomplete is served from memory; each process reloads all
+    # names every AUTOCOMPLETE_REBUILD_INTERVAL seconds.
+    AUTOCOMPLETE_RESULTS = 10
+    AUTOCOMPLETE_REBUILD_INTERVAL = 300
+    # Users listed per page of the admin's registered users table.
+    ADMIN_USERS_PER_PAGE = 50
+    # Reviews listed per page on a resource's page.
+    REVIEWS_PER_PAGE = 20
+    # Seconds between writes of buffered review likes and dislikes.
+    COUNTER_FLUSH_INTERVAL = 5
+    # Seconds for a review's weight in the trending resources score to
+    # halve, and number of trending resources listed.
+    TRENDING_HALF_LIFE = 7 * 24 * 60 * 60
+    TRENDING_RESOURCES = 10
 
     @staticmethod
     def init_app(app):
@@ -29,6 +120,7 @@ class Config:
 class DevelopmentConfig(Config):
     DEBUG = True
     ASSETS_DEBUG = True
+    QUERY_COUNTER_ENABLED = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-dev.sqlite')
 
@@ -38,6 +130,9 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
     WTF_CSRF_ENABLED = False
+    QUERY_COUNTER_ENABLED = True
+    GEOCODER_REMOTE_FALLBACK = False
+    GEOCODER_ADDRESSES = False
 
 
 class ProductionConfig(Config):
@@ -75,6 +75,226 @@ def add_fake_data(count):
                                      AffiliationTag.query.all())
 
 
+@manager.option('source',
+                help='CSV with zip_code, latitude and longitude columns')
+def build_gazetteer(source):
+    """Rebuilds the bundled ZIP code gazetteer from a CSV file."""
+    from app.geo.gazetteer import write_gazetteer, read_csv_rows
+
+    count = write_gazetteer(read_csv_rows(source))
+    print('Wrote {} ZIP codes to the gazetteer.'.format(count))
+
+
+@manager.option('-c',
+                '--checkpoint',
+                default=None,
+                help='File recording finished lookups, so an interrupted '
+                     'backfill can resume without repeating them')
+def geocode_backfill(checkpoint):
+    """
+    Geocodes every ZIP code that is missing coordinates, then every address
+    that has no street-level coordinates.
+    """
+    from app.geo import geocode_remote
+    from app.geo.batch import BatchGeocoder
+    from app.geo.backfill import backfill_zip_codes, backfill_addresses
+
+    def geocode(query):
+        with app.app_context():
+            return geocode_remote(query)
+
+    batch_geocoder = BatchGeocoder(
+        geocode,
+        workers=app.config['GEOCODER_BATCH_WORKERS'],
+        rate_limit=app.config['GEOCODER_RATE_LIMIT'],
+        checkpoint_path=checkpoint)
+    for name, backfill in [('ZIP codes', backfill_zip_codes),
+                           ('Addresses', backfill_addresses)]:
+        report = backfill(batch_geocoder)
+        for query, error in report['errors']:
+            print('Failed to geocode {}: {}'.format(query, error))
+        print('{} located: {located}, not found: {not_found}, '
+              'failed: {failed}'.format(name, **report))
+
+
+@manager.command
+def rebuild_zip_code_counts():
+    """Recounts the users and resources in every ZIP code."""
+    from app.models import ZIPCodeCount
+
+    count = ZIPCodeCount.rebuild()
+    print('Counted users and resources in {} ZIP codes.'.format(count))
+
+
+@manager.command
+def rebuild_search_index():
+    """Creates the member name search index if needed, and refills it."""
+    from app.search import rebuild_index
+
+    rebuild_index()
+    print('Rebuilt the member search index.')
+
+
+@manager.command
+def reconcile_resource_counts():
+    """Recounts the reviews, ratings and closed reports of each resource."""
+    count = Resource.reconcile_counts()
+    print('Fixed the counts of {} resources.'.format(count))
+
+
+@manager.option('-r',
+                '--rebuild',
+                action='store_true',
+                help='Recompute every score from scratch')
+def update_trending(rebuild=False):
+    """Updates the trending scores of resources whose reviews changed."""
+    from app.trending import update_trending_scores
+
+    count = update_trending_scores(rebuild=rebuild)
+    print('Counted {} reviews.'.format(count))
+
+
+@manager.option('source',
+                help='CSV with first_name, last_name and email columns')
+@manager.option('-r',
+                '--role',
+                default='User',
+                help='Name of the role to give the invited users')
+@manager.option('-u',
+                '--base-url',
+                default='http://localhost',
+                help='Address of the site, for links in the invitations')
+def invite_users(source, role, base_url):
+    """Invites every new user listed in a CSV file."""
+    from app.invites import invite_users as invite, InviteFileError, \
+        get_invitation_sender
+
+    user_role = Role.query.filter_by(name=role).first()
+    if user_role is None:
+        print('No role named {}.'.format(role))
+        return
+
+    def progress(report):
+        print('Read {rows} rows, invited {invited} users and resent '
+              '{resent} invitations.'.format(**report))
+
+    with open(source, 'rb') as csvfile, \
+            app.test_request_context(base_url=base_url):
+        try:
+            report = invite(csvfile, user_role, progress=progress)
+        except InviteFileError as e:
+            print(e)
+            return
+    for line, email, error in report['errors']:
+        print('Line {}: {} {}'.format(line, email or '', error))
+    if app.config['JOB_QUEUE_ENABLED']:
+        print('The invitations will be sent by manage.py worker.')
+        return
+    print('Sending the invitations...')
+    get_invitation_sender(app).join()
+    print('Done.')
+
+
+@manager.option('-f',
+                '--format',
+                default='csv',
+                choices=['csv', 'jsonl'],
+                help='Output format')
+@manager.option('-s',
+                '--since',
+                default=None,
+                help='Only export users added or changed at or after this '
+                     'UTC time, e.g. 2016-05-01 or 2016-05-01T12:00:00')
+@manager.option('-o',
+                '--output',
+                default=None,
+                help='File to write, gzipped if its name ends in .gz '
+                     '(standard output if not given)')
+def export_users(format, since, output):
+    """Exports users with their roles, ZIP codes and affiliations."""
+    import sys
+    from datetime import datetime
+    from app.export import export_users as export, gzipped, parse_since
+
+    exported_at = datetime.utcnow()
+    chunks = export(format, parse_since(since))
+    if output is None:
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+    else:
+        if output.endswith('.gz'):
+            chunks = gzipped(chunks)
+        with open(output, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    sys.stderr.write('Exported users changed up to {}; pass it as --since '
+                     'to export later changes.\n'.format(
+                         exported_at.isoformat()))
+
+
+@manager.option('source',
+                help='CSV or JSON lines file of resources with name, '
+                     'description, website, street_address, city, state '
+                     'and zip_code fields')
+@manager.option('-f',
+                '--format',
+                default=None,
+                choices=['csv', 'jsonl'],
+                help='Format of the file (by default, from its extension)')
+@manager.option('-u',
+                '--user',
+                default=None,
+                help='Email of the user to list as adding the resources')
+def import_resources(source, format, user):
+    """Imports a directory of resources, skipping duplicates."""
+    from app.resource_import import import_resources as import_file, \
+        ImportFileError
+
+    format = format or ('csv' if source.endswith('.csv') else 'jsonl')
+    added_by = None
+    if user is not None:
+        added_by = User.query.filter_by(email=user).first()
+        if added_by is None:
+            print('No user with the email {}.'.format(user))
+            return
+
+    def progress(report):
+        print('Read {rows} rows, imported {imported} resources.'
+              .format(**report))
+
+    with open(source, 'rb') as f:
+        try:
+            report = import_file(f, format, user=added_by, progress=progress)
+        except ImportFileError as e:
+            print(e)
+            return
+    for line, name, message in report['duplicates'] + report['errors']:
+        print(u'Line {}: {} {}'.format(line, name or '', message)
+              .encode('utf-8'))
+    print('Imported {imported} resources, with {addresses} new addresses; '
+          '{} duplicates and {} errors.'.format(len(report['duplicates']),
+                                                len(report['errors']),
+                                                **report))
+    if report['addresses']:
+        print('Run manage.py geocode_backfill to locate the new addresses.')
+
+
+@manager.option('-b',
+                '--burst',
+                action='store_true',
+                help='Stop once no jobs are ready to run')
+def worker(burst=False):
+    """Runs background jobs and scheduled maintenance tasks."""
+    import signal
+    from app.jobs import Worker
+
+    job_worker = Worker(app)
+    signal.signal(signal.SIGTERM, job_worker.stop)
+    print('Worker {} started.'.format(job_worker.name))
+    count = job_worker.run(burst=burst)
+    print('Ran {} jobs.'.format(count))
+
+
 @manager.command
 def setup_dev():
     """Runs the set-up needed for local development."""
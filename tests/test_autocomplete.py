@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from app import create_app, db
+from app.autocomplete import NameIndex, get_name_index, name_words
+from app.models import User, Role
+
+
+class AutocompleteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        for first_name, last_name in [('Joan', 'Smith'), ('John', 'Doe'),
+                                      ('Mary', 'Johnson'), ('Ann', 'Jones')]:
+            db.session.add(User(first_name=first_name, last_name=last_name,
+                                email='%s@example.com' % first_name,
+                                password='password', confirmed=True))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def names(self, index, query, k=10):
+        return sorted(name for user_id, name in index.complete(query, k))
+
+    def test_name_words(self):
+        self.assertEqual(name_words(u'Zoë  O\'Neil'), [u'zoe', u'o', u'neil'])
+
+    def test_complete(self):
+        index = NameIndex()
+        self.assertEqual(self.names(index, 'jo'),
+                         ['Ann Jones', 'Joan Smith', 'John Doe',
+                          'Mary Johnson'])
+        self.assertEqual(self.names(index, 'JOHN'),
+                         ['John Doe', 'Mary Johnson'])
+        self.assertEqual(self.names(index, 'j smi'), ['Joan Smith'])
+        self.assertEqual(self.names(index, 'x'), [])
+        self.assertEqual(len(index.complete('jo', k=2)), 2)
+
+    def test_index_follows_commits(self):
+        index = get_name_index()
+        index.rebuild()
+        self.assertEqual(len(index), 4)
+        user = User.query.filter_by(first_name='Ann').first()
+        user.last_name = 'Brown'
+        db.session.add(User(first_name='Jo', last_name='Brown',
+                            email='jo@example.com'))
+        db.session.commit()
+        self.assertEqual(self.names(index, 'bro'), ['Ann Brown', 'Jo Brown'])
+        self.assertEqual(self.names(index, 'jones'), [])
+
+        db.session.delete(user)
+        db.session.commit()
+        self.assertEqual(self.names(index, 'bro'), ['Jo Brown'])
+
+        user = User.query.filter_by(first_name='Jo').first()
+        user.first_name = 'Joe'
+        db.session.rollback()
+        self.assertEqual(self.names(index, 'joe'), [])
+
+    def test_changes_during_a_rebuild_are_kept(self):
+        class SlowIndex(NameIndex):
+            def _read_names(self):
+                rows = NameIndex._read_names(self)
+                # Committed by another thread while the users were read.
+                self.set(99, 'Jo', 'Late')
+                self.remove(rows[0][0])
+                return rows
+
+        index = SlowIndex()
+        index.rebuild()
+        self.assertEqual(self.names(index, 'jo'),
+                         ['Ann Jones', 'Jo Late', 'John Doe',
+                          'Mary Johnson'])
+
+    def test_index_is_loaded_before_the_first_request(self):
+        self.app.test_client().get('/')
+        self.assertEqual(len(self.app.extensions['name_index']), 4)
+
+    def test_autocomplete_endpoint(self):
+        client = self.app.test_client()
+        client.post('/account/login', data={
+            'email': 'Joan@example.com',
+            'password': 'password'
+        })
+        data = json.loads(client.get('/autocomplete/smi').data)
+        self.assertEqual([r['title'] for r in data['results']],
+                         ['Joan Smith'])
@@ -0,0 +1,149 @@
+import asyncore
+import smtpd
+import smtplib
+import threading
+import time
+import unittest
+from flask.ext.mail import Message
+from app import create_app, mail
+from app.email import EmailPool, EmailQueueFull, send_email
+
+
+class RecordingSMTPServer(smtpd.SMTPServer):
+    """A local SMTP server that records the messages it receives."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, data))
+
+
+class FlakyConnection(object):
+    """A connection that breaks on the messages listed in failures."""
+
+    def __init__(self, failures, sent):
+        self.failures = failures
+        self.sent = sent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send(self, msg):
+        if msg.subject in self.failures:
+            self.failures.remove(msg.subject)
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly '
+                                                 'closed')
+        self.sent.append(msg.subject)
+
+
+class EmailTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = RecordingSMTPServer()
+        self.loop = threading.Thread(target=asyncore.loop,
+                                     kwargs={'timeout': 0.05})
+        self.loop.start()
+        self.app = create_app('testing')
+        self.app.config.update(MAIL_SERVER='127.0.0.1',
+                               MAIL_PORT=self.server.port,
+                               MAIL_USE_TLS=False, MAIL_SUPPRESS_SEND=False,
+                               MAIL_USERNAME=None,
+                               EMAIL_SENDER='admin@example.com')
+        mail.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.server.close()
+        asyncore.close_all()
+        self.loop.join()
+
+    def message(self, i):
+        return Message('Hello %d' % i, sender='admin@example.com',
+                       recipients=['user%d@example.com' % i], body='Hi')
+
+    def test_reuses_connections(self):
+        pool = EmailPool(self.app, workers=2, batch_size=4, idle_timeout=1)
+        for i in range(10):
+            pool.submit(self.message(i))
+        pool.join()
+        pool.stop()
+        self.assertEqual(sorted(r[0][0] for r in self.server.messages),
+                         sorted('user%d@example.com' % i for i in range(10)))
+        stats = pool.stats()
+        self.assertEqual((stats['queued'], stats['sent'], stats['failed'],
+                          stats['waiting']), (10, 10, 0, 0))
+        self.assertLessEqual(stats['connections'], 5)
+        self.assertEqual(stats['connections'], self.server.connections)
+
+    def test_send_email(self):
+        with self.app.test_request_context():
+            send_email('joan@example.com', 'Welcome', 'account/email/confirm',
+                       user={'full_name': lambda: 'Joan'}, token='token')
+        self.app.extensions['email_pool'].join()
+        self.assertEqual(self.server.messages[0][0], ['joan@example.com'])
+
+    def test_connection_failure(self):
+        port = self.server.port
+        self.server.close()
+        self.app.config['MAIL_PORT'] = port
+        pool = EmailPool(self.app, workers=1, retry_delay=0.1)
+        start = time.time()
+        pool.submit(self.message(1))
+        pool.join()
+        pool.stop()
+        self.assertEqual(pool.stats()['failed'], 1)
+        # Waited 0.1 seconds before reconnecting, then 0.2 more.
+        self.assertGreaterEqual(time.time() - start, 0.3)
+
+    def test_backpressure(self):
+        pool = EmailPool(self.app, workers=0, queue_size=2)
+        pool.submit(self.message(1))
+        pool.submit(self.message(2))
+        self.assertRaises(EmailQueueFull, pool.submit, self.message(3),
+                          timeout=0.01)
+        self.assertEqual(pool.stats()['overflowed'], 1)
+
+    def test_send_email_sends_itself_when_queue_is_full(self):
+        self.app.config['EMAIL_QUEUE_TIMEOUT'] = 0.01
+        self.app.extensions['email_pool'] = pool = EmailPool(
+            self.app, workers=0, queue_size=1)
+        with self.app.test_request_context():
+            user = {'full_name': lambda: 'Joan'}
+            for address in ('joan@example.com', 'jo@example.com'):
+                send_email(address, 'Welcome', 'account/email/confirm',
+                           user=user, token='token')
+        # The first is queued, the second sent right away.
+        self.assertEqual(pool.stats()['overflowed'], 1)
+        self.assertEqual([r[0] for r in self.server.messages],
+                         [['jo@example.com']])
+
+    def test_broken_connection_is_retried_once(self):
+        # Hello 1 fails once and is resent; Hello 2 fails twice and is
+        # given up on.
+        failures = ['Hello 1', 'Hello 2', 'Hello 2']
+        sent = []
+        mail.connect = lambda: FlakyConnection(failures, sent)
+        try:
+            pool = EmailPool(self.app, workers=1, retry_delay=0.01)
+            for i in range(1, 4):
+                pool.submit(self.message(i))
+            pool.join()
+            pool.stop()
+        finally:
+            del mail.connect
+        self.assertEqual(sent, ['Hello 1', 'Hello 3'])
+        stats = pool.stats()
+        self.assertEqual((stats['sent'], stats['retried'], stats['failed']),
+                         (2, 2, 1))
@@ -0,0 +1,104 @@
+import csv
+import json
+import zlib
+from datetime import datetime, timedelta
+from StringIO import StringIO
+import unittest
+from app import create_app, db
+from app.export import export_users, gzipped, parse_since
+from app.models import User, Role, ZIPCode, AffiliationTag
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        zip_code = ZIPCode.create_zip_code('19104')
+        army = AffiliationTag('Army')
+        navy = AffiliationTag('Navy')
+        for i in range(5):
+            db.session.add(User(first_name=u'Zo\xeb%d' % i, last_name='Lee',
+                                email='user%d@example.com' % i,
+                                password='password', confirmed=i > 0,
+                                zip_code=zip_code if i % 2 else None,
+                                tags=[army, navy] if i == 1 else []))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def rows(self, format='csv', since=None):
+        data = ''.join(export_users(format, since))
+        if format == 'csv':
+            return list(csv.DictReader(StringIO(data)))
+        return [json.loads(line) for line in data.splitlines()]
+
+    def test_csv(self):
+        self.app.config['EXPORT_BATCH_SIZE'] = 2
+        rows = self.rows()
+        self.assertEqual([row['email'] for row in rows],
+                         ['user%d@example.com' % i for i in range(5)])
+        self.assertEqual(rows[1]['first_name'].decode('utf-8'), u'Zo\xeb1')
+        self.assertEqual(rows[1]['affiliations'], 'Army; Navy')
+        self.assertEqual(rows[1]['zip_code'], '19104')
+        self.assertEqual(rows[1]['role'], 'User')
+        self.assertEqual(rows[0]['zip_code'], '')
+
+    def test_jsonl(self):
+        rows = self.rows('jsonl')
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[1]['affiliations'], ['Army', 'Navy'])
+        self.assertEqual(rows[1]['confirmed'], True)
+        self.assertIsNone(rows[0]['zip_code'])
+        self.assertEqual(parse_since(rows[0]['created_at'][:19]).date(),
+                         datetime.utcnow().date())
+
+    def test_since(self):
+        later = datetime.utcnow() + timedelta(seconds=1)
+        User.query.filter(User.id < 3).update(
+            {'updated_at': later - timedelta(days=1)})
+        db.session.commit()
+        self.assertEqual(self.rows('jsonl', since=later), [])
+        since = later - timedelta(days=1)
+        self.assertEqual(len(self.rows('jsonl', since=since)), 5)
+        self.assertEqual(len(self.rows('jsonl', since=later -
+                                       timedelta(hours=1))), 3)
+        # Changing only a user's tags marks it as changed.
+        user = User.query.filter_by(email='user0@example.com').first()
+        user.tags.append(AffiliationTag('Marines'))
+        db.session.commit()
+        self.assertEqual(len(self.rows('jsonl', since=later -
+                                       timedelta(hours=1))), 4)
+        self.assertRaises(ValueError, parse_since, 'yesterday')
+
+    def test_gzipped(self):
+        data = ''.join(gzipped(export_users('jsonl')))
+        text = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        self.assertEqual(len(text.splitlines()), 5)
+
+    def test_endpoint(self):
+        admin_role = Role.query.filter_by(name='Administrator').first()
+        admin = User.query.filter_by(email='user1@example.com').first()
+        admin.role = admin_role
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/account/login', data={
+            'email': 'user1@example.com',
+            'password': 'password'
+        })
+        response = client.get('/admin/users/export?format=csv',
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('X-Exported-At', response.headers)
+        text = zlib.decompress(response.data, 16 + zlib.MAX_WBITS)
+        self.assertEqual(len(text.splitlines()), 6)
+        response = client.get('/admin/users/export?format=jsonl&'
+                              'since=2000-01-01')
+        self.assertEqual(len(response.data.splitlines()), 5)
+        response = client.get('/admin/users/export?since=soon')
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,553 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from geopy.exc import GeocoderTimedOut
+from sqlalchemy import literal, select, union_all
+from app import create_app, db
+from app.models import ZIPCode, Address, Resource
+from app.geo.backfill import backfill_zip_codes, backfill_addresses
+from app.geo.batch import BatchGeocoder, RateLimiter
+from app.geo.cache import GeocodeCache, NOT_CACHED
+from app.geo.clustering import cluster_page, parse_bbox, within_bbox, \
+    MAX_LABELS
+from app.geo.distance import haversine_one_to_many, CoordinateIndex, \
+    haversine_many_to_many, get_zip_code_index
+from app.geo.singleflight import SingleFlight
+from app.geo.worker import GeocodingWorker
+from app.geo.spatial import cell_for, cells_within, haversine
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class GeocodeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = GeocodeCache(max_size=2, ttl=100, negative_ttl=10,
+                                  clock=self.clock)
+
+    def test_hit_and_miss(self):
+        self.assertIs(self.cache.get('19104'), NOT_CACHED)
+        self.cache.set('19104', (39.9, -75.2))
+        self.assertEqual(self.cache.get(' 19104 '), (39.9, -75.2))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_negative_results_expire_sooner(self):
+        self.cache.set('99999', None)
+        self.cache.set('19104', (39.9, -75.2))
+        self.assertIsNone(self.cache.get('99999'))
+        self.assertEqual(self.cache.stats()['negative_hits'], 1)
+        self.clock.now = 50
+        self.assertIs(self.cache.get('99999'), NOT_CACHED)
+        self.assertEqual(self.cache.get('19104'), (39.9, -75.2))
+        self.clock.now = 100
+        self.assertIs(self.cache.get('19104'), NOT_CACHED)
+
+    def test_lru_eviction(self):
+        self.cache.set('a', (1, 1))
+        self.cache.set('b', (2, 2))
+        self.cache.get('a')
+        self.cache.set('c', (3, 3))
+        self.assertIs(self.cache.get('b'), NOT_CACHED)
+        self.assertEqual(self.cache.get('a'), (1, 1))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_get_or_lookup_caches_misses(self):
+        calls = []
+
+        def lookup(query):
+            calls.append(query)
+            return None
+
+        self.assertIsNone(self.cache.get_or_lookup('00000', lookup))
+        self.assertIsNone(self.cache.get_or_lookup('00000', lookup))
+        self.assertEqual(calls, ['00000'])
+
+    def test_errors_are_not_cached(self):
+        def lookup(query):
+            raise IOError('geocoder unavailable')
+
+        with self.assertRaises(IOError):
+            self.cache.get_or_lookup('19104', lookup)
+        self.assertEqual(len(self.cache), 0)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_calls_are_spaced(self):
+        clock = FakeClock()
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock.now += seconds
+
+        limiter = RateLimiter(2.0, clock=clock, sleep=sleep)
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(sleeps, [0.5, 0.5])
+
+
+class BatchGeocoderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.flaky = set(['19104'])
+
+    def stub_geocode(self, query):
+        self.calls.append(query)
+        if query in self.flaky:
+            self.flaky.remove(query)
+            raise GeocoderTimedOut('stub timed out')
+        if query == '00000':
+            return None
+        return (float(query[:2]), float(query[2:]))
+
+    def batch_geocoder(self, **kwargs):
+        return BatchGeocoder(self.stub_geocode, workers=3, rate_limit=None,
+                             sleep=lambda seconds: None, **kwargs)
+
+    def test_geocode_all_retries_failures(self):
+        results = self.batch_geocoder().geocode_all(
+            ['19104', '00000', '60521', '60521'])
+        results = dict((q, (c, e)) for q, c, e in results)
+        self.assertEqual(results['19104'], ((19.0, 104.0), None))
+        self.assertEqual(results['00000'], (None, None))
+        self.assertEqual(results['60521'], ((60.0, 521.0), None))
+        self.assertEqual(sorted(self.calls),
+                         ['00000', '19104', '19104', '60521'])
+
+    def test_geocode_all_gives_up_after_max_retries(self):
+        sleeps = []
+
+        def always_times_out(query):
+            raise GeocoderTimedOut('stub timed out')
+
+        geocoder = BatchGeocoder(always_times_out, rate_limit=None,
+                                 max_retries=2, sleep=sleeps.append)
+        [(query, coordinates, error)] = geocoder.geocode_all(['19104'])
+        self.assertIsNone(coordinates)
+        self.assertIsInstance(error, GeocoderTimedOut)
+        self.assertEqual(sleeps, [1.0, 2.0])
+
+    def test_checkpoint_skips_finished_queries(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            list(self.batch_geocoder(checkpoint_path=path)
+                 .geocode_all(['19104', '00000']))
+            self.calls = []
+            results = list(self.batch_geocoder(checkpoint_path=path)
+                           .geocode_all(['19104', '00000', '60521']))
+            self.assertEqual(self.calls, ['60521'])
+            self.assertIn(('19104', (19.0, 104.0), None), results)
+            self.assertIn(('00000', None, None), results)
+        finally:
+            os.remove(path)
+
+
+class BackfillTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_backfill_zip_codes(self):
+        for zip_code in ['19104', '19198', '19199']:
+            db.session.add(ZIPCode(zip_code, defer=True))
+        db.session.commit()
+        stub = {'19198': (1.0, 2.0), '19199': None}
+        batch_geocoder = BatchGeocoder(stub.get, rate_limit=None)
+        report = backfill_zip_codes(batch_geocoder)
+        self.assertEqual(report['located'], 1)
+        self.assertEqual(report['not_found'], 1)
+        self.assertEqual(ZIPCode.get_by_zip_code('19198').latitude, 1.0)
+        missing = ZIPCode.get_by_zip_code('19199')
+        self.assertFalse(missing.is_pending())
+        self.assertTrue(missing.unresolvable)
+
+    def test_backfill_zip_codes_commits_as_it_goes(self):
+        from flask.ext.sqlalchemy import SignallingSession
+        from sqlalchemy import event
+
+        for zip_code in ['19156', '19157', '19158', '19159', '19163']:
+            db.session.add(ZIPCode(zip_code, defer=True))
+        db.session.commit()
+        commits = []
+
+        def count_commit(session):
+            commits.append(session)
+        event.listen(SignallingSession, 'after_commit', count_commit)
+        try:
+            # None of them are found.
+            report = backfill_zip_codes(BatchGeocoder(lambda query: None,
+                                                      rate_limit=None),
+                                        commit_every=2)
+        finally:
+            event.remove(SignallingSession, 'after_commit', count_commit)
+        self.assertEqual(report['not_found'], 5)
+        # After 2 and 4 ZIP codes, and once at the end.
+        self.assertEqual(len(commits), 3)
+
+    def test_backfill_addresses(self):
+        z = ZIPCode.create_zip_code('19104')
+        found = Address.create_address('A', '3650 Spruce St', 'Philadelphia',
+                                       'PA', zip_code=z)
+        missing = Address.create_address('B', '1 Nowhere Rd', 'Philadelphia',
+                                         'PA', zip_code=z)
+        stub = {found.geocoder_query(): (39.95, -75.19)}
+        report = backfill_addresses(BatchGeocoder(stub.get, rate_limit=None))
+        self.assertEqual((report['located'], report['not_found']), (1, 1))
+        db.session.expire_all()
+        self.assertTrue(found.is_geocoded)
+        self.assertEqual(found.latitude, 39.95)
+        self.assertFalse(missing.is_geocoded)
+        self.assertTrue(missing.unresolvable)
+        self.assertFalse(missing.is_pending())
+        self.assertEqual(missing.latitude, z.latitude)
+        # Unresolvable addresses are not looked up again.
+        report = backfill_addresses(BatchGeocoder(stub.get, rate_limit=None))
+        self.assertEqual((report['located'], report['not_found']), (0, 0))
+
+    def test_backfill_addresses_commits_as_it_goes(self):
+        from flask.ext.sqlalchemy import SignallingSession
+        from sqlalchemy import event
+
+        z = ZIPCode.create_zip_code('19104')
+        stub = {}
+        for street in ['1 Main St', '2 Main St']:
+            # Three addresses that share one geocoder query.
+            for name in 'ABC':
+                address = Address.create_address(
+                    name, street, 'Philadelphia', 'PA', zip_code=z)
+            stub[address.geocoder_query()] = (39.95, -75.19)
+        commits = []
+
+        def count_commit(session):
+            commits.append(session)
+        event.listen(SignallingSession, 'after_commit', count_commit)
+        try:
+            report = backfill_addresses(BatchGeocoder(stub.get,
+                                                      rate_limit=None),
+                                        commit_every=4)
+        finally:
+            event.remove(SignallingSession, 'after_commit', count_commit)
+        self.assertEqual(report['located'], 6)
+        # Once after 6 addresses were located, and once at the end.
+        self.assertEqual(len(commits), 2)
+
+
+class FlakyRow(object):
+    """A pending row whose geocode raises failures times."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def is_pending(self):
+        return True
+
+    def geocode(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise GeocoderTimedOut('Service timed out')
+
+
+class GeocodingWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+
+    def worker_calls(self, failures):
+        row = FlakyRow(failures)
+
+        class Model(object):
+            class query(object):
+                @staticmethod
+                def get(id):
+                    return row
+
+        worker = GeocodingWorker(self.app, max_attempts=3, retry_delay=0.01)
+        worker.enqueue(Model, 1)
+        worker.join()
+        return row.calls
+
+    def test_failures_are_retried(self):
+        self.assertEqual(self.worker_calls(2), 3)
+
+    def test_retries_are_bounded(self):
+        self.assertEqual(self.worker_calls(5), 3)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def lookup(query):
+            calls.append(query)
+            release.wait()
+            return (1.0, 2.0)
+
+        threads = [threading.Thread(
+            target=lambda: results.append(flight.do('19104', lookup, '19104')))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flight.in_flight() == 0:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ['19104'])
+        self.assertEqual(results, [(1.0, 2.0)] * 5)
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_errors_are_shared_and_not_remembered(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise IOError('geocoder unavailable')
+
+        with self.assertRaises(IOError):
+            flight.do('19104', fail)
+        self.assertEqual(flight.do('19104', lambda: 'ok'), 'ok')
+
+
+class SpatialTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_haversine(self):
+        # Philadelphia to New York City.
+        distance = haversine(39.9526, -75.1652, 40.7128, -74.0060)
+        self.assertAlmostEqual(distance, 80.6, places=0)
+
+    def test_cells_within_cover_the_circle(self):
+        cells = set(cells_within(39.95, -75.16, 30))
+        for latitude, longitude in [(39.95, -75.16), (40.37, -75.16),
+                                    (39.95, -74.60), (39.53, -75.72)]:
+            self.assertIn(cell_for(latitude, longitude), cells)
+        self.assertNotIn(cell_for(40.71, -74.00), cells)
+
+    def test_resources_near(self):
+        for name, zip_code in [('Philadelphia', '19104'),
+                               ('New York', '10001'),
+                               ('Stanford', '94305')]:
+            address = Address.create_address(
+                name, '1 Main St', name, 'XX',
+                zip_code=ZIPCode.create_zip_code(zip_code))
+            resource = Resource.create_resource(name, name, None)
+            resource.address = address
+        db.session.commit()
+        results = Resource.near(39.95, -75.16, 100)
+        self.assertEqual([row.name for distance, row in results],
+                         ['Philadelphia', 'New York'])
+        self.assertLess(results[0][0], results[1][0])
+        self.assertEqual(Resource.near(39.95, -75.16, 100, limit=1)[0][1].name,
+                         'Philadelphia')
+
+    def test_within_bbox(self):
+        for zip_code in ['19104', '10001', '94305']:
+            ZIPCode.create_zip_code(zip_code)
+        db.session.commit()
+
+        def within(bbox):
+            return sorted(zip_code.zip_code for zip_code in ZIPCode.query
+                          .filter(within_bbox(ZIPCode.latitude,
+                                              ZIPCode.longitude,
+                                              parse_bbox(bbox))))
+        self.assertEqual(within('39,-76,41,-73'), ['10001', '19104'])
+        self.assertEqual(within('-90,-180,90,180'),
+                         ['10001', '19104', '94305'])
+        self.assertEqual(within('-90,-540,90,540'),
+                         ['10001', '19104', '94305'])
+        # Crossing the 180th meridian from Asia to the US west coast.
+        self.assertEqual(within('30,100,45,-100'), ['94305'])
+
+
+class DistanceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_vectorized_haversine_matches_scalar(self):
+        latitudes, longitudes = [40.7128, 37.424, 39.9526], [-74.006,
+                                                             -122.1676,
+                                                             -75.1652]
+        distances = haversine_one_to_many(39.9526, -75.1652,
+                                          latitudes, longitudes)
+        for distance, latitude, longitude in zip(distances, latitudes,
+                                                 longitudes):
+            self.assertAlmostEqual(
+                distance, haversine(39.9526, -75.1652, latitude, longitude))
+        matrix = haversine_many_to_many(latitudes, longitudes,
+                                        latitudes[:2], longitudes[:2])
+        self.assertEqual(matrix.shape, (3, 2))
+        self.assertAlmostEqual(matrix[2][0], distances[0])
+        self.assertAlmostEqual(matrix[1][1], 0)
+
+    def test_zip_code_index_is_refreshed_incrementally(self):
+        philadelphia = ZIPCode.create_zip_code('19104')
+        pending = ZIPCode('19199', defer=True)
+        db.session.add(pending)
+        db.session.commit()
+        self.assertEqual(ZIPCode.nearest(39.95, -75.16)[0][0],
+                         philadelphia.id)
+
+        new_york = ZIPCode.create_zip_code('10001')
+        pending.set_coordinates(39.95, -75.16)
+        db.session.commit()
+        self.assertEqual(len(ZIPCode.within(39.95, -75.16, 100)), 1)
+        get_zip_code_index().refresh()
+        self.assertEqual([id for id, distance in
+                          ZIPCode.within(39.95, -75.16, 100)],
+                         [pending.id, philadelphia.id, new_york.id])
+        self.assertEqual(len(get_zip_code_index()), 3)
+
+        # Deleted rows stay until the next rebuild.
+        db.session.delete(new_york)
+        db.session.commit()
+        get_zip_code_index().refresh()
+        self.assertEqual(len(get_zip_code_index()), 3)
+        get_zip_code_index().rebuild()
+        self.assertEqual(len(get_zip_code_index()), 2)
+
+    def test_zip_code_index_is_kept_up_to_date_by_tick(self):
+        now = [1000]
+        index = CoordinateIndex(self.app, ZIPCode, refresh_interval=10,
+                                rebuild_interval=100, clock=lambda: now[0])
+        philadelphia_id = ZIPCode.create_zip_code('19104').id
+        index.tick()
+        self.assertIsNone(index._arrays)
+        self.assertEqual(len(index), 1)
+
+        ZIPCode.create_zip_code('10001')
+        index.tick()
+        self.assertEqual(len(index), 1)
+        now[0] += 10
+        index.tick()
+        self.assertEqual(len(index), 2)
+
+        ZIPCode.query.filter_by(zip_code='10001').delete()
+        db.session.commit()
+        now[0] += 10
+        index.tick()
+        self.assertEqual(len(index), 2)
+        now[0] += 100
+        index.tick()
+        self.assertEqual([id for id, distance in
+                          index.within(39.95, -75.16, 100)],
+                         [philadelphia_id])
+
+    def test_resources_are_ranked_by_their_addresses(self):
+        zip_code = ZIPCode.create_zip_code('19104')
+        for name, latitude, longitude in [('Far', 39.99, -75.10),
+                                          ('Near', 39.951, -75.191),
+                                          ('Centroid', None, None)]:
+            address = Address.create_address(name, '1 Main St',
+                                             'Philadelphia', 'PA',
+                                             zip_code=zip_code)
+            if latitude is not None:
+                address.set_coordinates(latitude, longitude)
+            resource = Resource.create_resource(name, name, None)
+            resource.address = address
+        db.session.commit()
+        results = Resource.near(39.951, -75.191, 10)
+        self.assertEqual([row.name for distance, row in results],
+                         ['Near', 'Centroid', 'Far'])
+
+
+class ClusteringTestCase(unittest.TestCase):
+    points = [(39.96, -75.20, 3, '19104'), (39.95, -75.16, 1, '19103'),
+              (37.42, -122.17, 2, '94305')]
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+
+    def query(self, points):
+        """Return a Query selecting points."""
+        names = ['latitude', 'longitude', 'count', 'label', 'key']
+        rows = union_all(*[select([literal(value).label(name)
+                                   for name, value in zip(names, point)])
+                           for point in points]).alias()
+        return db.session.query(*rows.c)
+
+    def test_no_zoom_keeps_every_point(self):
+        data = cluster_page(self.query(self.points))
+        self.assertEqual(data['count'], [3, 2, 1])
+
+    def test_nearby_points_merge_when_zoomed_out(self):
+        data = cluster_page(self.query(self.points), zoom=4)
+        self.assertEqual(data['count'], [4, 2])
+        self.assertEqual(data['labels'], [['19103', '19104'], ['94305']])
+        self.assertEqual(data['points'], [2, 1])
+        self.assertAlmostEqual(data['lat'][0], 39.9575)
+
+    def test_labels_are_limited(self):
+        points = [(39.95, -75.16, 1, str(i)) for i in range(MAX_LABELS + 2)]
+        data = cluster_page(self.query(points), zoom=4)
+        self.assertEqual(data['points'], [MAX_LABELS + 2])
+        self.assertEqual(data['labels'],
+                         [[str(i) for i in range(MAX_LABELS)]])
+
+    def test_single_point_clusters_keep_their_key(self):
+        data = cluster_page(self.query([(39.96, -75.20, 1, 'a', 7),
+                                        (39.95, -75.16, 1, 'b', 8),
+                                        (37.42, -122.17, 1, 'c', 9)]),
+                            zoom=4)
+        self.assertEqual(data['key'], [None, 9])
+
+    def test_parse_bbox(self):
+        self.assertEqual(parse_bbox('39,-76,40,-75'), (39, -76, 40, -75))
+        self.assertIsNone(parse_bbox(None))
+        self.assertIsNone(parse_bbox('39,-76,40'))
+        self.assertIsNone(parse_bbox('40,-76,39,-75'))
+        self.assertIsNone(parse_bbox('a,b,c,d'))
+
+    def test_pages(self):
+        data = cluster_page(self.query(self.points), page=1, per_page=2)
+        self.assertEqual(data['count'], [3, 2])
+        self.assertEqual(data['lat'], [39.96, 37.42])
+        self.assertEqual(data['next_page'], 2)
+        self.assertEqual(data['total'], 3)
+        data = cluster_page(self.query(self.points), page=2, per_page=2)
+        self.assertEqual(data['labels'], [['19103']])
+        self.assertIsNone(data['next_page'])
+        data = cluster_page(self.query(self.points), page=3, per_page=2)
+        self.assertEqual(data['count'], [])
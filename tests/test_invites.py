@@ -0,0 +1,122 @@
+import unittest
+from StringIO import StringIO
+from app import create_app, db, mail
+from app.invites import invite_users, InviteFileError, \
+    get_invitation_sender
+from app.jobs import Worker
+from app.models import Job, User, Role
+
+CSV = '''\xef\xbb\xbfEmail,First_Name,Last_Name,Phone
+ann@example.com,Ann,Jones,555
+bob@example.com,Bob,Smith,
+
+ann@example.com,Ann,Again,
+joan@example.com,Joan,Taken,
+not-an-email,Ned,Nope,
+cat@example.com,,Lee,
+dee@example.com,Z\xc3\xb6e,Dee,
+'''
+
+
+class InvitesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.request_context = self.app.test_request_context()
+        self.request_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.role = Role.query.filter_by(name='User').first()
+        db.session.add(User(first_name='Joan', last_name='Smith',
+                            email='joan@example.com', password='password',
+                            confirmed=True))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.request_context.pop()
+        self.app_context.pop()
+
+    def test_invite_users(self):
+        reports = []
+        report = invite_users(StringIO(CSV), self.role, batch_size=2,
+                              progress=lambda r: reports.append(r['rows']))
+        self.assertEqual(report['rows'], 7)
+        self.assertEqual(report['invited'], 3)
+        self.assertEqual(report['errors'], [
+            (5, 'ann@example.com', 'Listed more than once.'),
+            (6, 'joan@example.com', 'Email already registered.'),
+            (7, 'not-an-email', 'Invalid email address.'),
+            (8, 'cat@example.com', 'No first name.'),
+        ])
+        self.assertEqual(reports, [2, 7])
+        user = User.query.filter_by(email='dee@example.com').first()
+        self.assertEqual(user.full_name(), u'Z\xf6e Dee')
+        self.assertEqual(user.role, self.role)
+        self.assertFalse(user.confirmed)
+        self.assertIsNone(user.password_hash)
+        token = user.generate_confirmation_token()
+        self.assertTrue(user.confirm_account(token))
+
+    def test_invitations_are_sent_in_the_background(self):
+        with mail.record_messages() as outbox:
+            invite_users(StringIO(CSV), self.role)
+            get_invitation_sender().join()
+        self.assertEqual(sorted(msg.recipients[0] for msg in outbox),
+                         ['ann@example.com', 'bob@example.com',
+                          'dee@example.com'])
+        self.assertIn('http://localhost/account/join-from-invite/',
+                      outbox[0].body)
+
+    def test_invitations_are_resent_until_joined(self):
+        self.app.config['JOB_QUEUE_ENABLED'] = True
+        invite_users(StringIO(CSV), self.role)
+        ann = User.query.filter_by(email='ann@example.com').first()
+        ann.password = 'password'
+        db.session.commit()
+        report = invite_users(StringIO(CSV), self.role)
+        self.assertEqual((report['invited'], report['resent']), (0, 2))
+        self.assertEqual(report['errors'], [
+            (2, 'ann@example.com', 'Email already registered.'),
+            (5, 'ann@example.com', 'Listed more than once.'),
+            (6, 'joan@example.com', 'Email already registered.'),
+            (7, 'not-an-email', 'Invalid email address.'),
+            (8, 'cat@example.com', 'No first name.'),
+        ])
+        self.assertEqual(Job.query.filter_by(task='send_invitations')
+                         .count(), 2)
+        # Ann has joined by the time the first job runs.
+        with mail.record_messages() as outbox:
+            Worker(self.app, schedule={}).run(burst=True)
+        self.assertEqual(sorted(msg.recipients[0] for msg in outbox),
+                         ['bob@example.com', 'bob@example.com',
+                          'dee@example.com', 'dee@example.com'])
+
+    def test_missing_column(self):
+        self.assertRaises(InviteFileError, invite_users,
+                          StringIO('email,name\na@example.com,A\n'),
+                          self.role)
+        self.assertRaises(InviteFileError, invite_users, StringIO(''),
+                          self.role)
+
+    def test_upload(self):
+        admin_role = Role.query.filter_by(name='Administrator').first()
+        db.session.add(User(first_name='Ad', last_name='Min', role=admin_role,
+                            email='admin@example.com', password='password',
+                            confirmed=True))
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/account/login', data={
+            'email': 'admin@example.com',
+            'password': 'password'
+        })
+        response = client.post('/admin/invite-users', data={
+            'role': self.role.id,
+            'csv_file': (StringIO(CSV), 'members.csv')
+        })
+        self.assertIn('3 of 7 users invited and 0 invitations resent',
+                      response.data)
+        self.assertIn('Email already registered.', response.data)
+        self.assertEqual(User.query.count(), 5)
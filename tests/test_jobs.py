@@ -0,0 +1,126 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db, mail
+from app.email import send_email
+from app.jobs import enqueue, task, Worker
+from app.models import Job, Role, User
+
+calls = []
+
+
+@task()
+def record(value):
+    calls.append(value)
+
+
+@task()
+def tick():
+    calls.append('tick')
+
+
+@task(max_attempts=2)
+def fail():
+    raise ValueError('Failed on purpose')
+
+
+class JobsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['JOB_RETRY_DELAY'] = 0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        del calls[:]
+        self.worker = Worker(self.app, poll_interval=0, schedule={})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def job(self, id):
+        db.session.expire_all()
+        return Job.query.get(id)
+
+    def test_run_jobs(self):
+        first = enqueue('record', 1)
+        later = enqueue('record', 2, delay=3600)
+        db.session.commit()
+        first, later = first.id, later.id
+        self.assertEqual(self.worker.run(burst=True), 1)
+        self.assertEqual(calls, [1])
+        self.assertEqual(self.job(first).status, Job.DONE)
+        self.assertEqual(self.job(later).status, Job.QUEUED)
+
+    def test_retries(self):
+        job = enqueue('fail')
+        db.session.commit()
+        job_id = job.id
+        self.assertEqual(self.worker.run(burst=True), 2)
+        job = self.job(job_id)
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertIn('Failed on purpose', job.last_error)
+
+        enqueue('missing')
+        db.session.commit()
+        self.worker.run(burst=True)
+        self.assertEqual(Job.query.filter_by(task='missing').one().status,
+                         Job.FAILED)
+
+    def test_visibility_timeout(self):
+        job = enqueue('record', 1)
+        db.session.commit()
+        self.assertEqual(self.worker.claim().id, job.id)
+        # Its worker died; nobody else runs the job until its lock expires.
+        self.assertFalse(self.worker.run_one())
+        Job.query.update({'locked_until': datetime.utcnow() -
+                          timedelta(seconds=1)})
+        db.session.commit()
+        self.assertTrue(self.worker.run_one())
+        job = self.job(job.id)
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 2))
+        self.assertEqual(calls, [1])
+
+    def test_schedule(self):
+        worker = Worker(self.app, poll_interval=0, schedule={'tick': 60})
+        worker.enqueue_scheduled()
+        worker.enqueue_scheduled()
+        self.assertEqual(Job.query.count(), 1)
+        worker.run_one()
+        self.assertEqual(calls, ['tick'])
+        worker.enqueue_scheduled()
+        queued = Job.query.filter_by(status=Job.QUEUED).one()
+        self.assertGreater(queued.run_at,
+                           datetime.utcnow() + timedelta(seconds=50))
+
+    def test_send_email(self):
+        self.app.config['JOB_QUEUE_ENABLED'] = True
+        with self.app.test_request_context():
+            send_email('joan@example.com', 'Welcome', 'account/email/confirm',
+                       user={'full_name': lambda: 'Joan'}, token='token')
+        db.session.commit()
+        with mail.record_messages() as outbox:
+            self.worker.run(burst=True)
+        self.assertEqual(outbox[0].recipients, ['joan@example.com'])
+        self.assertIn('Joan', outbox[0].body)
+
+    def test_admin_page(self):
+        Role.insert_roles()
+        admin_role = Role.query.filter_by(name='Administrator').first()
+        db.session.add(User(first_name='Ad', last_name='Min', role=admin_role,
+                            email='admin@example.com', password='password',
+                            confirmed=True))
+        job = enqueue('fail')
+        db.session.commit()
+        job_id = job.id
+        self.worker.run(burst=True)
+        client = self.app.test_client()
+        client.post('/account/login', data={
+            'email': 'admin@example.com',
+            'password': 'password'
+        })
+        response = client.get('/admin/jobs?status=failed')
+        self.assertIn('Failed on purpose', response.data)
+        client.post('/admin/jobs/%d/retry' % job_id)
+        job = self.job(job_id)
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 0))
@@ -0,0 +1,178 @@
+import unittest
+from app import create_app, db
+from app.models import ZIPCode, Address
+from app.geo.gazetteer import get_gazetteer
+
+
+class LocationModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_gazetteer_lookup(self):
+        gazetteer = get_gazetteer()
+        self.assertEqual(gazetteer.lookup('19104'), (39.964, -75.1972))
+        self.assertIsNone(gazetteer.lookup('00000'))
+        self.assertIsNone(gazetteer.lookup('1910'))
+        self.assertIsNone(gazetteer.lookup('abcde'))
+
+    def test_create_zip_code_offline(self):
+        z = ZIPCode.create_zip_code('19104')
+        self.assertEqual(z.latitude, 39.964)
+        self.assertEqual(z.longitude, -75.1972)
+        self.assertEqual(ZIPCode.create_zip_code('19104').id, z.id)
+
+    def test_create_zip_code_race(self):
+        # Another process inserts the ZIP code between the lookup and the
+        # insert.
+        get_by_zip_code = ZIPCode.get_by_zip_code
+
+        def lose_race(zip_code):
+            ZIPCode.get_by_zip_code = staticmethod(get_by_zip_code)
+            with db.engine.begin() as connection:
+                connection.execute(ZIPCode.__table__.insert().values(
+                    zip_code=zip_code, latitude=39.964, longitude=-75.1972))
+            return None
+
+        # The caller's own changes are kept.
+        other = ZIPCode('19103')
+        db.session.add(other)
+        ZIPCode.get_by_zip_code = staticmethod(lose_race)
+        try:
+            z = ZIPCode.create_zip_code('19104')
+        finally:
+            ZIPCode.get_by_zip_code = staticmethod(get_by_zip_code)
+        self.assertEqual(z.zip_code, '19104')
+        self.assertIn(other, db.session)
+        db.session.commit()
+        self.assertEqual(ZIPCode.query.count(), 2)
+
+    def test_invalid_zip_code(self):
+        with self.assertRaises(ValueError):
+            ZIPCode.create_zip_code('00000')
+
+    def test_deferred_zip_code_is_geocoded_in_background(self):
+        import app.geo
+        from app.geo.worker import get_worker
+
+        self.app.config['GEOCODER_ASYNC'] = True
+        self.app.config['GEOCODER_REMOTE_FALLBACK'] = True
+        geocode_remote = app.geo.geocode_remote
+        app.geo.geocode_remote = lambda query: (10.0, 20.0)
+        try:
+            z = ZIPCode.create_zip_code('19199')
+            self.assertTrue(z.is_pending())
+            get_worker().join()
+        finally:
+            app.geo.geocode_remote = geocode_remote
+        db.session.expire_all()
+        z = ZIPCode.get_by_zip_code('19199')
+        self.assertFalse(z.is_pending())
+        self.assertEqual((z.latitude, z.longitude), (10.0, 20.0))
+
+    def test_deferred_zip_code_must_be_plausible(self):
+        import app.geo
+        from app.geo.worker import get_worker
+
+        self.app.config['GEOCODER_ASYNC'] = True
+        self.app.config['GEOCODER_REMOTE_FALLBACK'] = True
+        for zip_code in ['00000', '1910', 'abcde']:
+            with self.assertRaises(ValueError):
+                ZIPCode.create_zip_code(zip_code)
+
+        geocode_remote = app.geo.geocode_remote
+        app.geo.geocode_remote = lambda query: None
+        try:
+            z = ZIPCode.create_zip_code('19198')
+            get_worker().join()
+        finally:
+            app.geo.geocode_remote = geocode_remote
+        db.session.expire_all()
+        z = ZIPCode.get_by_zip_code('19198')
+        self.assertTrue(z.unresolvable)
+        self.assertFalse(z.is_pending())
+        with self.assertRaises(ValueError):
+            ZIPCode.create_zip_code('19198')
+
+    def test_address_falls_back_to_zip_centroid(self):
+        z = ZIPCode.create_zip_code('19104')
+        a = Address.create_address('Home', '3650 Spruce St', 'Philadelphia',
+                                   'PA', zip_code=z)
+        self.assertFalse(a.is_geocoded)
+        self.assertEqual((a.latitude, a.longitude),
+                         (z.latitude, z.longitude))
+        self.assertEqual(a.geocoder_query(),
+                         '3650 Spruce St, Philadelphia, PA, 19104')
+
+    def test_zip_code_counts_follow_users_and_resources(self):
+        from app.models import User, Resource, ZIPCodeCount
+
+        a = ZIPCode.create_zip_code('19104')
+        b = ZIPCode.create_zip_code('94305')
+
+        def counts(zip_code):
+            db.session.expire_all()
+            c = zip_code.counts
+            return (c.user_count, c.resource_count) if c else (0, 0)
+
+        # The rows are created with the ZIP codes.
+        self.assertEqual(ZIPCodeCount.query.count(), 2)
+
+        u = User(first_name='A', last_name='B', email='a@b.com',
+                 password='x', zip_code=a)
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(counts(a), (1, 0))
+
+        u.zip_code = b
+        db.session.commit()
+        self.assertEqual(counts(a), (0, 0))
+        self.assertEqual(counts(b), (1, 0))
+
+        r = Resource.create_resource('Food bank', 'Food', None)
+        r.address = Address.create_address('Bank', '3650 Spruce St',
+                                           'Philadelphia', 'PA', zip_code=a)
+        db.session.commit()
+        self.assertEqual(counts(a), (0, 1))
+
+        r.address.set_zip_code(b)
+        db.session.commit()
+        self.assertEqual(counts(a), (0, 0))
+        self.assertEqual(counts(b), (1, 1))
+
+        db.session.delete(u)
+        db.session.delete(r)
+        db.session.commit()
+        self.assertEqual(counts(b), (0, 0))
+
+        ZIPCodeCount.query.delete()
+        db.session.commit()
+        self.assertEqual(ZIPCodeCount.rebuild(), 0)
+        db.session.add(User(first_name='C', last_name='D', email='c@d.com',
+                            password='x', zip_code=a))
+        db.session.commit()
+        ZIPCodeCount.query.delete()
+        db.session.commit()
+        self.assertEqual(ZIPCodeCount.rebuild(), 1)
+        self.assertEqual(counts(a), (1, 0))
+        self.assertEqual(ZIPCodeCount.query.count(), 2)
+
+    def test_zip_code_counts_without_a_row(self):
+        from app.models import User, ZIPCodeCount
+
+        zip_code = ZIPCode.create_zip_code('19104')
+        # As for a ZIP code saved before its row was created with it.
+        ZIPCodeCount.query.delete()
+        db.session.commit()
+        db.session.add(User(first_name='A', last_name='B', email='a@b.com',
+                            password='x', zip_code=zip_code))
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(zip_code.counts.user_count, 1)
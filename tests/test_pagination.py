@@ -0,0 +1,108 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, AffiliationTag
+from app.pagination import keyset_paginate, decode_cursor
+
+
+class KeysetPaginationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        # Two users share each last name, to test ties in the sort key.
+        for i in range(10):
+            db.session.add(User(first_name='User', last_name='L%d' % (i / 2),
+                                email='user%d@example.com' % i,
+                                password='password', confirmed=i % 2 == 0))
+        db.session.commit()
+        self.columns = [User.last_name, User.id]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def emails(self, page):
+        return [int(u.email[4:-12]) for u in page]
+
+    def test_pages_forward_and_back(self):
+        page = keyset_paginate(User.query, self.columns, 4)
+        self.assertEqual(self.emails(page), [0, 1, 2, 3])
+        self.assertIsNone(page.prev_cursor)
+        page = keyset_paginate(User.query, self.columns, 4,
+                               after=page.next_cursor)
+        self.assertEqual(self.emails(page), [4, 5, 6, 7])
+        last = keyset_paginate(User.query, self.columns, 4,
+                               after=page.next_cursor)
+        self.assertEqual(self.emails(last), [8, 9])
+        self.assertIsNone(last.next_cursor)
+
+        page = keyset_paginate(User.query, self.columns, 4,
+                               before=last.prev_cursor)
+        self.assertEqual(self.emails(page), [4, 5, 6, 7])
+        page = keyset_paginate(User.query, self.columns, 4,
+                               before=page.prev_cursor)
+        self.assertEqual(self.emails(page), [0, 1, 2, 3])
+        self.assertIsNone(page.prev_cursor)
+        self.assertIsNotNone(page.next_cursor)
+
+    def test_descending(self):
+        page = keyset_paginate(User.query, self.columns, 3, descending=True)
+        self.assertEqual(self.emails(page), [9, 8, 7])
+        page = keyset_paginate(User.query, self.columns, 3,
+                               after=page.next_cursor, descending=True)
+        self.assertEqual(self.emails(page), [6, 5, 4])
+
+    def test_null_sort_values(self):
+        for i in (3, 6, 7):
+            User.query.filter_by(email='user%d@example.com' % i).first()\
+                .last_name = None
+        db.session.commit()
+        for descending, order in [(False, [0, 1, 2, 4, 5, 8, 9, 3, 6, 7]),
+                                  (True, [7, 6, 3, 9, 8, 5, 4, 2, 1, 0])]:
+            pages = [keyset_paginate(User.query, self.columns, 3,
+                                     descending=descending)]
+            while pages[-1].next_cursor is not None:
+                pages.append(keyset_paginate(User.query, self.columns, 3,
+                                             after=pages[-1].next_cursor,
+                                             descending=descending))
+            self.assertEqual(sum([self.emails(page) for page in pages], []),
+                             order)
+            # And back again.
+            page = pages[-1]
+            for expected in reversed(pages[:-1]):
+                page = keyset_paginate(User.query, self.columns, 3,
+                                       before=page.prev_cursor,
+                                       descending=descending)
+                self.assertEqual(self.emails(page), self.emails(expected))
+
+    def test_malformed_cursor_gives_first_page(self):
+        self.assertIsNone(decode_cursor('not a cursor', 2))
+        page = keyset_paginate(User.query, self.columns, 4, after='x')
+        self.assertEqual(self.emails(page), [0, 1, 2, 3])
+
+    def test_registered_users_filters(self):
+        admin = User.query.filter_by(email='user0@example.com').first()
+        admin.role = Role.query.filter_by(name='Administrator').first()
+        tag = AffiliationTag.create_affiliation_tag('Veteran')
+        user = User.query.filter_by(email='user3@example.com').first()
+        user.tags.append(tag)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/account/login', data={
+            'email': 'user0@example.com',
+            'password': 'password'
+        })
+        self.app.config['ADMIN_USERS_PER_PAGE'] = 4
+        data = client.get('/admin/users?confirmed=no').data
+        self.assertIn('user1@example.com', data)
+        self.assertNotIn('user0@example.com', data)
+        self.assertIn('after=', data)
+        data = client.get('/admin/users?affiliation=%d' % tag.id).data
+        self.assertIn('user3@example.com', data)
+        self.assertNotIn('user1@example.com', data)
+        data = client.get('/admin/users?sort=email&order=desc').data
+        self.assertIn('user9@example.com', data)
+        self.assertNotIn('user0@example.com', data)
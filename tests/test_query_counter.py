@@ -0,0 +1,124 @@
+import logging
+import unittest
+from flask import request
+from sqlalchemy.orm import joinedload
+from app import create_app, db
+from app.models import User, Role, ZIPCode, DonorLevel, Address, \
+    Resource, ResourceReview
+from app.query_counter import count_queries, max_queries, \
+    QueryBudgetExceeded
+
+
+class QueryCounterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        DonorLevel.insert_donor_levels()
+        self.zip_codes = [ZIPCode.create_zip_code(z)
+                          for z in ['19104', '94305', '60521']]
+        self.resource = Resource.create_resource('Food bank', 'Food', None)
+        self.resource.address = Address.create_address(
+            'Bank', '3650 Spruce St', 'Philadelphia', 'PA',
+            zip_code=self.zip_codes[0])
+        self.add_users(10)
+        self.resource.user = User.query.get(1)
+        self.resource.user.role = Role.query.filter_by(
+            name='Administrator').first()
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/account/login', data={
+            'email': 'user0@example.com',
+            'password': 'password'
+        })
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_users(self, count):
+        """Add count users, each with a donor level and a review."""
+        donor_levels = DonorLevel.query.all()
+        start = User.query.count()
+        for i in range(start, start + count):
+            user = User(first_name='User', last_name=str(i),
+                        email='user%d@example.com' % i,
+                        password='password', confirmed=True,
+                        zip_code=self.zip_codes[i % 3],
+                        donor_level=donor_levels[i % 3])
+            review = ResourceReview(timestamp=None, content='Good',
+                                    rating=4)
+            review.user = user
+            review.resource = self.resource
+            db.session.add(review)
+        db.session.commit()
+
+    def test_count_queries(self):
+        with count_queries() as stats:
+            for user in User.query.all():
+                user.zip_code.zip_code
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(len(stats.repeated(3)), 1)
+        self.assertEqual(stats.repeated(4), [])
+
+    def test_max_queries(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with max_queries(1):
+                User.query.all()
+                ZIPCode.query.all()
+
+    def test_n_plus_one_requests_are_logged(self):
+        messages = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+
+        # Each review's user is lazy loaded unless eager is given.
+        @self.app.route('/test/reviewers')
+        def reviewers():
+            reviews = ResourceReview.query
+            if 'eager' in request.args:
+                reviews = reviews.options(joinedload(ResourceReview.user))
+            return ', '.join(review.user.email for review in reviews)
+
+        self.app.logger.addHandler(Handler())
+        db.session.remove()
+        self.client.get('/test/reviewers')
+        self.assertEqual(len([m for m in messages
+                              if 'Likely N+1 query in GET /test/reviewers, '
+                                 'run 10 times' in m]), 1)
+
+        del messages[:]
+        db.session.remove()
+        self.client.get('/test/reviewers?eager=1')
+        self.assertEqual([m for m in messages if 'N+1' in m], [])
+
+    def test_map_data_query_budget(self):
+        with max_queries(3):
+            response = self.client.get('/users/map-data?zoom=4')
+        self.assertEqual(response.status_code, 200)
+        with max_queries(3):
+            response = self.client.get('/resources/map-data?zoom=4')
+        self.assertEqual(response.status_code, 200)
+
+    def test_page_query_counts_do_not_grow_with_rows(self):
+        pages = ['/users', '/resources/', '/admin/users',
+                 '/resources/read/%d' % self.resource.id,
+                 '/resources/review/create/%d' % self.resource.id]
+        counts = []
+        for page in pages:
+            # Start each request with an empty session, as in production.
+            db.session.remove()
+            with count_queries() as stats:
+                response = self.client.get(page)
+            self.assertEqual(response.status_code, 200)
+            counts.append(stats.count)
+        self.add_users(10)
+        for page, count in zip(pages, counts):
+            db.session.remove()
+            with max_queries(count):
+                self.client.get(page)
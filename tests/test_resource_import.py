@@ -0,0 +1,97 @@
+import json
+import unittest
+from StringIO import StringIO
+from app import create_app, db
+from app.models import Address, Resource, ZIPCode, ZIPCodeCount, User
+from app.resource_import import import_resources, ImportFileError
+
+CSV = '''Name,Description,Website,Street_Address,City,State,ZIP_Code
+Food Bank,Food,http://food.example.com,3650 Spruce St,Philadelphia,pa,19104
+Legal Aid,Law,,1 Main St,Chelmsford,MA,1810
+Food Bank,Again,,3650 Spruce St,Philadelphia,PA,19104
+Clinic,Health,,2 Elm St,Nowhere,ZZ,00000
+Shelter,,,,,,19104-1234
+,No name,,,,,19104
+Bad Zip,,,,,,ABCDE
+'''
+
+
+class ResourceImportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_import_csv(self):
+        existing = Resource.create_resource('Legal Aid', 'Old', None)
+        existing.address = Address.create_address(
+            'Legal Aid', '1 Main St', 'Chelmsford', 'MA',
+            zip_code=ZIPCode.create_zip_code('01810'))
+        db.session.commit()
+
+        progress = []
+        report = import_resources(StringIO(CSV), 'csv', batch_size=2,
+                                  progress=lambda r: progress.append(
+                                      r['rows']))
+        self.assertEqual(report['rows'], 7)
+        self.assertEqual(report['imported'], 2)
+        self.assertEqual(report['addresses'], 2)
+        self.assertEqual(report['duplicates'], [
+            (3, 'Legal Aid', 'Already listed as resource %d.' % existing.id),
+            (4, 'Food Bank', 'Listed more than once.'),
+        ])
+        self.assertEqual(report['errors'], [
+            (5, 'Clinic', 'ZIP code 00000 could not be found.'),
+            (7, None, 'No name.'),
+            (8, 'Bad Zip', 'Invalid ZIP code ABCDE.'),
+        ])
+        self.assertEqual(progress, [2, 5, 7])
+
+        resource = Resource.query.filter_by(name='Food Bank').one()
+        self.assertEqual(resource.website, 'http://food.example.com')
+        self.assertEqual(resource.review_count, 0)
+        self.assertEqual(resource.address.state, 'PA')
+        self.assertEqual(resource.address.zip_code.zip_code, '19104')
+        self.assertIsNotNone(resource.address.latitude)
+        self.assertFalse(resource.address.is_geocoded)
+        shelter = Resource.query.filter_by(name='Shelter').one()
+        self.assertIsNone(shelter.address.street_address)
+
+        zip_code = ZIPCode.get_by_zip_code('19104')
+        self.assertEqual(zip_code.counts.resource_count, 2)
+        self.assertEqual(ZIPCodeCount.rebuild(), 2)
+        db.session.expire_all()
+        self.assertEqual(zip_code.counts.resource_count, 2)
+
+        # Importing the same file again adds nothing.
+        report = import_resources(StringIO(CSV), 'csv')
+        self.assertEqual(report['imported'], 0)
+        self.assertEqual(len(report['duplicates']), 4)
+
+    def test_import_jsonl(self):
+        user = User(first_name='Ann', last_name='Lee',
+                    email='ann@example.com')
+        db.session.add(user)
+        db.session.commit()
+        lines = [json.dumps({'name': u'Caf\xe9', 'zip_code': 19104}),
+                 '[1, 2]', '', 'not json']
+        report = import_resources(StringIO('\n'.join(lines)), 'jsonl',
+                                  user=user)
+        self.assertEqual(report['imported'], 1)
+        self.assertEqual(report['errors'], [
+            (2, None, 'Not a UTF-8 row or JSON object.'),
+            (4, None, 'Not a UTF-8 row or JSON object.'),
+        ])
+        resource = Resource.query.one()
+        self.assertEqual(resource.name, u'Caf\xe9')
+        self.assertEqual(resource.user, user)
+
+    def test_missing_column(self):
+        self.assertRaises(ImportFileError, import_resources,
+                          StringIO('name,city\nA,B\n'), 'csv')
@@ -0,0 +1,190 @@
+import unittest
+from app import create_app, db
+from app.models import Resource, ResourceReview, ClosedResourceDetail, \
+    User, Role
+
+
+class ResourceModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.resource = Resource.create_resource('Food bank', 'Food', None)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def counts(self):
+        db.session.expire_all()
+        r = Resource.query.get(self.resource.id)
+        return (r.review_count, r.rating_sum, r.average_rating,
+                r.rating_histogram(), r.closed_report_count)
+
+    def add_review(self, rating):
+        review = ResourceReview(timestamp=None, content='', rating=rating)
+        review.resource_id = self.resource.id
+        db.session.add(review)
+        Resource.update_review_counts(self.resource.id, added=rating)
+        db.session.commit()
+        return review
+
+    def test_review_counts(self):
+        self.assertEqual(self.counts(), (0, 0, None, [0, 0, 0, 0, 0], 0))
+        self.add_review(5)
+        self.add_review(2)
+        self.assertEqual(self.counts(), (2, 7, 3.5, [0, 1, 0, 0, 1], 0))
+        Resource.update_review_counts(self.resource.id, added=4, removed=2)
+        db.session.commit()
+        self.assertEqual(self.counts(), (2, 9, 4.5, [0, 0, 0, 1, 1], 0))
+        Resource.update_review_counts(self.resource.id, removed=5)
+        Resource.update_review_counts(self.resource.id, removed=4)
+        db.session.commit()
+        self.assertEqual(self.counts(), (0, 0, None, [0, 0, 0, 0, 0], 0))
+
+        ClosedResourceDetail.create_closed_resource('Gone', '',
+                                                    self.resource.id)
+        self.assertEqual(self.counts()[-1], 1)
+
+    def test_reconcile_counts(self):
+        self.add_review(5)
+        self.add_review(3)
+        ClosedResourceDetail.create_closed_resource('Gone', '',
+                                                    self.resource.id)
+        self.assertEqual(Resource.reconcile_counts(), 0)
+        Resource.query.update({'review_count': 7, 'rating_3_count': 0,
+                               'average_rating': 1.0,
+                               'closed_report_count': 0})
+        other = Resource.create_resource('Clinic', 'Health', None)
+        other.review_count = 1
+        db.session.commit()
+        self.assertEqual(Resource.reconcile_counts(), 2)
+        self.assertEqual(self.counts(), (2, 8, 4.0, [0, 0, 1, 0, 1], 1))
+        self.assertEqual(Resource.query.get(other.id).review_count, 0)
+
+    def test_review_views_update_counts(self):
+        Role.insert_roles()
+        db.session.add(User(first_name='A', last_name='B', email='a@b.com',
+                            password='password', confirmed=True))
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/account/login', data={'email': 'a@b.com',
+                                            'password': 'password'})
+        resource_id = self.resource.id
+        client.post('/resources/review/create/%d' % resource_id,
+                    data={'rating': 4, 'content': 'Good'})
+        self.assertEqual(self.counts()[:3], (1, 4, 4.0))
+        review_id = ResourceReview.query.first().id
+        client.post('/resources/review/update/%d' % review_id,
+                    data={'rating': 2, 'content': 'Bad'})
+        self.assertEqual(self.counts()[:4], (1, 2, 2.0, [0, 1, 0, 0, 0]))
+        client.get('/resources/review/delete/%d' % review_id)
+        self.assertEqual(self.counts()[:3], (0, 0, None))
+
+    def test_reviews_are_paginated_newest_first(self):
+        Role.insert_roles()
+        user = User(first_name='A', last_name='B', email='a@b.com',
+                    password='password', confirmed=True)
+        self.resource.user = user
+        for i in range(25):
+            review = ResourceReview(timestamp=None, content='Review %02d' % i,
+                                    rating=3)
+            review.resource = self.resource
+            review.user = user
+            db.session.add(review)
+        db.session.commit()
+        self.app.config['REVIEWS_PER_PAGE'] = 20
+        client = self.app.test_client()
+        client.post('/account/login', data={'email': 'a@b.com',
+                                            'password': 'password'})
+        data = client.get('/resources/read/%d' % self.resource.id).data
+        self.assertIn('Review 24', data)
+        self.assertIn('Review 05', data)
+        self.assertNotIn('Review 04', data)
+        self.assertLess(data.index('Review 24'), data.index('Review 05'))
+        after = data.split('after=')[1].split('"')[0]
+        data = client.get('/resources/read/%d?after=%s' %
+                          (self.resource.id, after)).data
+        self.assertIn('Review 04', data)
+        self.assertIn('Review 00', data)
+        self.assertNotIn('Review 05', data)
+        self.assertIn('before=', data)
+
+    def test_vote_counter_coalesces_increments(self):
+        from app.counters import CounterBuffer
+
+        reviews = [self.add_review(3), self.add_review(4)]
+        ids = [review.id for review in reviews]
+        counter = CounterBuffer(self.app, ResourceReview,
+                                ['count_likes', 'count_dislikes'],
+                                flush_interval=3600)
+        for i in range(5):
+            counter.increment(ids[0], 'count_likes')
+        counter.increment(ids[0], 'count_dislikes')
+        counter.increment(ids[1], 'count_likes', 5)
+        self.assertEqual(counter.pending(ids[0]),
+                         {'count_likes': 5, 'count_dislikes': 1})
+        with self.assertRaises(ValueError):
+            counter.increment(ids[0], 'rating')
+
+        self.assertEqual(counter.flush(), 3)
+        self.assertEqual(counter.pending(ids[0]),
+                         {'count_likes': 0, 'count_dislikes': 0})
+        db.session.expire_all()
+        self.assertEqual([(r.count_likes, r.count_dislikes) for r in
+                          ResourceReview.query.order_by(ResourceReview.id)],
+                         [(5, 1), (5, 0)])
+        counter.increment(ids[1], 'count_dislikes')
+        counter.stop()
+        db.session.expire_all()
+        self.assertEqual(ResourceReview.query.get(ids[1]).count_dislikes, 1)
+
+    def test_vote_counters_share_the_background_thread(self):
+        import threading
+        from app.counters import CounterBuffer
+
+        review_id = self.add_review(3).id
+        now = [0]
+        counters = [CounterBuffer(self.app, ResourceReview, ['count_likes'],
+                                  flush_interval=10, clock=lambda: now[0])
+                    for i in range(3)]
+        self.assertEqual(len([thread for thread in threading.enumerate()
+                              if thread.name == 'background']), 1)
+
+        counters[0].increment(review_id, 'count_likes')
+        counters[0].tick()
+        self.assertEqual(counters[0].pending(review_id)['count_likes'], 1)
+        now[0] = 10
+        counters[0].tick()
+        self.assertEqual(counters[0].pending(review_id)['count_likes'], 0)
+        for counter in counters:
+            counter.stop()
+
+    def test_vote_endpoint(self):
+        import json
+        from app.counters import get_vote_counter
+        from app.query_counter import max_queries
+
+        Role.insert_roles()
+        db.session.add(User(first_name='A', last_name='B', email='a@b.com',
+                            password='password', confirmed=True))
+        review_id = self.add_review(5).id
+        client = self.app.test_client()
+        client.post('/account/login', data={'email': 'a@b.com',
+                                            'password': 'password'})
+        client.post('/resources/review/%d/like' % review_id)
+        db.session.remove()
+        # The current user and the review's counts.
+        with max_queries(2):
+            response = client.post('/resources/review/%d/like' % review_id)
+        data = json.loads(response.data)
+        self.assertEqual(data, {'likes': 2, 'dislikes': 0})
+        get_vote_counter().flush()
+        data = json.loads(
+            client.post('/resources/review/%d/dislike' % review_id).data)
+        self.assertEqual(data, {'likes': 2, 'dislikes': 1})
+        get_vote_counter().flush()
+        db.session.expire_all()
+        self.assertEqual(ResourceReview.query.get(review_id).count_likes, 2)
@@ -0,0 +1,85 @@
+import json
+import unittest
+from app import create_app, db
+from app.models import User, Role
+from app import search
+from app.search import search_users, rebuild_index
+
+
+class SearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        for first_name, last_name in [('Joan', 'Smith'), ('John', 'Doe'),
+                                      ('Mary', 'Johnson'), ('Ann', 'Jones'),
+                                      ('Jo', 'Smithers')]:
+            db.session.add(User(first_name=first_name, last_name=last_name,
+                                email='%s@example.com' % first_name,
+                                password='password', confirmed=True))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def names(self, query, **kwargs):
+        users, has_next = search_users(query, **kwargs)
+        return [u.full_name() for u in users]
+
+    def test_prefix_match(self):
+        self.assertEqual(self.names('joh'), ['John Doe', 'Mary Johnson'])
+        self.assertEqual(self.names('JO SMI'), ['Joan Smith', 'Jo Smithers'])
+        self.assertEqual(self.names('xyz'), [])
+        self.assertEqual(self.names('%'), [])
+
+    def test_pagination(self):
+        users, has_next = search_users('jo', per_page=3)
+        self.assertEqual(len(users), 3)
+        self.assertTrue(has_next)
+        more, has_next = search_users('jo', page=2, per_page=3)
+        self.assertEqual(len(more), 2)
+        self.assertFalse(has_next)
+        self.assertFalse(set(users) & set(more))
+
+    def test_index_follows_changes(self):
+        user = User.query.filter_by(first_name='Ann').first()
+        user.last_name = 'Brown'
+        db.session.commit()
+        self.assertEqual(self.names('jones'), [])
+        self.assertEqual(self.names('bro'), ['Ann Brown'])
+        db.session.delete(user)
+        db.session.commit()
+        self.assertEqual(self.names('ann'), [])
+
+    def test_without_fts5(self):
+        search._fts5_available = False
+        try:
+            self.assertEqual(self.names('joh'), ['John Doe', 'Mary Johnson'])
+            self.assertEqual(self.names('JO SMI'), ['Joan Smith',
+                                                    'Jo Smithers'])
+            self.assertEqual(self.names('%'), [])
+        finally:
+            search._fts5_available = None
+
+    def test_rebuild_index(self):
+        db.session.execute('DROP TABLE user_search')
+        rebuild_index()
+        self.assertEqual(self.names('mary'), ['Mary Johnson'])
+
+    def test_search_endpoint(self):
+        client = self.app.test_client()
+        client.post('/account/login', data={
+            'email': 'Joan@example.com',
+            'password': 'password'
+        })
+        self.app.config['SEARCH_RESULTS_PER_PAGE'] = 2
+        data = json.loads(client.get('/search/smi').data)
+        self.assertEqual([r['title'] for r in data['results']],
+                         ['Joan Smith', 'Jo Smithers'])
+        self.assertIsNone(data['next_page'])
+        data = json.loads(client.get('/search/jo').data)
+        self.assertEqual(data['next_page'], 2)
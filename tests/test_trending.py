@@ -0,0 +1,96 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import Resource, ResourceReview
+from app.trending import update_trending_scores, trending_resources, \
+    current_score
+
+
+class TrendingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.half_life = self.app.config['TRENDING_HALF_LIFE']
+        self.resources = [Resource.create_resource(name, '', None)
+                          for name in ('Old', 'New', 'Quiet')]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_review(self, resource, rating, age):
+        review = ResourceReview(
+            timestamp=datetime.utcnow() - timedelta(seconds=age),
+            content='', rating=rating)
+        review.resource_id = resource.id
+        db.session.add(review)
+        db.session.commit()
+        return review
+
+    def names(self):
+        return [r.name for r in trending_resources()]
+
+    def score(self, resource):
+        db.session.expire_all()
+        return current_score(Resource.query.get(resource.id).trending_score,
+                             self.half_life)
+
+    def test_decay(self):
+        old, new, quiet = self.resources
+        for _ in range(3):
+            self.add_review(old, 5, 3 * self.half_life)
+        self.add_review(new, 3, 0)
+        self.assertEqual(update_trending_scores(), 4)
+        self.assertEqual(self.names(), ['New', 'Old'])
+        # Three five star reviews three half-lives ago weigh 3 * 5/3 / 8.
+        self.assertAlmostEqual(self.score(old), 0.625, places=3)
+        self.assertAlmostEqual(self.score(new), 1.0, places=3)
+        self.assertEqual(self.score(quiet), 0.0)
+
+    def test_incremental_update(self):
+        old, new, quiet = self.resources
+        self.add_review(old, 5, self.half_life)
+        self.add_review(new, 1, 0)
+        update_trending_scores()
+        self.assertEqual(update_trending_scores(), 0)
+        self.assertEqual(self.names(), ['Old', 'New'])
+        self.add_review(new, 5, 0)
+        self.add_review(quiet, 1, 0)
+        # Both reviews of New are recounted.
+        self.assertEqual(update_trending_scores(), 3)
+        self.assertEqual(self.names(), ['New', 'Old', 'Quiet'])
+        scores = [self.score(r) for r in self.resources]
+        self.assertEqual(update_trending_scores(rebuild=True), 4)
+        for resource, score in zip(self.resources, scores):
+            self.assertAlmostEqual(self.score(resource), score, places=6)
+
+    def test_edited_and_deleted_reviews(self):
+        old, new, quiet = self.resources
+        self.add_review(old, 3, 0)
+        review = self.add_review(new, 3, 0)
+        update_trending_scores()
+        self.assertAlmostEqual(self.score(new), 1.0, places=3)
+
+        # Votes don't change the score.
+        review.count_likes = 1
+        db.session.commit()
+        self.assertEqual(update_trending_scores(), 0)
+
+        review.rating = 5
+        db.session.commit()
+        self.assertEqual(update_trending_scores(), 1)
+        self.assertAlmostEqual(self.score(new), 5 / 3.0, places=3)
+
+        review.resource_id = quiet.id
+        db.session.commit()
+        self.assertEqual(update_trending_scores(), 1)
+        self.assertEqual(self.score(new), 0.0)
+        self.assertAlmostEqual(self.score(quiet), 5 / 3.0, places=3)
+
+        db.session.delete(review)
+        db.session.commit()
+        update_trending_scores()
+        self.assertEqual(self.names(), ['Old'])